@@ -0,0 +1,76 @@
+# Replay of an offline backlog by the exercise_2 server, with and without
+# MessageBatch frames.
+#
+# usage: python benchmarks/bench_backlog_replay.py [--messages N]
+#
+# Stores N messages for an offline receiver, then connects as that receiver and
+# measures how long the whole backlog takes to arrive.
+
+import asyncio
+import shutil
+import tempfile
+import time
+from sys import argv
+
+import common
+
+pb2 = common.load_pb2(2)
+RECEIVER = 1_000_000
+
+
+async def fill_backlog(port, messages):
+    reader, writer, id = await common.open_client(2, pb2, port)
+    for i in range(messages):
+        writer.write(common.encode_frame(pb2.Message(fr=id, to=RECEIVER, msg=f"backlog message {i:08d}")))
+        if i % 1000 == 0:
+            await writer.drain()
+    # a message to ourselves marks the point where everything before it was stored
+    writer.write(common.encode_frame(pb2.Message(fr=id, to=id, msg="done")))
+    await writer.drain()
+    await common.read_frame(reader)
+    writer.close()
+
+
+async def replay(port, messages, batching):
+    start = time.perf_counter()
+    reader, writer, _ = await common.open_client(2, pb2, port, desired_id=RECEIVER, batching=batching)
+    received = frames = 0
+    while received < messages:
+        frame = await common.read_frame(reader)
+        frames += 1
+        if batching:
+            received += len(pb2.MessageBatch.FromString(frame).messages)
+        else:
+            pb2.Message.FromString(frame)
+            received += 1
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed, frames
+
+
+def run(name, messages, batching, store_args):
+    port = common.free_port()
+    proc = common.start_server(2, port, *store_args)
+    try:
+        asyncio.run(fill_backlog(port, messages))
+        elapsed, frames = asyncio.run(replay(port, messages, batching))
+    finally:
+        common.stop_server(proc)
+    print(f"{name:<28} {messages / elapsed:10.0f} msg/s   {elapsed:6.2f}s   {frames:7d} frames")
+
+
+def main():
+    messages = int(argv[argv.index("--messages") + 1]) if "--messages" in argv else 100000
+    print(f"replaying a backlog of {messages} messages")
+    for batching in (False, True):
+        label = "batched" if batching else "single frames"
+        run(f"memory store, {label}", messages, batching, ())
+        store_dir = tempfile.mkdtemp()
+        try:
+            run(f"segment store, {label}", messages, batching, ("--store-dir", store_dir, "--ram-budget", "0"))
+        finally:
+            shutil.rmtree(store_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# Per-message cost of the wire codecs of exercise_1 and exercise_2 (codec.py):
+# protobuf against the fixed layout the relay routes on its header.
+#
+# usage: python benchmarks/bench_codec.py [--exercise 1|2] [--messages N] [--sizes 16,128,1024,8192]
+#            [--server-args "--asyncio ..."]
+#
+# In process, per text size, microseconds per message for
+#   encode     a client serializing a Message
+#   decode     a client reading one, fixed layout receivers read both encodings
+#   route      what the relay does with a frame before queueing it: parse,
+#              check for "end", find `to`, serialize again; for the fixed
+#              layout read the header and copy the frame out of the read buffer
+#   convert    fixed layout payload rewritten as protobuf by the writer of a
+#              receiver that did not negotiate the codec
+# Then through a real server: N messages from one client to another for each
+# pair of sender and receiver codecs, with the relay's own mean of
+# relay_route_seconds and the messages per second that arrived.
+
+import asyncio
+import shlex
+import sys
+import time
+import urllib.request
+from sys import argv
+
+import common
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+EXERCISE = int(get_option("--exercise", 2))
+sys.path.insert(0, common.exercise_dir(EXERCISE))
+import codec  # noqa: E402  (lives next to template_pb2)
+import template_pb2  # noqa: E402
+
+PROTOBUF = codec.CODECS[codec.PROTOBUF]
+FIXED = codec.CODECS[codec.FIXED]
+
+
+def timed(function, items):
+    # microseconds per item
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) * 1e6 / len(items)
+
+
+def route_protobuf(frame):
+    # the protobuf path of the relay handlers
+    msg = template_pb2.Message.FromString(frame)
+    if msg.HasField("trace"):
+        pass
+    if msg.msg.lower() == "end":
+        return None
+    if msg.msg == '':
+        msg.msg = 'empty string'
+    return msg.to, msg.SerializeToString()
+
+
+def route_fixed(frame):
+    # the fixed layout path of the relay handlers
+    if not codec.is_fixed(frame):
+        return None
+    to, _, _ = codec.check(frame)
+    if codec.is_end(frame):
+        return None
+    return to, bytes(frame) if len(frame) > codec.HEADER_SIZE else bytes(frame) + b"empty string"
+
+
+def bench_in_process(count, sizes):
+    print(f"exercise_{EXERCISE}, in process, us per message")
+    print(f"  {'text bytes':>10} {'codec':<9} {'wire bytes':>10} {'encode':>8} {'decode':>8} {'route':>8} {'convert':>8}")
+    for size in sizes:
+        messages = [template_pb2.Message(fr=1000 + i, to=2000 + i, msg=("%d " % i + "x" * size)[:size])
+                    for i in range(count)]
+        for wire in (PROTOBUF, FIXED):
+            payloads = [wire.encode(msg) for msg in messages]
+            # frames are handed out as memoryviews into the connection's read buffer
+            frames = [memoryview(payload) for payload in payloads]
+            encode = timed(wire.encode, messages)
+            decode = timed(wire.decode, frames)
+            route = timed(route_fixed if wire is FIXED else route_protobuf, frames)
+            convert = f"{timed(codec.to_protobuf, payloads):8.2f}" if wire is FIXED else f"{'-':>8}"
+            print(f"  {size:>10} {wire.name:<9} {sum(map(len, payloads)) / count:>10.0f} {encode:8.2f} "
+                  f"{decode:8.2f} {route:8.2f} {convert}", flush=True)
+
+
+def metric(metrics_port, name):
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith(name + " "):
+                return float(line.split()[1])
+    return 0.0
+
+
+async def connect(port, wire, desired_id):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if EXERCISE == 1:
+        handshake = template_pb2.FastHandshake.FromString(await common.read_frame(reader))
+    else:
+        requested = "" if wire is PROTOBUF else wire.name
+        writer.write(common.encode_frame(template_pb2.Handshake(id=desired_id, change_id=True, codec=requested)))
+        handshake = template_pb2.Handshake.FromString(await common.read_frame(reader))
+    return reader, writer, handshake.id
+
+
+async def relay_pair(port, metrics_port, sender_wire, receiver_wire, count, size, base_id):
+    # (route us per message, messages/s) of count messages from a sender to a receiver
+    receiver_reader, receiver_writer, receiver_id = await connect(port, receiver_wire, base_id)
+    if receiver_wire is FIXED and EXERCISE == 1:
+        # exercise_1 takes a fixed layout message as the sign that the client reads them
+        hello = FIXED.encode(template_pb2.Message(fr=receiver_id, to=-2, msg="hello"))
+        receiver_writer.write(len(hello).to_bytes(4, "big") + hello)
+    _, sender_writer, sender_id = await connect(port, sender_wire, base_id + 1)
+    payloads = [sender_wire.encode(template_pb2.Message(fr=sender_id, to=receiver_id,
+                                                        msg=("%d " % i + "x" * size)[:size])) for i in range(count)]
+    await asyncio.sleep(0.2)
+
+    routed = metric(metrics_port, "relay_route_seconds_count")
+    seconds = metric(metrics_port, "relay_route_seconds_sum")
+    start = time.perf_counter()
+    sender_writer.writelines(len(payload).to_bytes(4, "big") + payload for payload in payloads)
+    received = 0
+    while received < count:
+        if await asyncio.wait_for(common.read_frame(receiver_reader), 10):
+            received += 1
+    elapsed = time.perf_counter() - start
+    route = ((metric(metrics_port, "relay_route_seconds_sum") - seconds)
+             / max(metric(metrics_port, "relay_route_seconds_count") - routed, 1))
+    sender_writer.close()
+    receiver_writer.close()
+    return route * 1e6, count / elapsed
+
+
+async def bench_server(count, size, server_args):
+    port = common.free_port()
+    metrics_port = common.free_port()
+    proc = common.start_server(EXERCISE, port, "--metrics-port", str(metrics_port), "--log-level", "error",
+                               *server_args)
+    try:
+        await asyncio.sleep(0.5)
+        print(f"exercise_{EXERCISE} {' '.join(server_args) or 'threaded'}, {count} messages of {size} bytes "
+              f"through the relay")
+        for index, (sender_wire, receiver_wire) in enumerate(
+                ((PROTOBUF, PROTOBUF), (FIXED, FIXED), (FIXED, PROTOBUF), (PROTOBUF, FIXED))):
+            route, rate = await relay_pair(port, metrics_port, sender_wire, receiver_wire, count, size,
+                                           100_000 + index * 10)
+            print(f"  {sender_wire.name:>8} -> {receiver_wire.name:<8} route {route:6.2f} us/msg   "
+                  f"{rate:9.0f} msg/s", flush=True)
+    finally:
+        common.stop_server(proc)
+
+
+def main():
+    count = int(get_option("--messages", 20000))
+    sizes = [int(size) for size in get_option("--sizes", "16,128,1024,8192").split(",")]
+    bench_in_process(count, sizes)
+    asyncio.run(bench_server(count, 128, shlex.split(get_option("--server-args", ""))))
+
+
+if __name__ == "__main__":
+    main()
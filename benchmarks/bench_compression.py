@@ -0,0 +1,157 @@
+# CPU against bytes on the wire for the frame compression of exercise_2, on a
+# generated chat corpus: mostly short lines, some questions with times and
+# names, links, and now and then a pasted paragraph or log excerpt.
+#
+# usage: python benchmarks/bench_compression.py [--messages N] [--seed S]
+#
+# Reported per setting: wire bytes (4 byte headers included) relative to the
+# uncompressed frames, and the CPU spent deflating on the sender and inflating
+# on the receiver, per message. Batches are compared with the single frames too.
+# Settings:
+#   single frames  every Message in a frame of its own, compressed when it has
+#                  at least `min` bytes; with and without the preset dictionary
+#                  and at several zlib levels
+#   batches        MessageBatch frames of B messages, compressed as a whole, as
+#                  the relay sends them to clients that negotiated batching
+
+import random
+import sys
+import time
+import zlib
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(2))
+import compression  # noqa: E402  (lives next to template_pb2)
+import template_pb2  # noqa: E402
+from outbound import encode_batch  # noqa: E402
+
+HEADER = 4
+NAMES = ["Ana", "Bruno", "Chen", "Dara", "Emeka", "Farah", "Giulia", "Hugo", "Ines", "Jonas", "Kenji", "Lea"]
+PLACES = ["the office", "room 4B", "the cafe downstairs", "the station", "Lisbon", "the main hall", "home"]
+TOPICS = ["the quarterly report", "the new login page", "the release notes", "the budget", "the onboarding doc",
+          "the flaky integration test", "the customer demo", "the database migration", "the holiday schedule"]
+SHORT = ["ok", "yes", "no", "sure", "thanks!", "lol", "on it", "done", "brb", "+1", "nice", "k", "omw", "ty",
+         "haha true", "not yet", "give me 5 min", "sounds good", "good morning", "night all"]
+TEMPLATES = [
+    "hey {name}, did you get a chance to look at {topic}?",
+    "I'm at {place}, are you around?",
+    "can we move the call to {time}? something came up",
+    "{name} said {topic} should be ready by {day}",
+    "just pushed a fix for {topic}, can you review when you have time",
+    "where are we meeting, {place} or {place2}?",
+    "running {minutes} minutes late, sorry!",
+    "did anyone see the email about {topic}",
+    "here's the link: https://docs.example.com/{slug}/{number}",
+    "I think {name} is handling {topic}, ask them",
+    "lunch at {time}? {place} maybe",
+    "{name} and I will be at {place} from {time}",
+    "quick question about {topic}: is it still blocked on {name}?",
+    "thanks {name}, that fixed it",
+]
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "tomorrow", "next week", "end of day"]
+LOG_LINES = ["ERROR connection refused to db-{n}:5432", "WARN retrying request {n} after timeout",
+             "INFO user {n} logged in from 10.0.{n}.{m}", "DEBUG cache miss for key session:{n}:{m}"]
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def chat_line(rng):
+    roll = rng.random()
+    if roll < 0.35:
+        return rng.choice(SHORT)
+    if roll < 0.9:
+        place, place2 = rng.sample(PLACES, 2)
+        return rng.choice(TEMPLATES).format(
+            name=rng.choice(NAMES), topic=rng.choice(TOPICS), place=place, place2=place2,
+            time=f"{rng.randint(8, 18)}:{rng.choice(['00', '15', '30', '45'])}", day=rng.choice(DAYS),
+            minutes=rng.choice([5, 10, 15, 20]), slug=rng.choice(TOPICS).split()[-1], number=rng.randint(100, 99999))
+    if roll < 0.97:
+        # a paragraph: several sentences in a row
+        return " ".join(chat_line(rng) for _ in range(rng.randint(3, 8)))
+    # a pasted log excerpt
+    return "\n".join(rng.choice(LOG_LINES).format(n=rng.randint(1, 999), m=rng.randint(1, 255))
+                     for _ in range(rng.randint(5, 30)))
+
+
+def corpus(count, seed):
+    rng = random.Random(seed)
+    return [template_pb2.Message(fr=rng.randint(1, 5000), to=rng.randint(1, 5000), msg=chat_line(rng))
+            .SerializeToString() for _ in range(count)]
+
+
+def deflate_with(data, level, zdict):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, compression.WBITS, compression.MEM_LEVEL, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, compression.WBITS, compression.MEM_LEVEL)
+    deflated = compressor.compress(data) + compressor.flush()
+    return deflated if len(deflated) < len(data) else None
+
+
+def inflate_with(data, zdict):
+    if zdict:
+        return zlib.decompressobj(compression.WBITS, zdict=zdict).decompress(data)
+    return zlib.decompressobj(compression.WBITS).decompress(data)
+
+
+def measure(frames, minimum, level, zdict):
+    # (wire bytes, deflate seconds, inflate seconds) of sending every frame
+    wire = 0
+    deflated_frames = []
+    start = time.process_time()
+    for frame in frames:
+        deflated = deflate_with(frame, level, zdict) if len(frame) >= minimum else None
+        if deflated is None:
+            wire += HEADER + len(frame)
+        else:
+            wire += HEADER + len(deflated)
+            deflated_frames.append(deflated)
+    deflate_seconds = time.process_time() - start
+    start = time.process_time()
+    for deflated in deflated_frames:
+        inflate_with(deflated, zdict)
+    inflate_seconds = time.process_time() - start
+    return wire, deflate_seconds, inflate_seconds
+
+
+def report(label, frames, messages, baseline, minimum, level, zdict):
+    wire, deflate_seconds, inflate_seconds = measure(frames, minimum, level, zdict)
+    print(f"  {label:<34} wire {wire / baseline:6.1%}   deflate {deflate_seconds * 1e6 / messages:5.2f} us/msg   "
+          f"inflate {inflate_seconds * 1e6 / messages:5.2f} us/msg", flush=True)
+
+
+def main():
+    count = int(get_option("--messages", 20000))
+    messages = corpus(count, int(get_option("--seed", 1)))
+    sizes = sorted(len(message) for message in messages)
+    print(f"{count} messages, {sum(sizes) / count:.0f} bytes on average, median {sizes[count // 2]}, "
+          f"p90 {sizes[count * 9 // 10]}, max {sizes[-1]}; "
+          f"{sum(size >= compression.COMPRESS_MIN for size in sizes) / count:.0%} "
+          f"have at least COMPRESS_MIN={compression.COMPRESS_MIN} bytes")
+    baseline = sum(HEADER + len(message) for message in messages)
+    dictionary = compression.DICTIONARY
+
+    print("single frames")
+    report("uncompressed", messages, count, baseline, float("inf"), compression.LEVEL, dictionary)
+    for minimum in (0, 64, 128, 256, 512):
+        report(f"min {minimum:>3}, level 6, dictionary", messages, count, baseline, minimum, 6, dictionary)
+    report("min 128, level 6, no dictionary", messages, count, baseline, 128, 6, None)
+    for level in (1, 9):
+        report(f"min 128, level {level}, dictionary", messages, count, baseline, 128, level, dictionary)
+
+    print("MessageBatch frames, compressed as a whole")
+    for batch in (8, 32, 256):
+        frames = [encode_batch(messages[i:i + batch]) for i in range(0, count, batch)]
+        report(f"{batch:>3} messages, uncompressed", frames, count, baseline, float("inf"), 6, dictionary)
+        report(f"{batch:>3} messages, dictionary", frames, count, baseline, 0, 6, dictionary)
+        report(f"{batch:>3} messages, no dictionary", frames, count, baseline, 0, 6, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Fan-out of one sender's messages to every member of a group on the exercise_2
+# server: a channel message serialized once by the server, against the sender
+# addressing every member with its own Message.
+#
+# usage: python benchmarks/bench_fanout.py [--members N] [--messages M] [--asyncio]
+#
+# Reports the time until every member received all M messages, the bytes the
+# sender had to upload and the CPU time the server spent.
+
+import asyncio
+import os
+import time
+from sys import argv
+
+import common
+
+pb2 = common.load_pb2(2)
+CHANNEL = "bench"
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def cpu_seconds(pid):
+    # utime + stime of a running process, read from /proc
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def open_member(port):
+    reader, writer, id = await common.open_client(2, pb2, port)
+    writer.write(common.encode_frame(pb2.Message(fr=id, channel=CHANNEL, op=pb2.JOIN)))
+    # the server handles our frames in order, so the join is done once this comes back
+    writer.write(common.encode_frame(pb2.Message(fr=id, to=id, msg="joined")))
+    await writer.drain()
+    await common.read_frame(reader)
+    return reader, writer, id
+
+
+async def receive(reader, messages):
+    for _ in range(messages):
+        pb2.Message.FromString(await common.read_frame(reader))
+
+
+async def run(proc, port, members, messages, use_channel):
+    clients = []
+    for _ in range(members):
+        clients.append(await open_member(port))
+    sender_reader, sender, sender_id = await common.open_client(2, pb2, port)
+
+    receivers = [asyncio.create_task(receive(reader, messages)) for reader, _, _ in clients]
+    uploaded = 0
+    cpu = cpu_seconds(proc.pid)
+    start = time.perf_counter()
+    for i in range(messages):
+        if use_channel:
+            frames = [common.encode_frame(pb2.Message(fr=sender_id, channel=CHANNEL, msg=f"fan-out message {i}"))]
+        else:
+            frames = [common.encode_frame(pb2.Message(fr=sender_id, to=id, msg=f"fan-out message {i}"))
+                      for _, _, id in clients]
+        for frame in frames:
+            sender.write(frame)
+            uploaded += len(frame)
+        await sender.drain()
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds(proc.pid) - cpu
+
+    sender.close()
+    for _, writer, _ in clients:
+        writer.close()
+    return elapsed, uploaded, cpu
+
+
+def main():
+    members = int(get_option("--members", 1000))
+    messages = int(get_option("--messages", 100))
+    mode = ("--asyncio",) if "--asyncio" in argv else ()
+    common.raise_fd_limit()
+
+    print(f"{messages} messages to {members} members ({'asyncio' if mode else 'threaded'} server)")
+    for use_channel in (False, True):
+        port = common.free_port()
+        proc = common.start_server(2, port, *mode)
+        try:
+            elapsed, uploaded, cpu = asyncio.run(run(proc, port, members, messages, use_channel))
+        finally:
+            common.stop_server(proc)
+        label = "channel fan-out" if use_channel else "per-client sends"
+        deliveries = members * messages
+        print(f"{label:<18} {deliveries / elapsed:10.0f} deliveries/s   {elapsed:6.2f}s   "
+              f"uploaded {uploaded / 1024:9.1f} KiB   server cpu {cpu:6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Micro-benchmark of the framing layer: the original send_message/receive_message
+# pair against framing.FrameReader/send_frames, over a local socketpair.
+#
+# usage: python benchmarks/bench_framing.py [--messages N] [--size BYTES]
+#
+# Reports syscalls per message on each side and messages per second.
+
+import socket
+import time
+from sys import argv
+from threading import Thread
+
+import common
+
+common.load_pb2(2)
+import framing  # noqa: E402  (lives next to template_pb2)
+
+
+class CountingSocket:
+    # forwards to a real socket and counts the I/O syscalls made through it
+    COUNTED = ("recv", "recv_into", "send", "sendall", "sendmsg")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name not in self.COUNTED:
+            return attr
+
+        def counted(*args):
+            self.calls += 1
+            return attr(*args)
+        return counted
+
+
+def legacy_send(conn, payload):
+    conn.sendall(len(payload).to_bytes(4, byteorder="big"))
+    conn.sendall(payload)
+
+
+def legacy_receive(conn):
+    size = int.from_bytes(conn.recv(4), byteorder="big")
+    return conn.recv(size)
+
+
+def framing_send(conn, payload):
+    framing.send_frame(conn, payload)
+
+
+def run(name, send, make_receive, messages, payload):
+    a, b = socket.socketpair()
+    writer, reader = CountingSocket(a), CountingSocket(b)
+    receive = make_receive(reader)
+
+    def produce():
+        for _ in range(messages):
+            send(writer, payload)
+
+    start = time.perf_counter()
+    producer = Thread(target=produce)
+    producer.start()
+    for _ in range(messages):
+        receive()
+    producer.join()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+
+    print(f"{name:<10} send {writer.calls / messages:5.2f} syscalls/msg   "
+          f"receive {reader.calls / messages:5.2f} syscalls/msg   "
+          f"{messages / elapsed:10.0f} msg/s")
+
+
+def main():
+    messages = int(argv[argv.index("--messages") + 1]) if "--messages" in argv else 200000
+    size = int(argv[argv.index("--size") + 1]) if "--size" in argv else 64
+    payload = b"x" * size
+
+    print(f"{messages} messages of {size} bytes")
+    run("legacy", legacy_send, lambda r: (lambda: legacy_receive(r)), messages, payload)
+    run("framing", framing_send, lambda r: framing.FrameReader(r).read_frame, messages, payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Relay throughput with logging at each level: the same bench_relay_load run
+# against a server started with --log-level error, warning, info and debug,
+# debug once to stdout, once to a rotating file and once sampled.
+#
+# usage: python benchmarks/bench_logging.py [--exercise 1|2] [--clients N] [--processes P]
+#            [--duration S] [--rate R] [--server-args "--asyncio ..."] [--configs error,debug-file,...]
+#
+# At debug every relayed message is a log record; at info and above the
+# per-message call returns after comparing levels. The server's stdout goes to
+# /dev/null, so debug-stdout measures the pipeline without a terminal behind it.
+# --rate 0 (the default) sends as fast as the server takes the messages.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from sys import argv
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+CONFIGS = {
+    "error": ["--log-level", "error"],
+    "warning": ["--log-level", "warning"],
+    "info": ["--log-level", "info"],
+    "debug-stdout": ["--log-level", "debug"],
+    "debug-file": ["--log-level", "debug", "--log-file", "{dir}/relay.log"],
+    "debug-sampled": ["--log-level", "debug", "--log-file", "{dir}/relay.log", "--log-sample", "messages=100"],
+}
+
+
+def run(name, log_args, options, directory):
+    output = os.path.join(directory, "results.jsonl")
+    server_args = " ".join([options["server_args"], *(arg.format(dir=directory) for arg in log_args)]).strip()
+    subprocess.run([sys.executable, "bench_relay_load.py", "--exercise", options["exercise"],
+                    "--clients", options["clients"], "--processes", options["processes"],
+                    "--duration", options["duration"], "--rate", options["rate"],
+                    "--server-args", server_args, "--output", output],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        result = json.loads(f.readlines()[-1])["result"]
+    logged = sum(os.path.getsize(os.path.join(directory, file)) for file in os.listdir(directory)
+                 if file.startswith("relay.log"))
+    return result, logged
+
+
+def main():
+    options = {
+        "exercise": get_option("--exercise", "2"),
+        "clients": get_option("--clients", "100"),
+        "processes": get_option("--processes", "2"),
+        "duration": get_option("--duration", "5"),
+        "rate": get_option("--rate", "0"),
+        "server_args": get_option("--server-args", ""),
+    }
+    names = get_option("--configs", ",".join(CONFIGS)).split(",")
+    for name in names:
+        if name not in CONFIGS:
+            print(f"Invalid config {name}, expected one of: {', '.join(CONFIGS)}")
+            return
+
+    print(f"exercise_{options['exercise']} {options['server_args'] or 'threaded'}, {options['clients']} clients, "
+          f"{options['duration']}s at {'the highest rate' if options['rate'] == '0' else options['rate'] + ' msg/s'}")
+    for name in names:
+        with tempfile.TemporaryDirectory() as directory:
+            result, logged = run(name, CONFIGS[name], options, directory)
+        cpu_per_message = result["server_cpu_seconds"] * 1e6 / result["received"] if result["received"] else 0
+        latency = result["latency_ms"]
+        print(f"{name:<14} {result['msgs_per_sec']:8.0f} msg/s   server cpu {cpu_per_message:6.1f} us/msg   "
+              f"p99 {latency['p99'] or 0:8.2f} ms   log file {logged / 1024:8.0f} KiB", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Burst handling of the threaded exercise_3 Peer against the asyncio engine.
+#
+# usage: python benchmarks/bench_peer_engines.py [--messages N] [--hops H]
+#
+# One peer sends N messages back to back along a chain of H + 1 peers. Without
+# retransmissions the delivery ratio shows how many datagrams the relays lost
+# while they were busy; with them, the time until everything arrived.
+
+import asyncio
+import contextlib
+import io
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+from async_peer import AsyncPeer
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def link(peers):
+    for left, right in zip(peers, peers[1:]):
+        left.connect_to_peer("127.0.0.1", right.port)
+
+
+def run_threaded(messages, hops, reliable):
+    peers = [Peer("127.0.0.1", free_udp_port(), reliable=reliable) for _ in range(hops + 1)]
+    link(peers)
+    time.sleep(0.2)
+    source, destination = peers[0], peers[-1]
+    start = time.perf_counter()
+    for i in range(messages):
+        source.broadcast_message(f"engine benchmark {i}", destination.peer_id)
+    last, idle_since = -1, time.time()
+    while destination.messages_received < messages and time.time() - idle_since < 2:
+        if destination.messages_received != last:
+            last, idle_since = destination.messages_received, time.time()
+        time.sleep(0.01)
+    return destination.messages_received, time.perf_counter() - start
+
+
+async def run_async(messages, hops, reliable):
+    peers = [AsyncPeer("127.0.0.1", free_udp_port(), reliable=reliable) for _ in range(hops + 1)]
+    for peer in peers:
+        await peer.start()
+    link(peers)
+    await asyncio.sleep(0.2)
+    source, destination = peers[0], peers[-1]
+    start = time.perf_counter()
+    for i in range(messages):
+        await source.send(f"engine benchmark {i}", destination.peer_id)
+
+    async def receive_all():
+        for _ in range(messages):
+            await destination.receive()
+
+    try:
+        await asyncio.wait_for(receive_all(), 30)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    for peer in peers:
+        peer.close()
+    return destination.messages_received, elapsed
+
+
+def main():
+    messages = int(get_option("--messages", 20000))
+    hops = int(get_option("--hops", 2))
+
+    print(f"{messages} messages over {hops} hops")
+    for reliable in (False, True):
+        for engine in ("threaded", "asyncio"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                if engine == "threaded":
+                    delivered, elapsed = run_threaded(messages, hops, reliable)
+                else:
+                    delivered, elapsed = asyncio.run(run_async(messages, hops, reliable))
+            label = "reliable" if reliable else "fire and forget"
+            print(f"{engine:<9} {label:<16} delivered {delivered:7d}/{messages} "
+                  f"({delivered / messages:7.2%})   {elapsed:6.2f}s   {delivered / elapsed:8.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Throughput of large exercise_3 Peer messages, which travel as fragments,
+# across a chain of local peers.
+#
+# usage: python benchmarks/bench_peer_fragments.py [--hops H] [--mtu M]
+#
+# Sends payloads from 64 KiB to 10 MiB from one end of a chain of H + 1 peers
+# to the other and measures the time until the last peer reassembled them.
+# Fragments are sized to the path MTU (64 KiB on loopback) unless --mtu is given,
+# e.g. --mtu 1500 to see what an Ethernet path would cost.
+
+import contextlib
+import io
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+
+PAYLOADS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 10 * 1024 * 1024)
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def send(source, destination, size):
+    received = destination.messages_received
+    start = time.perf_counter()
+    source.broadcast_message("x" * size, destination.peer_id)
+    deadline = time.time() + 120
+    while destination.messages_received == received and time.time() < deadline:
+        time.sleep(0.001)
+    if destination.messages_received == received:
+        return None
+    return time.perf_counter() - start
+
+
+def main():
+    hops = int(get_option("--hops", 2))
+    mtu = get_option("--mtu", None)
+    mtu = int(mtu) if mtu else None
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        peers = [Peer("127.0.0.1", free_udp_port(), mtu=mtu) for _ in range(hops + 1)]
+        for left, right in zip(peers, peers[1:]):
+            left.connect_to_peer("127.0.0.1", right.port)
+        time.sleep(0.2)
+    source, destination = peers[0], peers[-1]
+
+    print(f"{hops} hops, fragments of {source.fragment_size()} bytes")
+    for size in PAYLOADS:
+        retransmissions = source.stats()["retransmissions"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed = send(source, destination, size)
+        retransmissions = source.stats()["retransmissions"] - retransmissions
+        fragments = -(-size // source.fragment_size())
+        if elapsed is None:
+            print(f"{size // 1024:6d} KiB   not delivered")
+            continue
+        print(f"{size // 1024:6d} KiB   {fragments:6d} fragments   {elapsed * 1000:9.1f} ms   "
+              f"{size / elapsed / 1024 / 1024:7.1f} MiB/s   retransmissions {retransmissions}")
+
+
+if __name__ == "__main__":
+    main()
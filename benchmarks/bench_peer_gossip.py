@@ -0,0 +1,107 @@
+# Delivery ratio against traffic for exercise_3 Peers, flooding against
+# gossip with and without push-pull anti-entropy.
+#
+# usage: python benchmarks/bench_peer_gossip.py [--peers N] [--degree D] [--messages M] [--fanouts 2,3]
+#
+# Starts N peers on localhost with routing off, so every message has to be
+# disseminated, links each one to D random others and sends M messages between
+# random pairs, unreliably so that retransmissions do not hide what the
+# dissemination missed. Packets include the ACKs, which spread the same way,
+# and with push-pull the digests exchanged until the repairs are done.
+
+import contextlib
+import io
+import random
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+
+REPAIR_TIME = 2.0  # seconds given to anti-entropy after the last message
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_mesh(peers, degree, rng):
+    # a ring keeps the mesh connected, random links bring every peer up to `degree`
+    n = len(peers)
+    links = {(i, (i + 1) % n) for i in range(n)}
+    for i in range(n):
+        candidates = [j for j in range(n) if j != i]
+        rng.shuffle(candidates)
+        for j in candidates[: max(0, degree - 2)]:
+            links.add((min(i, j), max(i, j)))
+    for i, j in links:
+        peers[i].connect_to_peer("127.0.0.1", peers[j].port)
+    time.sleep(0.5)
+
+
+def packets(peers):
+    return sum(peer.packets_sent for peer in peers)
+
+
+def settle(peers):
+    # wait until the last disseminated copies were handled
+    last = -1
+    while last != packets(peers):
+        last = packets(peers)
+        time.sleep(0.05)
+
+
+def run(n, degree, messages, options, seed):
+    rng = random.Random(seed)
+    # heartbeats would be counted as packets of the deliveries, keep them out of the way
+    peers = [Peer("127.0.0.1", free_udp_port(), routing=False, reliable=False, heartbeat_interval=3600,
+                  **options) for _ in range(n)]
+    build_mesh(peers, degree, rng)
+    settle(peers)
+    start = packets(peers)
+    for _ in range(messages):
+        source, destination = rng.sample(peers, 2)
+        source.broadcast_message("gossip benchmark", destination.peer_id)
+        time.sleep(0.005)
+    settle(peers)
+    if options.get("push_pull"):
+        time.sleep(REPAIR_TIME)
+        settle(peers)
+    delivered = sum(peer.messages_received for peer in peers)
+    repaired = sum(peer.repaired for peer in peers)
+    return delivered, (packets(peers) - start) / messages, repaired
+
+
+def main():
+    n = int(get_option("--peers", 50))
+    degree = int(get_option("--degree", 6))
+    messages = int(get_option("--messages", 100))
+    fanouts = [int(k) for k in get_option("--fanouts", "2,3").split(",")]
+
+    modes = [("flood", {})]
+    for k in fanouts:
+        modes.append((f"gossip k={k}", {"dissemination": "gossip", "fanout": k}))
+        modes.append((f"gossip k={k} push-pull", {"dissemination": "gossip", "fanout": k, "push_pull": True}))
+
+    print(f"{n} peers, degree {degree}, {messages} messages")
+    for label, options in modes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            delivered, cost, repaired = run(n, degree, messages, options, seed=n)
+        print(f"{label:<24} delivered {delivered / messages:7.1%}   packets per message {cost:8.1f}   "
+              f"repaired {repaired}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# Overlay simulator for exercise_3 Peers: N peers on localhost ports in a
+# chosen topology, traffic injected with broadcast_message, one run per
+# routing or dissemination strategy.
+#
+# usage: python benchmarks/bench_peer_overlay.py [--peers N] [--topology line|ring|random|mesh]
+#            [--degree D] [--messages M] [--rate R] [--fanout K] [--unreliable] [--heartbeats]
+#            [--strategies routing,flood,gossip,push-pull] [--seed S] [--json]
+#
+# Topologies: line and ring chain the peers, random adds random links to a ring
+# until every peer has about D neighbors, mesh links every pair. Strategies:
+#   routing    learned reverse-path routes, flooding until a route is known
+#   flood      routing off, every message flooded
+#   gossip     routing off, every message passed to K random neighbors
+#   push-pull  gossip plus anti-entropy digests
+# M messages between random pairs are sent at R messages/s, each carrying its
+# send time. Reported per strategy: delivery ratio, end-to-end latency, packets
+# per delivery (every packet sent while the traffic ran, ACKs, retransmissions
+# and digests included) and CPU per node, which is the CPU time of the process
+# running all N peers divided by N. Heartbeats are kept out of the way unless
+# --heartbeats is given. Every strategy runs in a process of its own. --json
+# prints one JSON object per strategy instead of the table.
+
+import contextlib
+import io
+import json
+import random
+import socket
+import sys
+import time
+from multiprocessing import Pipe, Process
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+
+STRATEGIES = {
+    "routing": {"routing": True},
+    "flood": {"routing": False},
+    "gossip": {"routing": False, "dissemination": "gossip"},
+    "push-pull": {"routing": False, "dissemination": "gossip", "push_pull": True},
+}
+TOPOLOGIES = ("line", "ring", "random", "mesh")
+MAX_SETTLE = 30  # seconds waited at most for retransmissions and repairs after the last message
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SimPeer(Peer):
+    # records when each benchmark message arrives instead of printing it
+
+    def __init__(self, *args, arrivals, **options):
+        self.arrivals = arrivals  # shared by all peers: (message number, latency in ns)
+        super().__init__(*args, **options)
+
+    def on_message(self, message):
+        number, _, sent_at = message.text_message.partition(":")
+        if sent_at.isdigit():
+            self.arrivals.append((int(number), time.monotonic_ns() - int(sent_at)))
+
+    def on_ack(self, message, addr):
+        pass
+
+
+def topology_links(topology, n, degree, rng):
+    if topology == "line":
+        return {(i, i + 1) for i in range(n - 1)}
+    if topology == "ring":
+        return {(i, (i + 1) % n) for i in range(n)}
+    if topology == "mesh":
+        return {(i, j) for i in range(n) for j in range(i + 1, n)}
+    # random: a ring keeps the graph connected, random links bring every peer up to about `degree`
+    links = {(min(i, (i + 1) % n), max(i, (i + 1) % n)) for i in range(n)}
+    for i in range(n):
+        candidates = [j for j in range(n) if j != i]
+        rng.shuffle(candidates)
+        for j in candidates[: max(0, degree - 2)]:
+            links.add((min(i, j), max(i, j)))
+    return links
+
+
+def packets(peers):
+    return sum(peer.packets_sent for peer in peers)
+
+
+def settle(peers, arrivals, expected):
+    # until every message arrived, or nothing was sent and nothing is waiting for an ACK for a while
+    deadline = time.time() + MAX_SETTLE
+    quiet_since, last = time.time(), -1
+    while time.time() < deadline:
+        if len({number for number, _ in arrivals}) >= expected:
+            return
+        sent = packets(peers)
+        if sent != last:
+            quiet_since, last = time.time(), sent
+        unacked = sum(peer.stats()["unacked"] for peer in peers)
+        if not unacked and time.time() - quiet_since > 1.0:
+            return
+        time.sleep(0.05)
+
+
+def simulate(config, strategy, conn):
+    # body of the process running one strategy, sends its result back over conn
+    rng = random.Random(config["seed"])
+    options = dict(STRATEGIES[strategy], reliable=config["reliable"])
+    if options.get("dissemination") == "gossip":
+        options["fanout"] = config["fanout"]
+    if not config["heartbeats"]:
+        # heartbeats would be counted as packets of the deliveries
+        options["heartbeat_interval"] = 3600
+    arrivals = []
+    n = config["peers"]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        peers = [SimPeer("127.0.0.1", free_udp_port(), arrivals=arrivals, **options) for _ in range(n)]
+        links = topology_links(config["topology"], n, config["degree"], rng)
+        for i, j in links:
+            peers[i].connect_to_peer("127.0.0.1", peers[j].port)
+        time.sleep(0.5)
+
+        messages = config["messages"]
+        start_packets = packets(peers)
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        for number in range(messages):
+            source, destination = rng.sample(peers, 2)
+            source.broadcast_message(f"{number}:{time.monotonic_ns()}", destination.peer_id)
+            # paced against the start, so a slow send does not lower the overall rate
+            delay = start + (number + 1) / config["rate"] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        settle(peers, arrivals, messages)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        sent = packets(peers) - start_packets
+
+    delivered = {}
+    for number, latency in list(arrivals):
+        delivered.setdefault(number, latency)  # the first arrival counts
+    latencies = sorted(delivered.values())
+    stats = [peer.stats() for peer in peers]
+    conn.send({
+        "strategy": strategy,
+        "topology": config["topology"],
+        "peers": n,
+        "links": len(links),
+        "messages": messages,
+        "delivered": len(delivered),
+        "delivery_ratio": len(delivered) / messages,
+        "duplicates": len(arrivals) - len(delivered),
+        "latency_ms": {name: percentile(latencies, q) / 1e6 if latencies else None
+                       for name, q in (("p50", 0.5), ("p99", 0.99), ("max", 1.0))},
+        "packets": sent,
+        "packets_per_delivery": sent / len(delivered) if delivered else None,
+        "cpu_ms_per_node": cpu * 1000 / n,
+        "cpu_us_per_delivery": cpu * 1e6 / len(delivered) if delivered else None,
+        "seconds": elapsed,
+        "retransmissions": sum(s["retransmissions"] for s in stats),
+        "hop_limit_dropped": sum(s["hop_limit_dropped"] for s in stats),
+    })
+
+
+def run(config, strategy):
+    parent, child = Pipe()
+    process = Process(target=simulate, args=(config, strategy, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def main():
+    config = {
+        "peers": int(get_option("--peers", 30)),
+        "topology": get_option("--topology", "random"),
+        "degree": int(get_option("--degree", 4)),
+        "messages": int(get_option("--messages", 200)),
+        "rate": float(get_option("--rate", 100)),
+        "fanout": int(get_option("--fanout", 3)),
+        "reliable": "--unreliable" not in argv,
+        "heartbeats": "--heartbeats" in argv,
+        "seed": int(get_option("--seed", 1)),
+    }
+    strategies = get_option("--strategies", ",".join(STRATEGIES)).split(",")
+    if config["topology"] not in TOPOLOGIES:
+        print(f"Invalid topology {config['topology']}, expected one of: {', '.join(TOPOLOGIES)}")
+        return
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            print(f"Invalid strategy {strategy}, expected one of: {', '.join(STRATEGIES)}")
+            return
+
+    as_json = "--json" in argv
+    if not as_json:
+        print(f"{config['peers']} peers, {config['topology']} topology, {config['messages']} messages "
+              f"at {config['rate']:g}/s, {'reliable' if config['reliable'] else 'unreliable'}")
+    for strategy in strategies:
+        result = run(config, strategy)
+        if as_json:
+            print(json.dumps(result), flush=True)
+            continue
+        latency = result["latency_ms"]
+        latency = (f"p50 {latency['p50']:7.2f} ms  p99 {latency['p99']:8.2f} ms"
+                   if latency["p50"] is not None else "no deliveries")
+        per_delivery = result["packets_per_delivery"]
+        print(f"{strategy:<10} delivered {result['delivery_ratio']:7.1%}   {latency}   "
+              f"packets/delivery {per_delivery if per_delivery is not None else float('nan'):8.1f}   "
+              f"cpu/node {result['cpu_ms_per_node']:7.1f} ms", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Packets spent per delivery by exercise_3 Peers, flooding against learned
+# reverse-path routes.
+#
+# usage: python benchmarks/bench_peer_routing.py [--peers N] [--degree D] [--pairs P]
+#
+# Starts N peers on localhost, links each one to D random others (D = N - 1
+# gives a full mesh) and lets P random pairs exchange a message and its ACK
+# twice: the first exchange finds no routes, the second one can use the routes
+# learned from the first.
+
+import contextlib
+import io
+import random
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_mesh(peers, degree, rng):
+    # a ring keeps the mesh connected, random links bring every peer up to `degree`
+    n = len(peers)
+    links = {(i, (i + 1) % n) for i in range(n)}
+    for i in range(n):
+        candidates = [j for j in range(n) if j != i]
+        rng.shuffle(candidates)
+        for j in candidates[: max(0, degree - 2)]:
+            links.add((min(i, j), max(i, j)))
+    for i, j in links:
+        peers[i].connect_to_peer("127.0.0.1", peers[j].port)
+    time.sleep(0.5)
+    return len(links)
+
+
+def packets(peers):
+    return sum(peer.packets_sent for peer in peers)
+
+
+def settle(peers):
+    # wait until the last flooded copies were handled
+    last = -1
+    while last != packets(peers):
+        last = packets(peers)
+        time.sleep(0.05)
+
+
+def exchange(peers, pairs):
+    # every pair sends one message and waits for its ACK, returns packets per delivery
+    start = packets(peers)
+    for source, destination in pairs:
+        acks = source.acks_received
+        source.broadcast_message("routing benchmark", destination.peer_id)
+        deadline = time.time() + 5
+        while source.acks_received == acks and time.time() < deadline:
+            time.sleep(0.001)
+        settle(peers)
+    return (packets(peers) - start) / len(pairs)
+
+
+def run(n, degree, pairs, routing, seed):
+    rng = random.Random(seed)
+    # heartbeats would be counted as packets of the deliveries, keep them out of the way
+    peers = [Peer("127.0.0.1", free_udp_port(), routing=routing, heartbeat_interval=3600) for _ in range(n)]
+    links = build_mesh(peers, degree, rng)
+    chosen = [tuple(rng.sample(peers, 2)) for _ in range(pairs)]
+    cold = exchange(peers, chosen)
+    warm = exchange(peers, chosen)
+    delivered = sum(peer.messages_received for peer in peers)
+    return links, cold, warm, delivered
+
+
+def main():
+    n = int(get_option("--peers", 50))
+    degree = int(get_option("--degree", 4))
+    pairs = int(get_option("--pairs", 20))
+
+    print(f"{n} peers, degree {degree}, {pairs} pairs, packets per delivery (message + ACK)")
+    for routing in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            links, cold, warm, delivered = run(n, degree, pairs, routing, seed=n)
+        label = "learned routes" if routing else "flooding"
+        print(f"{label:<16} {links:5d} links   first exchange {cold:8.1f}   "
+              f"second exchange {warm:8.1f}   delivered {delivered}/{2 * pairs}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+# Load generator for the exercise_1 and exercise_2 relay servers: thousands of
+# simulated clients spread over a few processes, driving configurable traffic
+# through the real handshakes and reporting throughput and relay latency.
+#
+# usage: python benchmarks/bench_relay_load.py [--exercise 1|2] [--clients N] [--processes P]
+#            [--traffic uniform|hotspot|offline] [--duration S] [--rate R] [--size B]
+#            [--hot-clients H] [--hot-share F] [--offline-clients O] [--offline-share F]
+#            [--port PORT | --server-args "--asyncio ..."] [--output results.jsonl]
+#
+# Every client runs the handshake of its exercise (FastHandshake, or Handshake
+# with change_id so that every process knows the receiver ids up front), then
+# sends messages for S seconds: R messages/s in total spread over all clients,
+# or as fast as the server takes them with --rate 0. Receivers are picked
+#   uniform  among all connected clients
+#   hotspot  among the first H clients for a share F of the messages
+#   offline  among O ids that never connect for a share F of the messages; on
+#            exercise_2 they connect afterwards and their backlog replay is timed,
+#            exercise_1 drops them
+# Every message carries its send time, so receivers measure the relay latency.
+# The server is started on a free port unless --port points at a running one.
+# With --output the results are appended to a JSON lines file, one run per line.
+# Load processes and the server share the machine's cores, so give the server
+# some of them to yourself when comparing numbers.
+
+import asyncio
+import datetime
+import json
+import os
+import random
+import shlex
+import time
+from multiprocessing import Pipe, Process
+from sys import argv
+
+import common
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+EXERCISE = int(get_option("--exercise", 2))
+pb2 = common.load_pb2(EXERCISE)
+ID_BASE = 1_000_000  # exercise_2 clients ask for ids from here on
+OFFLINE_BASE = 1_000_000_000  # ids that never connect during the run
+CONNECT_CONCURRENCY = 64  # handshakes in flight per load process
+QUIET = 0.5  # seconds without arrivals after which the run is considered drained
+MAX_DRAIN = 10  # seconds waited at most for messages still in flight
+
+
+def cpu_seconds(pid):
+    # utime + stime of a running process, read from /proc
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Receivers:
+    # picks the receiver of every message according to the traffic pattern
+
+    def __init__(self, config, ids, offline_ids):
+        self.traffic = config["traffic"]
+        self.ids = ids
+        self.hot = ids[:config["hot_clients"]]
+        self.hot_share = config["hot_share"]
+        self.offline = offline_ids
+        self.offline_share = config["offline_share"]
+
+    def pick(self, rng):
+        # (receiver id, True if the receiver is offline)
+        if self.traffic == "hotspot" and rng.random() < self.hot_share:
+            return rng.choice(self.hot), False
+        if self.traffic == "offline" and rng.random() < self.offline_share:
+            return rng.choice(self.offline), True
+        return rng.choice(self.ids), False
+
+
+async def connect(port, count, first_id):
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def open_one(index):
+        async with semaphore:
+            desired_id = first_id + index if EXERCISE == 2 else None
+            return await asyncio.wait_for(common.open_client(EXERCISE, pb2, port, desired_id), 30)
+
+    return await asyncio.gather(*(open_one(index) for index in range(count)))
+
+
+async def drive(port, conn, count, first_id, config, seed):
+    # body of a load process: connect, report the ids, wait for the go, send and receive
+    common.raise_fd_limit()
+    start = time.perf_counter()
+    clients = await connect(port, count, first_id)
+    connect_seconds = time.perf_counter() - start
+    conn.send([id for _, _, id in clients])
+    ids, offline_ids, stop_at = conn.recv()
+
+    receivers = Receivers(config, ids, offline_ids)
+    padding = "x" * max(0, config["size"] - 20)
+    # every client sends at the same pace, the total rate split evenly between them
+    interval = len(ids) / config["rate"] if config["rate"] else 0
+    stats = {"sent": 0, "sent_offline": 0, "received": 0, "errors": 0}
+    latencies = []
+    last_arrival = [time.monotonic()]
+
+    async def send(client, rng):
+        _, writer, id = client
+        next_send = time.monotonic() + rng.random() * interval
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= stop_at:
+                    break
+                if interval:
+                    if next_send > now:
+                        await asyncio.sleep(next_send - now)
+                    next_send += interval
+                to, offline = receivers.pick(rng)
+                message = pb2.Message(fr=id, to=to, msg=f"{time.monotonic_ns()}:{padding}")
+                writer.write(common.encode_frame(message))
+                stats["sent"] += 1
+                stats["sent_offline"] += offline
+                await writer.drain()
+                if not interval:
+                    await asyncio.sleep(0)  # let the other clients and the readers run
+        except (ConnectionError, OSError):
+            stats["errors"] += 1
+
+    async def receive(client):
+        reader = client[0]
+        try:
+            while True:
+                data = await common.read_frame(reader)
+                now = time.monotonic_ns()
+                message = pb2.Message.FromString(data)
+                sent_at = message.msg.partition(":")[0]
+                if sent_at.isdigit():
+                    latencies.append(now - int(sent_at))
+                stats["received"] += 1
+                last_arrival[0] = time.monotonic()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+
+    rng = random.Random(seed)
+    readers = [asyncio.create_task(receive(client)) for client in clients]
+    await asyncio.gather(*(send(client, random.Random(rng.random())) for client in clients))
+
+    # messages still in flight arrive until the server has nothing left for us
+    drained_by = time.monotonic() + MAX_DRAIN
+    while time.monotonic() - last_arrival[0] < QUIET and time.monotonic() < drained_by:
+        await asyncio.sleep(0.05)
+    for reader in readers:
+        reader.cancel()
+    for _, writer, _ in clients:
+        writer.close()
+    stats["connect_seconds"] = connect_seconds
+    conn.send((stats, latencies))
+
+
+def load_process(port, conn, count, first_id, config, seed):
+    asyncio.run(drive(port, conn, count, first_id, config, seed))
+
+
+async def replay_offline(port, offline_ids):
+    # connects the offline receivers and times how long their backlogs take to arrive
+    received = 0
+    start = time.perf_counter()
+    clients = await connect(port, len(offline_ids), offline_ids[0])
+    last = time.perf_counter()
+
+    async def drain(reader):
+        nonlocal received, last
+        while True:
+            await common.read_frame(reader)
+            received += 1
+            last = time.perf_counter()
+
+    tasks = [asyncio.create_task(drain(reader)) for reader, _, _ in clients]
+    while time.perf_counter() - last < QUIET:
+        await asyncio.sleep(0.05)
+    for task in tasks:
+        task.cancel()
+    for _, writer, _ in clients:
+        writer.close()
+    return received, last - start
+
+
+def run(port, config, proc=None):
+    processes = config["processes"]
+    shares = [config["clients"] // processes + (index < config["clients"] % processes)
+              for index in range(processes)]
+    first_ids = [ID_BASE + sum(shares[:index]) for index in range(processes)]
+    pipes = [Pipe() for _ in range(processes)]
+    workers = [Process(target=load_process, args=(port, child, share, first_id, config, config["seed"] + index))
+               for index, ((_, child), share, first_id) in enumerate(zip(pipes, shares, first_ids))]
+    for worker in workers:
+        worker.start()
+
+    ids = [id for parent, _ in pipes for id in parent.recv()]
+    status = {}
+    if proc:
+        # what the connections cost the server, sampled while all of them are open
+        status["server_rss_kb"], status["server_threads"] = common.process_status(proc.pid)
+    if EXERCISE == 2:
+        offline_ids = list(range(ID_BASE + config["clients"], ID_BASE + config["clients"] + config["offline_clients"]))
+    else:
+        offline_ids = list(range(OFFLINE_BASE, OFFLINE_BASE + config["offline_clients"]))
+    stop_at = time.monotonic() + config["duration"]
+    for parent, _ in pipes:
+        parent.send((ids, offline_ids, stop_at))
+
+    results = [parent.recv() for parent, _ in pipes]
+    for worker in workers:
+        worker.join()
+
+    totals = {key: sum(stats[key] for stats, _ in results) for key in ("sent", "sent_offline", "received", "errors")}
+    latencies = sorted(latency for _, process_latencies in results for latency in process_latencies)
+    online = totals["sent"] - totals["sent_offline"]
+    result = {
+        **totals,
+        **status,
+        "delivery_ratio": totals["received"] / online if online else None,
+        "sent_per_sec": totals["sent"] / config["duration"],
+        "msgs_per_sec": totals["received"] / config["duration"],
+        "connect_seconds": max(stats["connect_seconds"] for stats, _ in results),
+        "latency_ms": {name: percentile(latencies, q) / 1e6 if latencies else None
+                       for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999), ("max", 1.0))},
+    }
+    if config["traffic"] == "offline" and EXERCISE == 2 and totals["sent_offline"]:
+        replayed, seconds = asyncio.run(replay_offline(port, offline_ids))
+        result["replayed"] = replayed
+        result["replay_seconds"] = seconds
+    return result
+
+
+def main():
+    config = {
+        "exercise": EXERCISE,
+        "clients": int(get_option("--clients", 1000)),
+        "processes": int(get_option("--processes", 2)),
+        "traffic": get_option("--traffic", "uniform"),
+        "duration": float(get_option("--duration", 10)),
+        "rate": float(get_option("--rate", 5000)),
+        "size": int(get_option("--size", 64)),
+        "hot_clients": int(get_option("--hot-clients", 10)),
+        "hot_share": float(get_option("--hot-share", 0.5)),
+        "offline_clients": int(get_option("--offline-clients", 100)),
+        "offline_share": float(get_option("--offline-share", 0.2)),
+        "server_args": get_option("--server-args", ""),
+        "seed": int(get_option("--seed", 1)),
+    }
+    if config["traffic"] not in ("uniform", "hotspot", "offline"):
+        print(f"Invalid traffic {config['traffic']}, expected one of: uniform, hotspot, offline")
+        return
+    common.raise_fd_limit()
+
+    port = get_option("--port", None)
+    proc = None
+    if port is None:
+        port = common.free_port()
+        proc = common.start_server(EXERCISE, port, *shlex.split(config["server_args"]))
+    port = int(port)
+    try:
+        cpu = cpu_seconds(proc.pid) if proc else None
+        result = run(port, config, proc)
+        if proc:
+            result["server_cpu_seconds"] = cpu_seconds(proc.pid) - cpu
+    finally:
+        if proc:
+            common.stop_server(proc)
+
+    latency = result["latency_ms"]
+    rate = f"{config['rate']:g} msg/s" if config["rate"] else "the highest rate"
+    print(f"exercise_{EXERCISE} {config['server_args'] or 'threaded'}, {config['clients']} clients in "
+          f"{config['processes']} processes, {config['traffic']} traffic, {config['duration']:g}s at {rate}")
+    print(f"  connected in {result['connect_seconds']:.2f}s")
+    print(f"  sent {result['sent']} ({result['sent_per_sec']:.0f}/s, {result['sent_offline']} to offline ids), "
+          f"received {result['received']} ({result['msgs_per_sec']:.0f}/s), errors {result['errors']}")
+    if result["delivery_ratio"] is not None:
+        print(f"  delivered {result['delivery_ratio']:.2%} of the messages to online clients")
+    if latency["p50"] is not None:
+        print(f"  latency p50 {latency['p50']:.2f} ms   p99 {latency['p99']:.2f} ms   "
+              f"p999 {latency['p999']:.2f} ms   max {latency['max']:.2f} ms")
+    if "replayed" in result:
+        print(f"  replayed {result['replayed']} stored messages in {result['replay_seconds']:.2f}s")
+    if "server_cpu_seconds" in result:
+        print(f"  server cpu {result['server_cpu_seconds']:.2f}s, rss {result['server_rss_kb'] / 1024:.0f} MiB, "
+              f"{result['server_threads']} threads")
+
+    output = get_option("--output", None)
+    if output:
+        with open(output, "a") as f:
+            f.write(json.dumps({"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                                "config": config, "result": result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Compare the threaded and the asyncio server modes.
+#
+# usage: python benchmarks/bench_server_modes.py [--exercise 1|2] [--connections N]
+#                                                [--pairs P] [--messages M]
+#
+# For each mode it reports how many idle connections the server accepted and
+# what they cost (RSS, OS threads), then the relay throughput of P sender ->
+# receiver pairs each pushing M messages.
+
+import asyncio
+import time
+from sys import argv
+
+import common
+
+
+def get_option(name, default):
+    if name in argv:
+        return int(argv[argv.index(name) + 1])
+    return default
+
+
+async def connection_capacity(exercise, pb2, port, proc, connections):
+    clients = []
+    rss_before, _ = common.process_status(proc.pid)
+    start = time.perf_counter()
+    try:
+        for _ in range(connections):
+            clients.append(await asyncio.wait_for(common.open_client(exercise, pb2, port), 5))
+    except Exception as e:
+        print(f"  stopped after {len(clients)} connections: {e!r}")
+    elapsed = time.perf_counter() - start
+    rss_after, threads = common.process_status(proc.pid)
+
+    print(f"  connections:      {len(clients)} in {elapsed:.2f}s ({len(clients) / elapsed:.0f} conn/s)")
+    print(f"  server RSS:       {rss_after / 1024:.1f} MiB "
+          f"(+{(rss_after - rss_before) / max(len(clients), 1):.1f} KiB per connection)")
+    print(f"  server threads:   {threads}")
+
+    for _, writer, _ in clients:
+        writer.close()
+    await asyncio.sleep(0.5)
+
+
+async def relay_throughput(exercise, pb2, port, pairs, messages):
+    senders = [await common.open_client(exercise, pb2, port) for _ in range(pairs)]
+    receivers = [await common.open_client(exercise, pb2, port) for _ in range(pairs)]
+
+    async def send(client, to):
+        _, writer, id = client
+        frame = common.encode_frame(pb2.Message(fr=id, to=to, msg="x" * 32))
+        for _ in range(messages):
+            writer.write(frame)
+            await writer.drain()
+
+    async def receive(client):
+        reader = client[0]
+        for _ in range(messages):
+            await common.read_frame(reader)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(send(s, r[2]) for s, r in zip(senders, receivers)),
+        *(receive(r) for r in receivers),
+    )
+    elapsed = time.perf_counter() - start
+    total = pairs * messages
+    print(f"  relayed:          {total} messages in {elapsed:.2f}s ({total / elapsed:.0f} msg/s)")
+
+    for _, writer, _ in senders + receivers:
+        writer.close()
+
+
+def run_mode(exercise, pb2, mode_args, connections, pairs, messages):
+    port = common.free_port()
+    proc = common.start_server(exercise, port, *mode_args)
+    try:
+        asyncio.run(connection_capacity(exercise, pb2, port, proc, connections))
+        asyncio.run(relay_throughput(exercise, pb2, port, pairs, messages))
+    finally:
+        common.stop_server(proc)
+
+
+def main():
+    exercise = get_option("--exercise", 2)
+    connections = get_option("--connections", 2000)
+    pairs = get_option("--pairs", 20)
+    messages = get_option("--messages", 2000)
+
+    common.raise_fd_limit()
+    pb2 = common.load_pb2(exercise)
+
+    for name, mode_args in (("threaded", ()), ("asyncio", ("--asyncio",))):
+        print(f"exercise_{exercise} server, {name} mode")
+        run_mode(exercise, pb2, mode_args, connections, pairs, messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Ids per second from exercise_3 snowflake generators.
+#
+# usage: python benchmarks/bench_snowflake.py [--ids N] [--threads T]
+#
+# One assigner gets at most 512 ids per 10 ms tick, 51200 per second, so a
+# single generator is measured against that ceiling, and many assigners show
+# the cost of generating an id without it. Batches reserve up to a whole tick
+# under one lock acquisition.
+
+import sys
+import threading
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+import snowflake
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def rate(label, n, work, threads=1):
+    per_thread = n // threads
+    workers = [threading.Thread(target=work, args=(index, per_thread)) for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {per_thread * threads / elapsed:12,.0f} ids/s")
+
+
+def main():
+    n = int(get_option("--ids", 200_000))
+    threads = int(get_option("--threads", 8))
+    ceiling = (snowflake.MAX_SEQUENCE + 1) * 100
+    print(f"{n} ids, one assigner is capped at {ceiling:,} ids/s")
+
+    def module_calls(index, count):
+        for _ in range(count):
+            snowflake.derive_id(1)
+
+    def one_generator(index, count):
+        ids = snowflake.generator(2)
+        for _ in range(count):
+            ids.derive_id()
+
+    def batches(index, count):
+        ids = snowflake.generator(3)
+        for _ in range(count // 512):
+            ids.derive_ids(512)
+
+    def many_assigners(index, count):
+        ids = [snowflake.generator(10_000_000 + index * 1000 + i) for i in range(1000)]
+        for i in range(count):
+            ids[i % 1000].derive_id()
+
+    rate("derive_id(assigner)", n, module_calls)
+    rate("IdGenerator.derive_id()", n, one_generator)
+    rate("IdGenerator.derive_id(), 1000 assigners", n, many_assigners)
+    rate(f"IdGenerator.derive_id(), {threads} threads", n, one_generator, threads)
+    rate("IdGenerator.derive_ids(512)", n, batches)
+    rate(f"IdGenerator.derive_ids(512), {threads} threads", n, batches, threads)
+
+
+if __name__ == "__main__":
+    main()
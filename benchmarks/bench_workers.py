@@ -0,0 +1,100 @@
+# Relay throughput of the exercise_2 server with 1, 2, 4 and 8 worker processes.
+#
+# usage: python benchmarks/bench_workers.py [--processes P] [--pairs K] [--messages M] [--workers 1,2,4,8]
+#
+# P load processes each open K sender -> receiver pairs and push M messages per
+# pair. With several workers the pairs land on random workers, so most traffic
+# crosses a worker link. Every receiver checks that its messages arrived, in the
+# order they were sent. Only useful on a machine with enough cores.
+
+import asyncio
+import sys
+import time
+from multiprocessing import Pool
+from sys import argv
+
+import common
+
+pb2 = common.load_pb2(2)
+
+
+READ_TIMEOUT = 10  # seconds without a message before a receiver gives up on the rest
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+async def drive(port, pairs, messages):
+    senders = [await common.open_client(2, pb2, port) for _ in range(pairs)]
+    receivers = [await common.open_client(2, pb2, port) for _ in range(pairs)]
+    await asyncio.sleep(0.5)  # let the workers learn where every client lives
+
+    async def send(client, to):
+        _, writer, id = client
+        for i in range(messages):
+            writer.write(common.encode_frame(pb2.Message(fr=id, to=to, msg=f"{i:08d}" + "x" * 24)))
+            if i % 100 == 0:
+                await writer.drain()
+        await writer.drain()
+
+    async def receive(client):
+        # (messages received, messages out of order)
+        received = out_of_order = 0
+        try:
+            while received < messages:
+                frame = await asyncio.wait_for(common.read_frame(client[0]), READ_TIMEOUT)
+                out_of_order += int(pb2.Message.FromString(frame).msg[:8]) != received
+                received += 1
+        except asyncio.TimeoutError:
+            pass
+        return received, out_of_order
+
+    start = time.time()
+    results = await asyncio.gather(*(send(s, r[2]) for s, r in zip(senders, receivers)),
+                                   *(receive(r) for r in receivers))
+    end = time.time()
+    for _, writer, _ in senders + receivers:
+        writer.close()
+    received = sum(result[0] for result in results[pairs:])
+    out_of_order = sum(result[1] for result in results[pairs:])
+    return start, end, pairs * messages, received, out_of_order
+
+
+def load_process(args):
+    return asyncio.run(drive(*args))
+
+
+def main():
+    processes = int(get_option("--processes", 4))
+    pairs = int(get_option("--pairs", 10))
+    messages = int(get_option("--messages", 2000))
+    common.raise_fd_limit()
+
+    failed = False
+    for workers in map(int, get_option("--workers", "1,2,4,8").split(",")):
+        port = common.free_port()
+        proc = common.start_server(2, port, "--workers", str(workers))
+        time.sleep(0.5)
+        try:
+            with Pool(processes) as pool:
+                results = pool.map(load_process, [(port, pairs, messages)] * processes)
+        finally:
+            common.stop_server(proc)
+        start = min(r[0] for r in results)
+        end = max(r[1] for r in results)
+        total = sum(r[2] for r in results)
+        received = sum(r[3] for r in results)
+        out_of_order = sum(r[4] for r in results)
+        ok = received == total and not out_of_order
+        failed |= not ok
+        print(f"{workers} worker(s): {total} messages in {end - start:.2f}s ({total / (end - start):.0f} msg/s), "
+              f"{received} received, {out_of_order} out of order   {'ok' if ok else 'FAILED'}", flush=True)
+        time.sleep(1.5)  # workers notice the console process is gone
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
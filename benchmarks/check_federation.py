@@ -0,0 +1,80 @@
+# Runs three exercise_2 servers on localhost as one federation and checks that
+# clients on different nodes reach each other, that offline messages are kept
+# on the receiver's home node, and that desired and default ids are unique
+# network-wide.
+#
+# usage: python benchmarks/check_federation.py
+
+import asyncio
+import subprocess
+import sys
+import time
+
+import common
+
+pb2 = common.load_pb2(2)
+NODES = 3
+
+
+def start_node(ports, federation, node):
+    return subprocess.Popen(
+        [sys.executable, "server.py", str(ports[node]), "--nodes", federation, "--node", str(node)],
+        cwd=common.exercise_dir(2),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def receive_text(client):
+    return pb2.Message.FromString(await asyncio.wait_for(common.read_frame(client[0]), 5)).msg
+
+
+async def send_text(client, to, text):
+    client[1].write(common.encode_frame(pb2.Message(fr=client[2], to=to, msg=text)))
+    await client[1].drain()
+
+
+async def check(ports):
+    alice = await common.open_client(2, pb2, ports[0], desired_id=100)
+    bob = await common.open_client(2, pb2, ports[1], desired_id=200)
+    await asyncio.sleep(0.5)
+
+    await send_text(alice, 200, "hello from node 0")
+    assert await receive_text(bob) == "hello from node 0"
+    print("ok  message forwarded to the receiver's node")
+
+    # 302 is offline, its home node is 302 % 3 = 2
+    for i in range(3):
+        await send_text(alice, 302, f"stored {i}")
+    await asyncio.sleep(0.5)
+    carol = await common.open_client(2, pb2, ports[1], desired_id=302)
+    assert [await receive_text(carol) for _ in range(3)] == ["stored 0", "stored 1", "stored 2"]
+    print("ok  backlog kept on the home node and replayed on another node")
+
+    other = await common.open_client(2, pb2, ports[2], desired_id=200)
+    assert other[2] != 200
+    print("ok  desired id already taken on another node is refused")
+
+    # node 0 hands out 0, 3, 6, ... by default, claim the next ones as desired ids on node 1
+    claimed = [await common.open_client(2, pb2, ports[1], desired_id=id) for id in range(3, 33, 3)]
+    await asyncio.sleep(0.5)
+    fresh = await common.open_client(2, pb2, ports[0])
+    assert fresh[2] not in {client[2] for client in claimed}, fresh[2]
+    print("ok  default ids skip desired ids claimed on another node")
+
+
+def main():
+    ports = [common.free_port() for _ in range(NODES)]
+    federation = ",".join(f"127.0.0.1:{common.free_port()}" for _ in range(NODES))
+    procs = [start_node(ports, federation, node) for node in range(NODES)]
+    try:
+        time.sleep(1.5)
+        asyncio.run(check(ports))
+    finally:
+        for proc in procs:
+            common.stop_server(proc)
+
+
+if __name__ == "__main__":
+    main()
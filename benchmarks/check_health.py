@@ -0,0 +1,303 @@
+# Checks connection health and admission control of exercise_1 and
+# exercise_2, threaded and asyncio, against real servers.
+#
+# usage: python benchmarks/check_health.py [--exercise 1|2] [--server-args "--asyncio ..."]
+#            [--messages N]
+#
+# - heartbeat     a client that sent one heartbeat and went silent is closed
+#                 within HEARTBEAT_MISSES intervals (the servers run with
+#                 --heartbeat 0.5); one that keeps sending them stays
+# - idle          without heartbeats a silent client stays, unless the server
+#                 has --idle-timeout
+# - handshake     exercise_2 closes a connection that sends no Handshake
+# - reroute       exercise_2: a receiver goes silent while N messages of 16 KiB
+#                 are sent to it, it is closed and reconnects with its id;
+#                 every message must have reached either the dead connection's
+#                 socket buffers or the replay to the new one
+# - admission     --max-connections refuses connections beyond the limit with
+#                 an error handshake and admits new ones once others closed;
+#                 --accept-rate spreads a burst out instead of refusing it
+
+import asyncio
+import shlex
+import socket
+import time
+import urllib.request
+from sys import argv
+
+import common
+
+HEARTBEAT = 0.5
+MISSES = 3  # health.HEARTBEAT_MISSES
+REAP_INTERVAL = 0.5  # health.REAP_INTERVAL
+DESIRED_ID = 4242
+PAYLOAD = "x" * 16384  # large enough for the messages not to fit in the socket buffers
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def metric(metrics_port, name):
+    # value of one sample, name with its labels as in the exposition
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith(name + " "):
+                return float(line.split()[1])
+    return 0.0
+
+
+async def connect(exercise, pb2, port, desired_id=None, handshake=True):
+    # (reader, writer, handshake reply) of a client that never sends heartbeats on its own
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if not handshake:
+        return reader, writer, None
+    if exercise == 1:
+        reply = pb2.FastHandshake()
+    else:
+        if desired_id is None:
+            request = pb2.Handshake(change_id=False)
+        else:
+            request = pb2.Handshake(id=desired_id, change_id=True)
+        writer.write(common.encode_frame(request))
+        reply = pb2.Handshake()
+    reply.ParseFromString(await common.read_frame(reader))
+    return reader, writer, reply
+
+
+def heartbeat(writer):
+    writer.write(b"\x00\x00\x00\x00")
+
+
+async def closed_after(reader, limit):
+    # seconds until the server closed the connection, None if it did not within limit
+    start = time.perf_counter()
+    try:
+        while await asyncio.wait_for(reader.read(65536), limit - (time.perf_counter() - start)):
+            pass
+    except (asyncio.TimeoutError, ValueError):
+        return None
+    except OSError:
+        pass
+    return time.perf_counter() - start
+
+
+class Server:
+
+    def __init__(self, exercise, *args):
+        self.port = common.free_port()
+        self.metrics_port = common.free_port()
+        self.proc = common.start_server(exercise, self.port, "--metrics-port", str(self.metrics_port),
+                                        "--log-level", "error", *args)
+
+    def metric(self, name):
+        return metric(self.metrics_port, name)
+
+    def stop(self):
+        common.stop_server(self.proc)
+
+
+def report(ok, name, detail):
+    print(f"  {'ok  ' if ok else 'FAIL'} {name:<10} {detail}", flush=True)
+    return ok
+
+
+async def check_heartbeat(exercise, pb2, server):
+    reader, writer, reply = await connect(exercise, pb2, server.port)
+    heartbeat(writer)
+    limit = HEARTBEAT * MISSES + REAP_INTERVAL + 1
+    seconds = await closed_after(reader, limit + 2)
+    writer.close()
+    report(reply.heartbeat_ms == HEARTBEAT * 1000 and seconds is not None and seconds <= limit, "heartbeat",
+           f"asked for one every {reply.heartbeat_ms} ms, silent client closed after "
+           f"{'never' if seconds is None else f'{seconds:.2f}s'} (limit {limit:.1f}s)")
+
+    reader, writer, _ = await connect(exercise, pb2, server.port)
+    start = time.perf_counter()
+    while time.perf_counter() - start < limit + 1:
+        heartbeat(writer)
+        if await closed_after(reader, HEARTBEAT) is not None:
+            break
+    alive = time.perf_counter() - start >= limit + 1
+    writer.close()
+    report(alive, "heartbeat", f"client sending heartbeats {'kept' if alive else 'CLOSED'} for {limit + 1:.1f}s")
+
+
+async def check_idle(exercise, pb2, server, idle_timeout):
+    reader, writer, _ = await connect(exercise, pb2, server.port)
+    limit = (idle_timeout or HEARTBEAT * MISSES) + REAP_INTERVAL + 1
+    seconds = await closed_after(reader, limit)
+    writer.close()
+    if idle_timeout:
+        report(seconds is not None, "idle", f"--idle-timeout {idle_timeout}: silent client without heartbeats "
+               f"closed after {'never' if seconds is None else f'{seconds:.2f}s'}")
+    else:
+        report(seconds is None, "idle", f"silent client without heartbeats {'kept' if seconds is None else 'CLOSED'} "
+               f"for {limit:.1f}s")
+
+
+async def check_handshake(exercise, pb2, server, handshake_timeout):
+    reader, writer, _ = await connect(exercise, pb2, server.port, handshake=False)
+    seconds = await closed_after(reader, handshake_timeout + REAP_INTERVAL + 1)
+    writer.close()
+    report(seconds is not None, "handshake", f"--handshake-timeout {handshake_timeout}: connection without a "
+           f"Handshake closed after {'never' if seconds is None else f'{seconds:.2f}s'}")
+
+
+def parse_frames(data, pb2):
+    # Messages in a stream of single Message frames, the first frame being the Handshake
+    messages = []
+    offset = 0
+    first = True
+    while offset + 4 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], byteorder="big")
+        if offset + 4 + size > len(data):
+            break
+        frame = data[offset + 4:offset + 4 + size]
+        offset += 4 + size
+        if first:
+            first = False
+            continue
+        messages.append(pb2.Message.FromString(frame))
+    return messages
+
+
+async def check_reroute(exercise, pb2, server, count):
+    # the receiver is a plain socket with a small buffer that stops reading after the handshake
+    dead = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    dead.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    dead.connect(("127.0.0.1", server.port))
+    dead.sendall(common.encode_frame(pb2.Handshake(id=DESIRED_ID, change_id=True)) + b"\x00\x00\x00\x00")
+
+    _, sender, _ = await connect(exercise, pb2, server.port)
+    for index in range(count):
+        sender.write(common.encode_frame(pb2.Message(fr=1, to=DESIRED_ID, msg=f"{index} {PAYLOAD}")))
+    sending = asyncio.ensure_future(sender.drain())
+
+    # the receiver is closed, the sender's blocked messages and the queued ones go to storage
+    timed_out = server.metric('relay_connections_timed_out_total{reason="heartbeat"}')
+    start = time.perf_counter()
+    while server.metric('relay_connections_timed_out_total{reason="heartbeat"}') == timed_out:
+        if time.perf_counter() - start > 10:
+            break
+        await asyncio.sleep(0.1)
+    detected = time.perf_counter() - start
+    await asyncio.wait_for(sending, 30)
+    previous = -1
+    while True:
+        await asyncio.sleep(0.5)
+        backlog = server.metric("relay_backlog_messages")
+        if backlog == previous:
+            break
+        previous = backlog
+
+    chunks = []
+    dead.settimeout(1)
+    try:
+        while chunk := dead.recv(1 << 20):
+            chunks.append(chunk)
+    except OSError:
+        pass
+    dead.close()
+    in_dead_buffers = parse_frames(b"".join(chunks), pb2)
+
+    reader, writer, reply = await connect(exercise, pb2, server.port, DESIRED_ID)
+    replayed = []
+    try:
+        while len(replayed) < backlog:
+            replayed.append(pb2.Message.FromString(await asyncio.wait_for(common.read_frame(reader), 5)))
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+        pass
+    writer.close()
+    sender.close()
+
+    indexes = [int(msg.msg.split(" ", 1)[0]) for msg in in_dead_buffers + replayed]
+    lost = count - len(set(indexes))
+    rerouted = server.metric("relay_messages_rerouted_total")
+    report(reply.id == DESIRED_ID and not lost, "reroute",
+           f"receiver closed after {detected:.2f}s; of {count} messages {len(in_dead_buffers)} sat in the dead "
+           f"connection's buffers, {len(replayed)} replayed after reconnecting ({rerouted:.0f} rerouted from its "
+           f"queue), {len(indexes) - len(set(indexes))} twice, {lost} lost")
+
+
+async def open_many(exercise, pb2, port, count):
+    # (clients that got in, refused, seconds) of count clients connecting at once
+    start = time.perf_counter()
+    results = await asyncio.gather(*(connect(exercise, pb2, port) for _ in range(count)), return_exceptions=True)
+    seconds = time.perf_counter() - start
+    admitted = [result for result in results if not isinstance(result, BaseException) and not result[2].error]
+    refused = [result for result in results if not isinstance(result, BaseException) and result[2].error]
+    for _, writer, _ in refused:
+        writer.close()
+    return admitted, len(refused), seconds
+
+
+async def check_max_connections(exercise, pb2, server, limit):
+    admitted, refused, _ = await open_many(exercise, pb2, server.port, limit + 10)
+    ok = len(admitted) == limit and refused == 10
+    for _, writer, _ in admitted[:5]:
+        writer.close()
+    await asyncio.sleep(0.5)
+    again, refused_again, _ = await open_many(exercise, pb2, server.port, 10)
+    ok = ok and len(again) == 5 and refused_again == 5
+    for _, writer, _ in admitted[5:] + again:
+        writer.close()
+    report(ok, "admission", f"--max-connections {limit}: {len(admitted)} of {limit + 10} admitted, {refused} refused; "
+           f"after 5 closed {len(again)} of 10 admitted")
+
+
+async def check_accept_rate(exercise, pb2, server, rate, count):
+    admitted, refused, seconds = await open_many(exercise, pb2, server.port, count)
+    expected = (count - rate) / rate
+    for _, writer, _ in admitted:
+        writer.close()
+    report(len(admitted) == count and seconds >= expected * 0.8, "admission",
+           f"--accept-rate {rate}: {count} clients at once admitted in {seconds:.2f}s "
+           f"(burst of {rate}, then {rate}/s: {expected:.2f}s), {refused} refused")
+
+
+async def check(exercise, server_args, messages):
+    pb2 = common.load_pb2(exercise)
+    mode = " ".join(server_args) or "threaded"
+    print(f"exercise_{exercise} {mode}")
+
+    server = Server(exercise, "--heartbeat", str(HEARTBEAT), *server_args)
+    try:
+        await check_heartbeat(exercise, pb2, server)
+        await check_idle(exercise, pb2, server, 0)
+        if exercise == 2:
+            await check_reroute(exercise, pb2, server, messages)
+    finally:
+        server.stop()
+
+    server = Server(exercise, "--idle-timeout", "1", "--handshake-timeout", "1", *server_args)
+    try:
+        await check_idle(exercise, pb2, server, 1)
+        if exercise == 2:
+            await check_handshake(exercise, pb2, server, 1)
+    finally:
+        server.stop()
+
+    server = Server(exercise, "--max-connections", "20", *server_args)
+    try:
+        await check_max_connections(exercise, pb2, server, 20)
+    finally:
+        server.stop()
+
+    server = Server(exercise, "--accept-rate", "100", *server_args)
+    try:
+        await check_accept_rate(exercise, pb2, server, 100, 300)
+    finally:
+        server.stop()
+
+
+def main():
+    common.raise_fd_limit()
+    exercise = int(get_option("--exercise", 2))
+    asyncio.run(check(exercise, shlex.split(get_option("--server-args", "")), int(get_option("--messages", 3000))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Failure detection of the exercise_3 Peer membership table.
+#
+# usage: python benchmarks/check_peer_membership.py [--peers N] [--interval S]
+#
+# Starts N fully connected peers with heartbeats every S seconds, stops one of
+# them, checks that every other peer evicts it, then starts it again on the
+# same port and checks that every peer takes it back.
+
+import asyncio
+import contextlib
+import io
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from async_peer import AsyncPeer
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until(condition, timeout):
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            return None
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+async def start_peer(port, interval):
+    peer = AsyncPeer("127.0.0.1", port, heartbeat_interval=interval)
+    await peer.start()
+    return peer
+
+
+async def run(n, interval):
+    peers = [await start_peer(free_udp_port(), interval) for _ in range(n)]
+    for i, peer in enumerate(peers):
+        for other in peers[i + 1:]:
+            peer.connect_to_peer("127.0.0.1", other.port)
+    await asyncio.sleep(interval * 5)  # let the detectors learn the heartbeat rhythm
+
+    victim = peers[-1]
+    victim_addr = ("127.0.0.1", victim.port)
+    others = peers[:-1]
+    false_evictions = sum(peer.peers.evictions for peer in peers)
+
+    victim.close()
+    detected = await wait_until(lambda: all(victim_addr not in peer.peers for peer in others), interval * 30)
+    table = others[0].membership()
+
+    victim = await start_peer(victim.port, interval)
+    rejoined = await wait_until(lambda: all(victim_addr in peer.peers for peer in others)
+                                and len(victim.peers) == len(others), interval * 30)
+    for peer in others + [victim]:
+        peer.close()
+    return false_evictions, detected, rejoined, table
+
+
+def main():
+    n = int(get_option("--peers", 8))
+    interval = float(get_option("--interval", 0.2))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        false_evictions, detected, rejoined, table = asyncio.run(run(n, interval))
+
+    print(f"{n} peers, heartbeat every {interval}s")
+    print(f"evictions before the failure: {false_evictions}")
+    print(f"failed peer evicted everywhere after: {'never' if detected is None else f'{detected:.2f}s'}")
+    print(f"restarted peer back everywhere after: {'never' if rejoined is None else f'{rejoined:.2f}s'}")
+    print("membership of peer 0 after the failure:")
+    for member in table:
+        phi = "-" if member["phi"] is None else f"{member['phi']:.2f}"
+        print(f"  {member['addr'][0]}:{member['addr'][1]}  {member['status']:<8} phi {phi:>6}  "
+              f"last heard {member['last_heard']:.2f}s ago")
+    sys.exit(0 if false_evictions == 0 and detected is not None and rejoined is not None else 1)
+
+
+if __name__ == "__main__":
+    main()
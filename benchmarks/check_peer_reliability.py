@@ -0,0 +1,108 @@
+# Delivery of exercise_3 Peer messages over a lossy network, with and without
+# retransmissions.
+#
+# usage: python benchmarks/check_peer_reliability.py [--messages N] [--hops H]
+#
+# Starts a chain of H + 1 peers whose sockets drop every outgoing datagram with
+# the given probability, sends N messages from one end to the other without
+# waiting between them, and reports how many arrived (exactly once) and what
+# that cost in retransmissions.
+
+import contextlib
+import io
+import random
+import socket
+import sys
+import time
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+from Peer import Peer
+
+LOSS_RATES = (0.01, 0.05, 0.1, 0.2)
+
+
+class LossySocket:
+    # drops outgoing datagrams at random, everything else goes to the real socket
+
+    def __init__(self, sock, loss, rng):
+        self.sock = sock
+        self.loss = loss
+        self.rng = rng
+        self.dropped = 0
+
+    def sendto(self, data, addr):
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return len(data)
+        return self.sock.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(messages, hops, loss, reliable, seed):
+    rng = random.Random(seed)
+    peers = [Peer("127.0.0.1", free_udp_port(), reliable=reliable) for _ in range(hops + 1)]
+    for left, right in zip(peers, peers[1:]):
+        left.connect_to_peer("127.0.0.1", right.port)
+    time.sleep(0.2)
+    for peer in peers:
+        peer.socket = LossySocket(peer.socket, loss, rng)
+
+    source, destination = peers[0], peers[-1]
+    start = time.perf_counter()
+    for i in range(messages):
+        source.broadcast_message(f"reliability check {i}", destination.peer_id)
+
+    # wait until nothing is outstanding any more, or nothing moved for a while
+    last = None
+    idle_since = time.time()
+    while source.stats()["unacked"] and time.time() - idle_since < 12:
+        progress = (destination.messages_received, source.stats()["retransmissions"])
+        if progress != last:
+            last = progress
+            idle_since = time.time()
+        time.sleep(0.05)
+    time.sleep(0.3)  # stragglers without retransmissions
+    elapsed = time.perf_counter() - start
+
+    stats = source.stats()
+    return destination.messages_received, stats["retransmissions"], stats["given_up"], elapsed
+
+
+def main():
+    messages = int(get_option("--messages", 1000))
+    hops = int(get_option("--hops", 2))
+
+    print(f"{messages} messages over {hops} hops")
+    failed = False
+    for loss in LOSS_RATES:
+        for reliable in (False, True):
+            with contextlib.redirect_stdout(io.StringIO()):
+                delivered, retransmissions, given_up, elapsed = run(messages, hops, loss, reliable, seed=42)
+            label = "reliable" if reliable else "fire and forget"
+            print(f"loss {loss:4.0%}  {label:<16} delivered {delivered:6d}/{messages} "
+                  f"({delivered / messages:7.2%})   retransmissions {retransmissions:6d}   "
+                  f"given up {given_up:4d}   {elapsed:6.2f}s")
+            if reliable and delivered != messages:
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
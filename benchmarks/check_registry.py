@@ -0,0 +1,287 @@
+# Stress test of the client registry of exercise_1 and exercise_2, first in
+# process, then through a real server.
+#
+# usage: python benchmarks/check_registry.py [--threads T] [--cycles C] [--clients N] [--waves W]
+#            [--contenders K] [--server-args "--asyncio ..."]
+#
+# In process, against three registries:
+#   unlocked  the dict and `LAST_ID += 1` the servers used before
+#   global    one lock around every operation
+#   sharded   registry.ClientRegistry
+# T threads connect clients at once, half of them with desired ids from the
+# range the counter hands out, which is what happens when clients reconnect
+# with the ids they had before a restart; then all race to claim the same
+# desired ids; then they register and remove clients C times each. The thread
+# switch interval is lowered for the first two, so races that are rare in
+# production show up here. Reported: clients that lost their registration to
+# another client, desired ids won twice, and register + remove pairs per
+# second at the normal switch interval. The unlocked row is expected to FAIL.
+#
+# Through the server, W waves of N clients connect at once, every desired id
+# wanted by K of them, and disconnect. Every wave checks that no two clients
+# got the same id, that each desired id went to exactly one client, and that
+# the server's relay_clients gauge drops back to 0.
+
+import asyncio
+import shlex
+import sys
+import time
+import urllib.request
+from collections import Counter
+from multiprocessing import Process
+from threading import Barrier, Lock, Thread
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(2))
+from registry import ClientRegistry  # noqa: E402  (lives next to template_pb2)
+
+DESIRED_BASE = 1_000_000  # far from the ids the server counts up from
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+class UnlockedRegistry:
+    # what handle_client and change_client_id did before the registry
+
+    def __init__(self):
+        self.clients = {}
+        self.last_id = 0
+
+    def register(self, client):
+        id = self.last_id
+        self.last_id += 1
+        self.clients[id] = client
+        return id
+
+    def reserve(self, id, client):
+        if self.clients.get(id):
+            return False
+        self.clients[id] = client
+        return True
+
+    def remove(self, id, client):
+        self.clients.pop(id, None)
+
+    def get(self, id):
+        return self.clients.get(id)
+
+    def __len__(self):
+        return len(self.clients)
+
+
+class GlobalLockRegistry:
+
+    def __init__(self):
+        self.clients = {}
+        self.last_id = 0
+        self.lock = Lock()
+
+    def register(self, client):
+        with self.lock:
+            while self.last_id in self.clients:
+                self.last_id += 1
+            id = self.last_id
+            self.last_id += 1
+            self.clients[id] = client
+            return id
+
+    def reserve(self, id, client):
+        with self.lock:
+            if id in self.clients:
+                return False
+            self.clients[id] = client
+            return True
+
+    def remove(self, id, client):
+        with self.lock:
+            if self.clients.get(id) is client:
+                del self.clients[id]
+
+    def get(self, id):
+        return self.clients.get(id)
+
+    def __len__(self):
+        return len(self.clients)
+
+
+def churn(registry, threads, cycles):
+    # (ids handed out, seconds): every thread registers and removes a client `cycles` times
+    ids = [[] for _ in range(threads)]
+    barrier = Barrier(threads + 1)
+
+    def run(out):
+        client = object()
+        barrier.wait()
+        for _ in range(cycles):
+            id = registry.register(client)
+            out.append(id)
+            registry.remove(id, client)
+
+    workers = [Thread(target=run, args=(out,)) for out in ids]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return [id for out in ids for id in out], time.perf_counter() - start
+
+
+def hold(registry, threads, per_thread):
+    # clients that connected and are no longer the holder of their id; odd threads ask for
+    # desired ids 1, 3, 5, ..., which even threads get from the counter too
+    held = [[] for _ in range(threads)]
+    barrier = Barrier(threads)
+
+    def run(index, out):
+        barrier.wait()
+        for number in range(per_thread):
+            client = object()
+            if index % 2:
+                id = (number * threads + index) | 1
+                if registry.reserve(id, client):
+                    out.append((id, client))
+            else:
+                out.append((registry.register(client), client))
+
+    workers = [Thread(target=run, args=(index, out)) for index, out in enumerate(held)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(1 for out in held for id, client in out if registry.get(id) is not client)
+
+
+def race_desired(registry, threads, count):
+    # every thread claims the same desired ids at the same time, returns the winners per id
+    winners = Counter()
+    lock = Lock()
+    barrier = Barrier(threads)
+
+    def run():
+        client = object()
+        barrier.wait()
+        for id in range(DESIRED_BASE, DESIRED_BASE + count):
+            if registry.reserve(id, client):
+                with lock:
+                    winners[id] += 1
+
+    workers = [Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return winners
+
+
+def check_in_process(threads, cycles):
+    print(f"in process: {threads} threads")
+    for name, factory in (("unlocked", UnlockedRegistry), ("global", GlobalLockRegistry), ("sharded", ClientRegistry)):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            lost = hold(factory(), threads, cycles // 10)
+            winners = race_desired(factory(), threads, 2000)
+        finally:
+            sys.setswitchinterval(interval)
+        double_wins = sum(1 for count in winners.values() if count > 1)
+        registry = factory()
+        ids, seconds = churn(registry, threads, cycles)
+        ok = not lost and not double_wins and not len(registry)
+        print(f"  {'ok  ' if ok else 'FAIL'} {name:<9} clients overwritten {lost:6d}   desired ids won twice "
+              f"{double_wins:5d}   left over {len(registry):5d}   {len(ids) / seconds:10.0f} register+remove/s",
+              flush=True)
+
+
+def relay_clients(metrics_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if line.startswith("relay_clients "):
+                return int(float(line.split()[1]))
+    return None
+
+
+async def wave(exercise, pb2, port, clients, contenders, wave_index):
+    # (connect seconds, problems) of N clients connecting at once, then all of them closing
+    contested = clients // 2 // contenders if exercise == 2 else 0
+    first = DESIRED_BASE + wave_index * contested
+    desired = [first + index % contested if index < contested * contenders else None
+               for index in range(clients)] if contested else [None] * clients
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(common.open_client(exercise, pb2, port, id) for id in desired),
+                                   return_exceptions=True)
+    seconds = time.perf_counter() - start
+
+    problems = []
+    failed = [result for result in results if isinstance(result, BaseException)]
+    if failed:
+        problems.append(f"{len(failed)} handshakes failed, e.g. {failed[0]!r}")
+    connected = [(result, wanted) for result, wanted in zip(results, desired) if not isinstance(result, BaseException)]
+    ids = Counter(id for (_, _, id), _ in connected)
+    duplicates = sum(count - 1 for count in ids.values() if count > 1)
+    if duplicates:
+        problems.append(f"{duplicates} ids given to more than one client")
+    granted = Counter(wanted for (_, _, id), wanted in connected if wanted is not None and id == wanted)
+    if contested and (len(granted) != contested or any(count != 1 for count in granted.values())):
+        problems.append(f"{contested - len(granted)} desired ids not granted, "
+                        f"{sum(1 for count in granted.values() if count > 1)} granted twice")
+    for (_, writer, _), _ in connected:
+        writer.close()
+    return seconds, problems
+
+
+async def check_server(exercise, clients, waves, contenders, server_args):
+    pb2 = common.load_pb2(exercise)
+    port = common.free_port()
+    metrics_port = common.free_port()
+    proc = common.start_server(exercise, port, "--metrics-port", str(metrics_port), "--log-level", "warning",
+                               *server_args)
+    try:
+        print(f"exercise_{exercise} {' '.join(server_args) or 'threaded'}: {waves} waves of {clients} clients"
+              + (f", every desired id wanted by {contenders}" if exercise == 2 else ""))
+        for index in range(waves):
+            seconds, problems = await wave(exercise, pb2, port, clients, contenders, index)
+            start = time.perf_counter()
+            remaining = relay_clients(metrics_port)
+            while remaining and time.perf_counter() - start < 30:
+                await asyncio.sleep(0.05)
+                remaining = relay_clients(metrics_port)
+            if remaining:
+                problems.append(f"{remaining} clients still registered after disconnecting")
+            print(f"  {'ok  ' if not problems else 'FAIL'} wave {index}: {clients / seconds:7.0f} connects/s, "
+                  f"all gone after {time.perf_counter() - start:.2f}s" + "".join(f"; {p}" for p in problems),
+                  flush=True)
+    finally:
+        common.stop_server(proc)
+
+
+def main():
+    common.raise_fd_limit()
+    threads = int(get_option("--threads", 16))
+    cycles = int(get_option("--cycles", 20000))
+    clients = int(get_option("--clients", 2000))
+    waves = int(get_option("--waves", 3))
+    contenders = int(get_option("--contenders", 10))
+    server_args = shlex.split(get_option("--server-args", ""))
+
+    check_in_process(threads, cycles)
+    for exercise in (1, 2):
+        # each exercise has its own template_pb2, so each gets a process of its own
+        process = Process(target=run_server_check, args=(exercise, clients, waves, contenders, server_args))
+        process.start()
+        process.join()
+
+
+def run_server_check(*args):
+    asyncio.run(check_server(*args))
+
+
+if __name__ == "__main__":
+    main()
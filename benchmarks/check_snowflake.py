@@ -0,0 +1,80 @@
+# Checks that exercise_3 snowflake ids stay unique and increasing under many
+# threads, through sequence overflow, and when the clock is set back.
+#
+# usage: python benchmarks/check_snowflake.py [--threads T] [--ids N]
+#
+# T threads take N ids each from one shared generator, half of them one at a
+# time and half in batches, so every tick overflows. A second run does the
+# same with a clock that jumps back a little and a lot while ids are handed out.
+
+import random
+import sys
+import threading
+from sys import argv
+
+import common
+
+sys.path.insert(0, common.exercise_dir(3))
+import snowflake
+
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+
+class SteppingClock(snowflake.IdGenerator):
+    # a clock that is set back by up to 50 ticks or by an hour every few hundred reads
+    def __init__(self, assigner):
+        super().__init__(assigner)
+        self.offset = 0
+        self.reads = 0
+
+    def clock(self):
+        self.reads += 1
+        if self.reads % 500 == 0:
+            self.offset -= random.choice((random.randint(1, 50), 360_000))
+        return super().clock() + self.offset
+
+
+def run(ids, threads, per_thread):
+    results = [None] * threads
+
+    def work(index):
+        taken = []
+        while len(taken) < per_thread:
+            if index % 2:
+                taken.extend(ids.derive_ids(random.randint(1, 700)))
+            else:
+                taken.append(ids.derive_id())
+        results[index] = taken[:per_thread]
+
+    workers = [threading.Thread(target=work, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    everything = [i for taken in results for i in taken]
+    unique = len(set(everything))
+    ordered = all(taken == sorted(taken) for taken in results)
+    return len(everything), unique, ordered
+
+
+def main():
+    threads = int(get_option("--threads", 32))
+    per_thread = int(get_option("--ids", 5000))
+
+    failed = False
+    for label, ids in (("shared generator", snowflake.generator(42)), ("clock set back", SteppingClock(43))):
+        total, unique, ordered = run(ids, threads, per_thread)
+        ok = unique == total and ordered
+        failed |= not ok
+        print(f"{label:<18} {total} ids, {unique} unique, increasing per thread: {ordered}   "
+              f"{ids.stats()}   {'ok' if ok else 'FAILED'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Helpers shared by the benchmark scripts: run the real servers as subprocesses
+# and talk to them with a minimal asyncio client that speaks the same framing.
+
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def exercise_dir(exercise):
+    return os.path.join(ROOT, f"exercise_{exercise}")
+
+
+def load_pb2(exercise):
+    # each exercise ships its own template_pb2, only one of them can be loaded per process
+    sys.path.insert(0, exercise_dir(exercise))
+    import template_pb2
+    return template_pb2
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(exercise, port, *args):
+    # stdin is kept open, otherwise the op> console sees EOF and the server exits
+    proc = subprocess.Popen(
+        [sys.executable, "server.py", str(port), *args],
+        cwd=exercise_dir(exercise),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                pass
+            # the probe connection above registered a client, give it time to go away
+            time.sleep(0.2)
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def stop_server(proc):
+    proc.kill()
+    proc.wait()
+
+
+def process_status(pid):
+    # VmRSS (kB) and thread count of a running process, read from /proc
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+    return int(status["VmRSS"].split()[0]), int(status["Threads"])
+
+
+def encode_frame(m):
+    serialized = m.SerializeToString()
+    return len(serialized).to_bytes(4, byteorder="big") + serialized
+
+
+async def read_frame(reader):
+    size = int.from_bytes(await reader.readexactly(4), byteorder="big")
+    return await reader.readexactly(size)
+
+
+async def open_client(exercise, pb2, port, desired_id=None, batching=False):
+    # runs the handshake of the given exercise and returns (reader, writer, id)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    if exercise == 1:
+        handshake = pb2.FastHandshake()
+    else:
+        if desired_id is None:
+            request = pb2.Handshake(change_id=False, batching=batching)
+        else:
+            request = pb2.Handshake(id=desired_id, change_id=True, batching=batching)
+        writer.write(encode_frame(request))
+        await writer.drain()
+        handshake = pb2.Handshake()
+    handshake.ParseFromString(await read_frame(reader))
+    if handshake.error:
+        raise RuntimeError("handshake rejected")
+    return reader, writer, handshake.id
@@ -1,24 +1,36 @@
 import socket
+import time
 from sys import argv
 import template_pb2 as template_pb2
 from threading import Thread
+from framing import FrameReader
+from health import Heartbeat
+import codec
+import tracing
 
 
-def send_message(conn, m):
-    serialized = m.SerializeToString()
-    conn.sendall(len(serialized).to_bytes(4, byteorder="big"))
-    conn.sendall(serialized)
-
-
-def receive_message(conn, m):
-    msg = m()
-    size = int.from_bytes(conn.recv(4), byteorder="big")
-    data = conn.recv(size)
-    msg.ParseFromString(data)
-    return msg
+def take_option(name, default):
+    # removes `name value` from argv, so the positional arguments keep their places
+    if name not in argv:
+        return default
+    index = argv.index(name)
+    value = argv[index + 1]
+    del argv[index:index + 2]
+    return value
 
 
 def main():
+    # --trace-rate R traces about R of the messages sent, receivers print where the time went
+    trace_rate = float(take_option("--trace-rate", 0))
+    # --compress has both directions compressed when the server offers it
+    compress = "--compress" in argv
+    if compress:
+        argv.remove("--compress")
+    # --codec fixed sends messages in the fixed layout when the server reads it, see codec.py
+    codec_name = take_option("--codec", codec.PROTOBUF)
+    if codec_name not in codec.CODECS:
+        print(f"Invalid codec {codec_name}, expected one of: {', '.join(codec.CODECS)}")
+        return
     host = None
     port = None
     try:
@@ -36,7 +48,8 @@ def main():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((host, port))
         print("Connected to the server")
-        handshake = receive_message(s, template_pb2.FastHandshake)
+        reader = FrameReader(s)
+        handshake = reader.receive_message(template_pb2.FastHandshake)
         if handshake.error:
             print("Server rejected the connection")
             return
@@ -44,7 +57,14 @@ def main():
         print(f"we are client #{handshake.id}")
         id = handshake.id
 
-        Thread(target=handle_incoming_messages,args=(s,), daemon=True).start()
+        # a server that supports batching switches to MessageBatch frames once we ask for them
+        batching = handshake.batching
+        compress = compress and handshake.compression
+        wire = codec.CODECS[codec_name if codec_name in handshake.codecs else codec.PROTOBUF]
+        # a server that asks for heartbeats closes connections that stay silent for longer
+        sender = Heartbeat(s, handshake.heartbeat_ms / 1000)
+
+        Thread(target=handle_incoming_messages,args=(reader, batching, wire), daemon=True).start()
         while True:
             try:
                 data = input("Enter a message: \n")
@@ -56,8 +76,11 @@ def main():
                 message = "end"
                 msg = template_pb2.Message(fr=id, to=error, msg=message)
                 
-            msg = template_pb2.Message(fr=id, to=receiver_id, msg=message)
-            send_message(s, msg)
+            msg = template_pb2.Message(fr=id, to=receiver_id, msg=message, accept_batches=batching,
+                                       accept_compression=compress)
+            if tracing.sampled(trace_rate):
+                tracing.start(msg)
+            sender.send(wire.encode(msg), compress)
             
             if message == "end":
                 break
@@ -65,11 +88,25 @@ def main():
         print("Closing connection")
 
 
-def handle_incoming_messages(conn):
+def handle_incoming_messages(reader, batching, wire):
     print('waiting for messages...')
+    batches = False
     while True:
-        msg = receive_message(conn, template_pb2.Message)
-        print(f"New message arrived: {msg.msg}")
+        frame = reader.read_frame()
+        arrived_ns = time.time_ns()
+        if batching and not frame:
+            # empty frame: everything after it comes in MessageBatch frames
+            batches = True
+            continue
+
+        if batches:
+            messages = wire.decode_batch(frame)
+        else:
+            messages = [wire.decode(frame)]
+        for msg in messages:
+            print(f"New message arrived: {msg.msg}")
+            if msg.HasField("trace"):
+                print(tracing.report(msg.trace, arrived_ns))
 
 if __name__ == "__main__":
     main()
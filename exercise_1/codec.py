@@ -0,0 +1,155 @@
+# Wire codecs for chat Messages. Protobuf is the default, every client reads
+# it; the fixed layout is negotiated in the handshake and lets the relay route
+# a message on its first bytes and pass the payload on as it came in:
+#
+#   0x00 | to: int64 | fr: int64 | flags: uint8 | msg: utf-8 up to the end
+#
+# integers big-endian. No protobuf field has number 0, so a protobuf Message
+# never starts with a 0 byte and the first byte tells the encodings apart:
+# both can share a connection. Messages the layout cannot hold, traced ones
+# and channel messages, are sent as protobuf by the same codec.
+# - CODECS {name: codec}  .encode(msg) -> payload, .decode(payload) -> Message,
+#                         .decode_batch(frame) -> [Message] of a MessageBatch frame
+# - is_fixed(payload), header(payload) -> (to, fr, flags), receiver(payload) -> to
+# - check(payload) -> (to, fr, flags), ValueError for a payload receivers could not decode
+# - is_end(payload), text(payload), to_protobuf(payload)
+# - split_batch(frame) -> payloads of a MessageBatch frame, without decoding them
+#
+# Flags carry the boolean fields of Message that tell the relay what the
+# sender reads (exercise_1), receivers ignore them.
+
+__all__ = ["CODECS", "PROTOBUF", "FIXED", "HEADER_SIZE", "ACCEPT_BATCHES", "ACCEPT_COMPRESSION",
+           "ProtobufCodec", "FixedCodec", "is_fixed", "header", "check", "receiver", "is_end", "text", "to_protobuf",
+           "split_batch"]
+
+import struct
+
+import template_pb2
+
+PROTOBUF = "protobuf"
+FIXED = "fixed"
+
+MAGIC = 0x00
+HEADER = struct.Struct(">BqqB")  # magic, to, fr, flags
+HEADER_SIZE = HEADER.size
+TO = struct.Struct(">q")  # to alone, right after the magic byte
+END = b"end"  # a message that ends the sender's session, in any case
+BATCH_FIELD_TAG = 0x0A  # MessageBatch.messages: field 1, length-delimited
+
+ACCEPT_BATCHES = 0x01  # flag bits, for the Message fields of the same name
+ACCEPT_COMPRESSION = 0x02
+# (bit, field) of the flags this exercise's Message has
+FLAG_FIELDS = [(bit, name) for bit, name in ((ACCEPT_BATCHES, "accept_batches"),
+                                             (ACCEPT_COMPRESSION, "accept_compression"))
+               if name in template_pb2.Message.DESCRIPTOR.fields_by_name]
+FIXED_FIELDS = {"fr", "to", "msg"} | {name for _, name in FLAG_FIELDS}
+# (field, is a submessage) of the fields the layout has no room for
+OTHER_FIELDS = [(field.name, field.message_type is not None) for field in template_pb2.Message.DESCRIPTOR.fields
+                if field.name not in FIXED_FIELDS]
+
+
+def is_fixed(payload):
+    return payload[0] == MAGIC
+
+
+def header(payload):
+    _, to, fr, flags = HEADER.unpack_from(payload)
+    return to, fr, flags
+
+
+def check(payload):
+    # the relay passes fixed layout payloads on undecoded, so it checks them as they come in,
+    # like protobuf that does not parse; UnicodeDecodeError is a ValueError
+    if len(payload) < HEADER_SIZE:
+        raise ValueError(f"fixed layout Message of {len(payload)} bytes, shorter than its header")
+    text(payload)
+    return header(payload)
+
+
+def receiver(payload):
+    # Message.to of a payload in either encoding
+    if is_fixed(payload):
+        return TO.unpack_from(payload, 1)[0]
+    return template_pb2.Message.FromString(payload).to
+
+
+def is_end(payload):
+    return len(payload) == HEADER_SIZE + len(END) and bytes(payload[HEADER_SIZE:]).lower() == END
+
+
+def text(payload):
+    return str(payload[HEADER_SIZE:], "utf-8")
+
+
+def to_protobuf(payload):
+    # for receivers that did not negotiate the fixed layout, ValueError if it cannot be decoded
+    check(payload)
+    return CODECS[FIXED].decode(payload).SerializeToString()
+
+
+def split_batch(frame):
+    # the serialized Messages of a MessageBatch, as outbound.encode_batch put them together
+    payloads = []
+    view = memoryview(frame)
+    offset = 0
+    while offset < len(view):
+        if view[offset] != BATCH_FIELD_TAG:
+            raise ValueError(f"unexpected tag {view[offset]:#x} in a MessageBatch")
+        offset += 1
+        size = shift = 0
+        while True:
+            byte = view[offset]
+            offset += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        if offset + size > len(view):
+            raise ValueError("truncated MessageBatch")
+        payloads.append(view[offset:offset + size])
+        offset += size
+    return payloads
+
+
+class ProtobufCodec:
+    name = PROTOBUF
+
+    def encode(self, msg):
+        return msg.SerializeToString()
+
+    def decode(self, payload):
+        return template_pb2.Message.FromString(payload)
+
+    def decode_batch(self, frame):
+        return template_pb2.MessageBatch.FromString(frame).messages
+
+
+class FixedCodec:
+    # reads both encodings, writes the fixed layout whenever the message fits in it
+    name = FIXED
+
+    def encode(self, msg):
+        for name, submessage in OTHER_FIELDS:
+            if msg.HasField(name) if submessage else getattr(msg, name):
+                return msg.SerializeToString()
+        flags = 0
+        for bit, name in FLAG_FIELDS:
+            if getattr(msg, name):
+                flags |= bit
+        return HEADER.pack(MAGIC, msg.to, msg.fr, flags) + msg.msg.encode()
+
+    def decode(self, payload):
+        if not is_fixed(payload):
+            return template_pb2.Message.FromString(payload)
+        to, fr, flags = header(payload)
+        msg = template_pb2.Message(fr=fr, to=to, msg=text(payload))
+        for bit, name in FLAG_FIELDS:
+            if flags & bit:
+                setattr(msg, name, True)
+        return msg
+
+    def decode_batch(self, frame):
+        return [self.decode(payload) for payload in split_batch(frame)]
+
+
+CODECS = {codec.name: codec for codec in (ProtobufCodec(), FixedCodec())}
@@ -0,0 +1,147 @@
+# Length-prefixed framing: [4 bytes big-endian size || payload]
+# - FrameReader(conn).read_frame() -> memoryview over the payload
+# - send_frame(conn, payload) / send_frames(conn, payloads)
+# The top bit of the size flags a payload deflated by compression.py, readers
+# inflate those transparently. Senders only set it once the other side said it
+# understands it, pass compress=True then. A header announcing more than
+# MAX_FRAME bytes raises ConnectionError before anything is allocated for it.
+
+__all__ = ["FrameReader", "send_frame", "send_frames", "send_message", "encode_frame", "decode_frame",
+           "frame_size", "COMPRESSED", "MAX_FRAME"]
+
+import socket
+
+from compression import COMPRESS_MIN, MAX_INFLATED, deflate, inflate
+
+HEADER_SIZE = 4
+BUFFER_SIZE = 8 * 1024  # per connection, grows temporarily for larger frames
+IOV_MAX = 1024  # max buffers accepted by a single sendmsg on Linux
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+COMPRESSED = 0x80000000  # size flag: the payload is deflated
+MAX_FRAME = MAX_INFLATED  # payload bytes, deflated or not; nothing larger is ever accepted after inflating either
+
+
+class FrameReader:
+    # Owns the receive buffer of one connection. Each recv_into fills as much
+    # of the buffer as the kernel has ready, so a single syscall usually yields
+    # several frames; frames are handed out as memoryviews into the buffer.
+
+    def __init__(self, conn, buffer_size=BUFFER_SIZE):
+        self.conn = conn
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not consumed yet
+        self.end = 0  # one past the last byte received
+
+    def read_frame(self):
+        # The returned view is only valid until the next call on this reader.
+        while True:
+            available = self.end - self.start
+            if available >= HEADER_SIZE:
+                size = int.from_bytes(self.view[self.start : self.start + HEADER_SIZE], byteorder="big")
+                compressed = size & COMPRESSED
+                size = frame_size(size)
+                frame_end = self.start + HEADER_SIZE + size
+                if frame_end <= self.end:
+                    frame = self.view[self.start + HEADER_SIZE : frame_end]
+                    self.start = frame_end
+                    return inflate(frame) if compressed else frame
+                self._reserve(HEADER_SIZE + size)
+            self._fill()
+
+    def receive_message(self, m):
+        msg = m()
+        msg.ParseFromString(self.read_frame())
+        return msg
+
+    def _reserve(self, frame_size):
+        # make room for a whole frame after self.start
+        if self.start + frame_size <= len(self.buffer):
+            return
+        pending = self.end - self.start
+        if frame_size <= len(self.buffer):
+            # only the tail of a partial frame is moved, copy it out first since the ranges may overlap
+            self.buffer[:pending] = bytes(self.view[self.start : self.end])
+        else:
+            # frames handed out earlier keep the old buffer alive, so never resize in place
+            buffer = bytearray(frame_size)
+            buffer[:pending] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    def _fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size:
+                # drop the space grown for an oversized frame
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+        elif self.end == len(self.buffer):
+            self._reserve(len(self.buffer))
+        received = self.conn.recv_into(self.view[self.end :])
+        if received == 0:
+            raise ConnectionError("connection closed by peer")
+        self.end += received
+
+
+def frame_size(size):
+    # payload size announced by a frame header, checked against MAX_FRAME
+    size &= ~COMPRESSED
+    if size > MAX_FRAME:
+        raise ConnectionError(f"frame of {size} bytes is larger than {MAX_FRAME}")
+    return size
+
+
+def header(size):
+    return size.to_bytes(HEADER_SIZE, byteorder="big")
+
+
+def encode_frame(payload, compress=False):
+    # (header, payload) of one frame, deflated when allowed and worth it
+    if compress and len(payload) >= COMPRESS_MIN:
+        deflated = deflate(payload)
+        if deflated is not None:
+            return header(len(deflated) | COMPRESSED), deflated
+    return header(len(payload)), payload
+
+
+def decode_frame(size, payload):
+    # payload of a frame read by other means than FrameReader, size as found in its header
+    return inflate(payload) if size & COMPRESSED else payload
+
+
+def send_frame(conn, payload, compress=False):
+    send_frames(conn, (payload,), compress)
+
+
+def send_frames(conn, payloads, compress=False):
+    # header and payload of every frame go out in one writev-style sendmsg
+    buffers = []
+    for payload in payloads:
+        buffers.extend(encode_frame(payload, compress))
+
+    if not HAS_SENDMSG:
+        conn.sendall(b"".join(buffers))
+        return
+
+    for i in range(0, len(buffers), IOV_MAX):
+        sendmsg_all(conn, buffers[i : i + IOV_MAX])
+
+
+def sendmsg_all(conn, buffers):
+    # sendmsg may stop early on a full socket buffer, resume where it left off
+    first = 0
+    while first < len(buffers):
+        sent = conn.sendmsg(buffers[first:])
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = memoryview(buffers[first])[sent:]
+
+
+def send_message(conn, m, compress=False):
+    send_frame(conn, m.SerializeToString(), compress)
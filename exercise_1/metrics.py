@@ -0,0 +1,154 @@
+# Server metrics: counters, gauges and latency histograms, cheap enough for the
+# per-message path. They are shown by the op> console and served in Prometheus
+# text format on a local HTTP port, away from the chat port.
+# - Registry()                                   the metrics of one process
+#   .counter(name, help, labels) -> Counter       .inc(n)
+#   .gauge(name, help, read, labels) -> Gauge     read() is called when collected
+#   .histogram(name, help, buckets) -> Histogram  .observe(seconds)
+#   .render() -> Prometheus text exposition
+# - serve(registry, port) -> HTTPServer           GET /metrics on 127.0.0.1:port
+#
+# Updates take no lock, like the other stats counters of the server: an
+# increment racing another one may get lost, which is fine for monitoring.
+
+__all__ = ["Registry", "serve", "format_labels", "LATENCY_BUCKETS"]
+
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # seconds
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, read, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.read = read
+
+    @property
+    def value(self):
+        return self.read()
+
+    def samples(self):
+        yield self.name, self.labels, self.read()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts values above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile, None without observations
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            yield f"{self.name}_bucket", {"le": repr(bound)}, seen
+        yield f"{self.name}_bucket", {"le": "+Inf"}, self.count
+        yield f"{self.name}_sum", {}, self.sum
+        yield f"{self.name}_count", {}, self.count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=None):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, read, labels=None):
+        return self._add(Gauge(name, help, read, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        described = set()
+        for metric in self.metrics:
+            if metric.name not in described:
+                # metrics that only differ in their labels share one HELP and TYPE
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def serve(registry, port):
+    # Prometheus scrape endpoint on a thread of its own, only reachable from this host
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes every few seconds would flood the console
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,390 @@
+# Per-connection outbound queues: every client gets one writer that owns its
+# socket, so senders never block on a slow receiver and frames of different
+# senders never interleave on the wire.
+# - ClientWriter(conn, max_queue, policy)         thread-per-connection servers
+# - AsyncClientWriter(writer, max_queue, policy)  asyncio servers
+# Set .compress once the receiver said it reads compressed frames: frames of
+# COMPRESS_MIN bytes or more, MessageBatch frames as a whole, are then deflated
+# by the writer, off the sender's path.
+# .abort() drops a connection that went silent, .take_pending() hands back what
+# a closed writer never wrote, so the server can keep it for the next connection.
+# Set .codec to codec.FIXED once the receiver reads the fixed layout; for the
+# others the writer converts fixed layout payloads to protobuf.
+
+__all__ = ["ClientWriter", "AsyncClientWriter", "POLICIES", "OVERFLOW"]
+
+import asyncio
+import socket
+import time
+from collections import deque
+from threading import Condition, Thread
+
+from codec import FIXED, PROTOBUF, is_fixed, to_protobuf
+from framing import encode_frame, send_frames
+
+BLOCK = "block"  # the sender waits until the receiver catches up
+DROP_OLDEST = "drop_oldest"  # the oldest queued frame is discarded
+DISCONNECT = "disconnect"  # the lagging receiver is disconnected
+POLICIES = (BLOCK, DROP_OLDEST, DISCONNECT)
+# per frame only, for senders that must not wait: a full queue keeps the frame in an overflow
+# deque that refills the queue in order as the writer frees space. Past MAX_OVERFLOW frames the
+# receiver is disconnected and the frame stays with the others for take_pending()
+OVERFLOW = "overflow"
+
+MAX_QUEUE = 1024  # frames
+MAX_BATCH = 256  # frames flushed together in one sendmsg
+MAX_OVERFLOW = 64 * 1024  # frames kept past max_queue for OVERFLOW senders
+MAX_BATCH_BYTES = 256 * 1024  # payload bytes packed into one MessageBatch frame
+
+START_BATCHING = object()  # queue marker, frames after it are packed into MessageBatch frames
+BATCH_FIELD_TAG = b"\x0a"  # MessageBatch.messages: field 1, length-delimited
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_batch(payloads):
+    # serialized MessageBatch built from already serialized Messages, without re-encoding them
+    parts = []
+    for payload in payloads:
+        parts.append(BATCH_FIELD_TAG)
+        parts.append(varint(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def pack(writer, items):
+    # turns drained queue items into frames, switching to batches at the marker
+    frames = []
+    pending = []
+    convert = writer.codec != FIXED
+    skipped = 0
+    for item in items:
+        if item is START_BATCHING:
+            frames.extend(pending)
+            pending = []
+            writer.batching = True
+        elif convert and item and is_fixed(item):
+            try:
+                pending.append(to_protobuf(item))
+            except ValueError:
+                # the relay checks payloads as they come in, one that slipped through is dropped
+                # rather than ending the writer
+                writer.dropped += 1
+                skipped += 1
+        else:
+            pending.append(item)
+    if writer.batching and pending:
+        start = size = 0
+        for i, payload in enumerate(pending):
+            if size and size + len(payload) > MAX_BATCH_BYTES:
+                frames.append(encode_batch(pending[start:i]))
+                start = i
+                size = 0
+            size += len(payload)
+        frames.append(encode_batch(pending[start:]))
+    else:
+        frames.extend(pending)
+    return frames, len(items) - (START_BATCHING in items) - skipped
+
+
+def refill(writer):
+    # caller holds the writer's lock, after taking frames off its queue
+    while writer.overflow and len(writer.queue) < writer.max_queue:
+        writer.queue.append(writer.overflow.popleft())
+
+
+class ClientWriter:
+
+    def __init__(self, conn: socket.socket, max_queue=MAX_QUEUE, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy!r}, expected one of {POLICIES}")
+        self.conn = conn
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = deque()
+        self.overflow = deque()  # OVERFLOW frames waiting for room in queue, oldest first
+        self.cond = Condition()
+        self.closed = False
+        self.batching = False
+        self.compress = False
+        self.codec = PROTOBUF
+
+        self.sent = 0
+        self.received = 0  # frames read from this client, counted by the server's reader
+        self.last_seen = time.perf_counter()  # when the server's reader last got a frame
+        self.timeout = None  # seconds of silence after which the server closes the connection
+        self.waiting_for = None  # what the server expects within timeout, see health.py
+        self.dropped = 0
+        self.batches = 0
+        self.max_depth = 0
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, payload, policy=None):
+        # queue one serialized message, returns False if the frame was not accepted.
+        # policy overrides the writer's policy for this frame, e.g. BLOCK for replays
+        policy = policy or self.policy
+        with self.cond:
+            if self.closed:
+                return False
+            if policy == OVERFLOW and (self.overflow or len(self.queue) >= self.max_queue):
+                self.overflow.append(payload)
+                if len(self.overflow) > MAX_OVERFLOW:
+                    self.dropped += 1
+                    self._shutdown()
+                return True
+            if len(self.queue) >= self.max_queue:
+                if policy == BLOCK:
+                    while len(self.queue) >= self.max_queue and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return False
+                elif policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    self._shutdown()
+                    return False
+            self.queue.append(payload)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+            return True
+
+    def send_message(self, m):
+        return self.send(m.SerializeToString())
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), MAX_BATCH))]
+                refill(self)
+                self.cond.notify_all()  # room for blocked senders
+            frames, messages = pack(self, batch)
+            try:
+                send_frames(self.conn, frames, self.compress)
+            except (OSError, ValueError):
+                with self.cond:
+                    # the batch may not have arrived, it goes back for take_pending()
+                    self.queue.extendleft(reversed(batch))
+                    self.closed = True
+                    self.cond.notify_all()
+                return
+            self.sent += messages
+            self.batches += 1
+
+    def switch_to_batches(self, marker):
+        # marker is the last single frame, frames queued after it go out as MessageBatch frames;
+        # both are queued at once, so no sender's frame can land between them. They may go past
+        # max_queue, the receiver has to get them either way
+        with self.cond:
+            if self.closed:
+                return False
+            self.queue.append(marker)
+            self.queue.append(START_BATCHING)
+            self.cond.notify_all()
+            return True
+
+    def close(self):
+        # frames still queued stay until take_pending(), the owner closes the socket
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        with self.cond:
+            self._shutdown()
+
+    def take_pending(self):
+        # payloads queued but never written, once closed
+        with self.cond:
+            pending = [item for item in self.queue if item is not START_BATCHING] + list(self.overflow)
+            self.queue.clear()
+            self.overflow.clear()
+        return pending
+
+    def _shutdown(self):
+        # wakes the connection's reader with EOF so it runs its usual cleanup
+        self.closed = True
+        self.cond.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def depth(self):
+        return len(self.queue) + len(self.overflow)
+
+    def stats(self):
+        return {
+            "depth": len(self.queue) + len(self.overflow),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+
+class AsyncClientWriter:
+    # Same queue and policies as ClientWriter, drained by a task on the event loop.
+    # send() must be awaited from the loop thread.
+
+    def __init__(self, writer: asyncio.StreamWriter, max_queue=MAX_QUEUE, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy!r}, expected one of {POLICIES}")
+        self.writer = writer
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = deque()
+        self.overflow = deque()  # OVERFLOW frames waiting for room in queue, oldest first
+        self.cond = asyncio.Condition()
+        self.closed = False
+        self.batching = False
+        self.compress = False
+        self.codec = PROTOBUF
+        # (batch, bytes) handed to the transport that may still be in its buffer, which abort() discards
+        self.unflushed = deque()
+        self.unflushed_bytes = 0
+
+        self.sent = 0
+        self.received = 0  # frames read from this client, counted by the server's reader
+        self.last_seen = time.perf_counter()  # when the server's reader last got a frame
+        self.timeout = None  # seconds of silence after which the server closes the connection
+        self.waiting_for = None  # what the server expects within timeout, see health.py
+        self.dropped = 0
+        self.batches = 0
+        self.max_depth = 0
+
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def send(self, payload, policy=None):
+        policy = policy or self.policy
+        async with self.cond:
+            if self.closed:
+                return False
+            if policy == OVERFLOW and (self.overflow or len(self.queue) >= self.max_queue):
+                self.overflow.append(payload)
+                if len(self.overflow) > MAX_OVERFLOW:
+                    self.dropped += 1
+                    self.cond.notify_all()
+                    self.abort()
+                return True
+            if len(self.queue) >= self.max_queue:
+                if policy == BLOCK:
+                    await self.cond.wait_for(lambda: len(self.queue) < self.max_queue or self.closed)
+                    if self.closed:
+                        return False
+                elif policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    self.closed = True
+                    self.cond.notify_all()
+                    self.abort()  # close() would wait for the unread buffer to drain
+                    return False
+            self.queue.append(payload)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+            return True
+
+    async def send_message(self, m):
+        return await self.send(m.SerializeToString())
+
+    async def run(self):
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.queue or self.closed)
+                if self.closed:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(len(self.queue), MAX_BATCH))]
+                refill(self)
+                self.cond.notify_all()
+            frames, messages = pack(self, batch)
+            try:
+                buffers = []
+                for frame in frames:
+                    buffers.extend(encode_frame(frame, self.compress))
+                self.unflushed.append((batch, sum(len(buffer) for buffer in buffers)))
+                self.unflushed_bytes += self.unflushed[-1][1]
+                self.writer.writelines(buffers)  # one transport write for the whole batch
+                await self.writer.drain()
+            except asyncio.CancelledError:
+                # closed while the batch was on its way, it goes back for take_pending()
+                self._requeue_unflushed()
+                raise
+            except (OSError, RuntimeError):
+                async with self.cond:
+                    self._requeue_unflushed()
+                    self.closed = True
+                    self.cond.notify_all()
+                return
+            # batches are only forgotten once the kernel has all of their bytes
+            buffered = self.writer.transport.get_write_buffer_size()
+            while self.unflushed and self.unflushed_bytes - self.unflushed[0][1] >= buffered:
+                self.unflushed_bytes -= self.unflushed.popleft()[1]
+            self.sent += messages
+            self.batches += 1
+
+    async def switch_to_batches(self, marker):
+        async with self.cond:
+            if self.closed:
+                return False
+            self.queue.append(marker)
+            self.queue.append(START_BATCHING)
+            self.cond.notify_all()
+            return True
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        asyncio.get_running_loop().create_task(self._wake_senders())
+
+    def abort(self):
+        # the reader sees the connection drop and runs its usual cleanup
+        self.closed = True
+        self._requeue_unflushed()
+        self.writer.transport.abort()
+
+    def _requeue_unflushed(self):
+        while self.unflushed:
+            batch, _ = self.unflushed.pop()
+            self.queue.extendleft(reversed(batch))
+        self.unflushed_bytes = 0
+
+    def take_pending(self):
+        # runs on the loop thread, so nothing is queued meanwhile
+        pending = [item for item in self.queue if item is not START_BATCHING] + list(self.overflow)
+        self.queue.clear()
+        self.overflow.clear()
+        return pending
+
+    async def _wake_senders(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    def depth(self):
+        return len(self.queue) + len(self.overflow)
+
+    def stats(self):
+        return {
+            "depth": len(self.queue) + len(self.overflow),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
@@ -0,0 +1,88 @@
+# Connected clients by id, safe to update from many handler threads at once.
+# Ids come from an atomic counter, and the map is split into shards that each
+# have a lock of their own: registering, claiming a desired id and removing
+# lock a single shard, so accepts on different shards never wait for each
+# other, and lookups on the per-message path take no lock at all.
+# - ClientRegistry(shards, first_id, step, taken)
+#   .register(client) -> id         the next id of first_id, first_id + step, ... nobody holds,
+#                                   here or, by taken(id), on another member of a cluster
+#   .reserve(id, client) -> bool    claims a desired id, False if it is taken
+#   .remove(id, client)             only while id still belongs to client
+#   .get(id), id in registry, len(registry)
+#   .items(), .values()             snapshots for stats, taken shard by shard
+
+__all__ = ["ClientRegistry", "SHARDS"]
+
+import itertools
+from threading import Lock
+
+SHARDS = 16
+
+
+class ClientRegistry:
+
+    def __init__(self, shards=SHARDS, first_id=0, step=1, taken=None):
+        self.shards = [{} for _ in range(shards)]
+        self.taken = taken  # id -> True while a client connected elsewhere holds it as desired id
+        self.locks = [Lock() for _ in range(shards)]
+        # next() on a count runs without releasing the GIL, so no id is handed out twice
+        # (threading numbers its threads the same way)
+        self.ids = itertools.count(first_id, step)
+
+        self.registered = 0
+        self.skipped = 0  # counter ids passed over because a client had claimed them as desired id,
+                          # here or elsewhere
+        self.rejected = 0  # desired ids refused because they were taken
+
+    def register(self, client):
+        while True:
+            id = next(self.ids)
+            if not (self.taken and self.taken(id)) and self._claim(id, client):
+                self.registered += 1
+                return id
+            self.skipped += 1
+
+    def reserve(self, id, client):
+        if self._claim(id, client):
+            return True
+        self.rejected += 1
+        return False
+
+    def _claim(self, id, client):
+        index = id % len(self.shards)
+        shard = self.shards[index]
+        with self.locks[index]:
+            if id in shard:
+                return False
+            shard[id] = client
+            return True
+
+    def remove(self, id, client):
+        # a client that lost or gave up its id must not remove whoever holds it now
+        index = id % len(self.shards)
+        with self.locks[index]:
+            if self.shards[index].get(id) is client:
+                del self.shards[index][id]
+
+    def get(self, id, default=None):
+        return self.shards[id % len(self.shards)].get(id, default)
+
+    def __contains__(self, id):
+        return id in self.shards[id % len(self.shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def items(self):
+        items = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                items.extend(shard.items())
+        return items
+
+    def values(self):
+        return [client for _, client in self.items()]
+
+    def stats(self):
+        return {"clients": len(self), "registered": self.registered, "skipped": self.skipped,
+                "rejected": self.rejected, "shards": len(self.shards)}
@@ -1,98 +1,444 @@
+import asyncio
 import socket
+import time
 from sys import argv
 from threading import Thread
 import template_pb2 as template_pb2
+from framing import FrameReader, decode_frame, encode_frame, frame_size, send_frame
+from metrics import Registry, format_labels, serve
+from outbound import AsyncClientWriter, ClientWriter, MAX_QUEUE, BLOCK, POLICIES
+from registry import ClientRegistry
+import codec
+import tracing
+import health
+import logs
 
-CLIENTS = {}
-LAST_ID = 0
+CLIENTS = ClientRegistry()
+QUEUE_SIZE = MAX_QUEUE
+QUEUE_POLICY = BLOCK
+COMPRESSION = True  # offered in the FastHandshake, off with --no-compression
+FIXED_CODEC = True  # codec.FIXED offered in the FastHandshake, off with --no-fixed-codec
+HEARTBEAT = health.HEARTBEAT_INTERVAL  # asked of clients in the FastHandshake, seconds
+IDLE_TIMEOUT = health.IDLE_TIMEOUT  # for clients that send no heartbeats
+ADMISSION = None  # health.Admission, set up in main
 
+METRICS = Registry()
+CONNECTIONS = METRICS.counter("relay_connections_total", "Client connections accepted")
+RECEIVED = METRICS.counter("relay_messages_received_total", "Messages read from clients")
+QUEUED = METRICS.counter("relay_messages_queued_total", "Messages queued for a connected receiver")
+DROPPED_UNKNOWN = METRICS.counter("relay_messages_dropped_total", "Messages not delivered",
+                                  {"reason": "unknown_receiver"})
+DROPPED_SLOW = METRICS.counter("relay_messages_dropped_total", "Messages not delivered", {"reason": "slow_receiver"})
+DROPPED_GONE = METRICS.counter("relay_messages_dropped_total", "Messages not delivered", {"reason": "receiver_gone"})
+HEARTBEATS = METRICS.counter("relay_heartbeats_total", "Heartbeats read from clients")
+REFUSED = {reason: METRICS.counter("relay_connections_refused_total", "Connections refused by admission control",
+                                   {"reason": reason}) for reason in (health.MAX_CONNECTIONS, health.ACCEPT_RATE)}
+TIMED_OUT = {reason: METRICS.counter("relay_connections_timed_out_total", "Connections closed after the client went silent",
+                                     {"reason": reason}) for reason in (health.HEARTBEAT, health.IDLE)}
+ROUTE_SECONDS = METRICS.histogram("relay_route_seconds", "Time from reading a message to queueing or dropping it")
+METRICS.gauge("relay_clients", "Connected clients", lambda: len(CLIENTS))
+METRICS.gauge("relay_connections_open", "Connections admitted and not closed yet", lambda: ADMISSION.active)
+METRICS.gauge("relay_queued_frames", "Frames waiting in the outbound queues",
+              lambda: sum(client.depth() for client in CLIENTS.values()))
+METRICS.gauge("relay_log_records_dropped", "Log records dropped because the log queue was full",
+              lambda: logs.stats()["dropped"])
 
-def send_message(conn, m):
-    serialized = m.SerializeToString()
-    conn.sendall(len(serialized).to_bytes(4, byteorder="big"))
-    conn.sendall(serialized)
+CONNECTION_LOG = logs.get("connections")
+MESSAGE_LOG = logs.get("messages")
+DROP_LOG = logs.get("drops")
+ADMISSION_LOG = logs.get("admission")
+LOG_RATES = {"drops": 10, "admission": 10}  # records/s, a receiver that went away or a flood would fill the log
 
-def receive_message(conn, m):
-    msg = m()
-    size = int.from_bytes(conn.recv(4), byteorder="big")
-    data = conn.recv(size)
-    msg.ParseFromString(data)
-    return msg
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+async def receive_frame_async(reader: asyncio.StreamReader):
+    size = int.from_bytes(await reader.readexactly(4), byteorder="big")
+    data = await reader.readexactly(frame_size(size))
+    return decode_frame(size, data)
+
+def fast_handshake(id):
+    return template_pb2.FastHandshake(id=id, error=False, batching=True, compression=COMPRESSION,
+                                      heartbeat_ms=int(HEARTBEAT * 1000),
+                                      codecs=[codec.FIXED] if FIXED_CODEC else []).SerializeToString()
+
+def log_client_error(id, client, e):
+    # connections the server closed itself, silent clients and those too far behind, are no error
+    if client.closed:
+        CONNECTION_LOG.info("Connection to client #%d closed: %s", id, e)
+    else:
+        CONNECTION_LOG.error("Error handling client #%d: %s", id, e)
+
+def note_heartbeat(client):
+    # the first heartbeat shows the client sends them, from then on it may only miss a few
+    HEARTBEATS.inc()
+    if client.waiting_for != health.HEARTBEAT:
+        client.timeout = HEARTBEAT * health.HEARTBEAT_MISSES
+        client.waiting_for = health.HEARTBEAT
+
+def read_message(client, frame):
+    # (to, payload, accept_batches, accept_compression) of a message frame, None for "end";
+    # fixed layout frames are routed on their header and passed on as they came in
+    if FIXED_CODEC and codec.is_fixed(frame):
+        to, fr, flags = codec.check(frame)
+        if MESSAGE_LOG.enabled(logs.DEBUG):
+            MESSAGE_LOG.debug("Message from %d to %d: %s", fr, to, codec.text(frame))
+        if codec.is_end(frame):
+            return None
+        # a client that writes the fixed layout reads it too
+        client.codec = codec.FIXED
+        payload = bytes(frame) if len(frame) > codec.HEADER_SIZE else bytes(frame) + b"empty string"
+        return to, payload, flags & codec.ACCEPT_BATCHES, flags & codec.ACCEPT_COMPRESSION
+
+    msg = template_pb2.Message.FromString(frame)
+    if msg.HasField("trace"):
+        tracing.stamp(msg, "relay")
+    if MESSAGE_LOG.enabled(logs.DEBUG):
+        MESSAGE_LOG.debug("Message from %d to %d: %s", msg.fr, msg.to, msg.msg)
+    if msg.msg.lower() == "end":
+        return None
+    accept_batches, accept_compression = msg.accept_batches, msg.accept_compression
+    msg.accept_batches = msg.accept_compression = False
+    if msg.msg == '':
+        msg.msg = 'empty string'
+    return msg.to, msg.SerializeToString(), accept_batches, accept_compression
+
+def drop_undelivered(id, client, handshake):
+    # no offline storage here, what was still queued for a client that went away is lost
+    undelivered = [payload for payload in client.take_pending() if payload and payload is not handshake]
+    if undelivered:
+        DROPPED_GONE.inc(len(undelivered))
+        DROP_LOG.warning("Client #%d went away with %d messages queued. Dropping them.", id, len(undelivered))
 
 def handle_client(conn: socket.socket, addr):
-    global LAST_ID
-    id = LAST_ID
-    LAST_ID += 1
-    CLIENTS[id] = conn
+    client = ClientWriter(conn, QUEUE_SIZE, QUEUE_POLICY)
+    id = CLIENTS.register(client)
+    CONNECTIONS.inc()
+    reader = FrameReader(conn)
+    client.timeout, client.waiting_for = IDLE_TIMEOUT, health.IDLE
+    handshake = fast_handshake(id)
 
     try:
-        handshake = template_pb2.FastHandshake(id=id, error=False)
-        send_message(conn, handshake)
-        print(f"Client #{id} connected from {addr}")
+        client.send(handshake)
+        CONNECTION_LOG.info("Client #%d connected from %s", id, addr)
+        batching = False
 
         while True:
-            msg = receive_message(conn, template_pb2.Message)
-            print(f"Message from {msg.fr} to {msg.to}: {msg.msg}")
-
-            if msg.msg.lower() == "end":
+            frame = reader.read_frame()
+            start = client.last_seen = time.perf_counter()
+            if not frame:
+                note_heartbeat(client)
+                continue
+            RECEIVED.inc()
+            client.received += 1
+            message = read_message(client, frame)
+            if message is None:
                 break
-            
-            if msg.msg == '':
-                msg.msg = 'empty string'
+            to, payload, accept_batches, accept_compression = message
 
-            receiver_conn = CLIENTS.get(msg.to)
-            if receiver_conn:
-                send_message(receiver_conn, msg)
+            if accept_batches and not batching:
+                # an empty frame tells the client that MessageBatch frames follow
+                batching = True
+                client.switch_to_batches(b"")
+
+            if accept_compression:
+                # from now on frames to this client are compressed when it pays off
+                client.compress = COMPRESSION
+
+            receiver = CLIENTS.get(to)
+            if receiver:
+                if receiver.send(payload):
+                    QUEUED.inc()
+                else:
+                    DROPPED_SLOW.inc()
+                    DROP_LOG.warning("Client #%d is not keeping up. Dropping message.", to)
             else:
-                print(f"Client #{msg.to} does not exist. Dropping message.")
+                DROPPED_UNKNOWN.inc()
+                DROP_LOG.warning("Client #%d does not exist. Dropping message.", to)
+            ROUTE_SECONDS.observe(time.perf_counter() - start)
 
     except Exception as e:
-        print(f"Error handling client #{id}: {e}")
+        log_client_error(id, client, e)
     finally:
-        print(f"Closing connection to client #{id}")
-        CLIENTS.pop(id, None)
+        CONNECTION_LOG.info("Closing connection to client #%d", id)
+        CLIENTS.remove(id, client)
+        client.close()
+        drop_undelivered(id, client, handshake)
         conn.close()
 
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # same protocol as handle_client, but one coroutine per client instead of one thread
+    client = AsyncClientWriter(writer, QUEUE_SIZE, QUEUE_POLICY)
+    id = CLIENTS.register(client)
+    CONNECTIONS.inc()
+    addr = writer.get_extra_info("peername")
+    client.timeout, client.waiting_for = IDLE_TIMEOUT, health.IDLE
+    handshake = fast_handshake(id)
+
+    try:
+        await client.send(handshake)
+        CONNECTION_LOG.info("Client #%d connected from %s", id, addr)
+        batching = False
+
+        while True:
+            frame = await receive_frame_async(reader)
+            start = client.last_seen = time.perf_counter()
+            if not frame:
+                note_heartbeat(client)
+                continue
+            RECEIVED.inc()
+            client.received += 1
+            message = read_message(client, frame)
+            if message is None:
+                break
+            to, payload, accept_batches, accept_compression = message
+
+            if accept_batches and not batching:
+                batching = True
+                await client.switch_to_batches(b"")
+
+            if accept_compression:
+                # from now on frames to this client are compressed when it pays off
+                client.compress = COMPRESSION
+
+            receiver = CLIENTS.get(to)
+            if receiver:
+                if await receiver.send(payload):
+                    QUEUED.inc()
+                else:
+                    DROPPED_SLOW.inc()
+                    DROP_LOG.warning("Client #%d is not keeping up. Dropping message.", to)
+            else:
+                DROPPED_UNKNOWN.inc()
+                DROP_LOG.warning("Client #%d does not exist. Dropping message.", to)
+            ROUTE_SECONDS.observe(time.perf_counter() - start)
+
+    except Exception as e:
+        log_client_error(id, client, e)
+    finally:
+        CONNECTION_LOG.info("Closing connection to client #%d", id)
+        CLIENTS.remove(id, client)
+        client.close()
+        drop_undelivered(id, client, handshake)
+        writer.close()
+
+def refusal(reason):
+    # the FastHandshake a refused connection gets before it is closed
+    REFUSED[reason].inc()
+    ADMISSION_LOG.warning("Refusing a connection: %s", reason)
+    return template_pb2.FastHandshake(id=-1, error=True).SerializeToString()
+
+def serve_client(conn: socket.socket, addr):
+    try:
+        health.keepalive(conn)
+        # replies and relayed messages are small frames, Nagle would hold them back for an ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handle_client(conn, addr)
+    finally:
+        ADMISSION.release()
+
+async def serve_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    refused, delay = ADMISSION.admit()
+    if refused:
+        writer.writelines(encode_frame(refusal(refused)))
+        writer.close()
+        return
+    try:
+        sock = writer.get_extra_info("socket")
+        health.keepalive(sock)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # as in serve_client
+        if delay:
+            await asyncio.sleep(delay)
+        await handle_client_async(reader, writer)
+    finally:
+        ADMISSION.release()
+
+def reap_silent_clients():
+    # closes the connections of clients that went silent, their readers then run the usual cleanup
+    for id, client in health.expired(CLIENTS, time.perf_counter()):
+        TIMED_OUT[client.waiting_for].inc()
+        CONNECTION_LOG.info("Client #%d sent no %s for %.1fs. Closing connection.", id, client.waiting_for,
+                            client.timeout)
+        client.timeout = None
+        client.abort()
+
+def reap_forever():
+    while True:
+        time.sleep(health.REAP_INTERVAL)
+        reap_silent_clients()
+
+async def reap_forever_async():
+    while True:
+        await asyncio.sleep(health.REAP_INTERVAL)
+        reap_silent_clients()
+
 def loop_main(port):
+    Thread(target=reap_forever, daemon=True).start()
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.bind(("0.0.0.0", port))
             print(f"Server started on port {port}")
             print("Waiting for a client...")
-            s.listen()
+            s.listen(socket.SOMAXCONN)
             while True:
                 try:
                     conn, addr = s.accept()
-                    Thread(target=handle_client, args=(conn, addr)).start()
                 except KeyboardInterrupt:
                     break
+                except OSError as e:
+                    # out of descriptors: the pending connection stays in the backlog until one is free
+                    ADMISSION_LOG.error("Accepting a connection failed: %s", e)
+                    time.sleep(health.REAP_INTERVAL)
+                    continue
+                refused, delay = ADMISSION.admit()
+                if refused:
+                    try:
+                        send_frame(conn, refusal(refused))
+                    except OSError:
+                        pass
+                    conn.close()
+                    continue
+                if delay:
+                    time.sleep(delay)  # later connections wait in the listen backlog meanwhile
+                try:
+                    Thread(target=serve_client, args=(conn, addr)).start()
+                except RuntimeError as e:
+                    # out of threads, --max-connections is set too high for this machine
+                    ADMISSION.release()
+                    ADMISSION_LOG.error("Serving a connection failed: %s", e)
+                    conn.close()
     except:
         pass
 
+async def loop_main_async(port):
+    server = await asyncio.start_server(serve_client_async, "0.0.0.0", port, backlog=socket.SOMAXCONN)
+    reaper = asyncio.create_task(reap_forever_async())
+    print(f"Server started on port {port} (asyncio mode)")
+    print("Waiting for a client...")
+    async with server:
+        await server.serve_forever()
+    reaper.cancel()
+
+def run_async_server(port):
+    try:
+        asyncio.run(loop_main_async(port))
+    except Exception as e:
+        print(f"Server error: {e}")
+
+def print_queues():
+    # lagging clients first
+    queues = sorted(((id, client.stats()) for id, client in CLIENTS.items()),
+                    key=lambda item: item[1]["depth"], reverse=True)
+    print(f"Outbound queues (max {QUEUE_SIZE} frames, policy {QUEUE_POLICY}):")
+    for id, stats in queues:
+        print(f"  client #{id}: depth={stats['depth']} max_depth={stats['max_depth']} "
+              f"sent={stats['sent']} dropped={stats['dropped']} batches={stats['batches']}")
+
+def print_stats():
+    print("Metrics:")
+    for metric in METRICS.metrics:
+        if metric.kind != "histogram":
+            print(f"  {metric.name}{format_labels(metric.labels)}: {metric.value}")
+        elif metric.count:
+            print(f"  {metric.name}: count={metric.count} mean={metric.sum / metric.count * 1000:.3f}ms "
+                  f"p50<={metric.quantile(0.5) * 1000:g}ms p99<={metric.quantile(0.99) * 1000:g}ms "
+                  f"p999<={metric.quantile(0.999) * 1000:g}ms")
+        else:
+            print(f"  {metric.name}: no observations")
+
+def print_top_clients(count):
+    # the clients lagging the most, then the busiest senders
+    clients = sorted(((id, client.stats()) for id, client in CLIENTS.items()),
+                     key=lambda item: (item[1]["depth"], item[1]["received"]), reverse=True)
+    print(f"Top {min(count, len(clients))} of {len(clients)} clients:")
+    for id, stats in clients[:count]:
+        print(f"  client #{id}: lag={stats['depth']} frames max_lag={stats['max_depth']} "
+              f"received={stats['received']} sent={stats['sent']} dropped={stats['dropped']}")
+
 def main():
     global CLIENTS
+    global QUEUE_SIZE
+    global QUEUE_POLICY
+    global COMPRESSION
+    global FIXED_CODEC
+    global HEARTBEAT
+    global IDLE_TIMEOUT
+    global ADMISSION
 
     try:
         port = int(argv[1])
     except:
         port = 8080
 
-    loop = Thread(target=loop_main, args=(port,))
+    QUEUE_SIZE = int(get_option("--queue-size", MAX_QUEUE))
+    QUEUE_POLICY = get_option("--queue-policy", BLOCK)
+    COMPRESSION = "--no-compression" not in argv
+    # --no-fixed-codec stops offering codec.FIXED, clients then send and get protobuf only
+    FIXED_CODEC = "--no-fixed-codec" not in argv
+    # --heartbeat S asks clients for a heartbeat every S seconds (0 for none), those that miss
+    # HEARTBEAT_MISSES in a row are disconnected; --idle-timeout S does the same for clients without
+    # heartbeats after S silent seconds; --max-connections N and --accept-rate N/s limit new connections
+    HEARTBEAT = float(get_option("--heartbeat", health.HEARTBEAT_INTERVAL))
+    IDLE_TIMEOUT = float(get_option("--idle-timeout", health.IDLE_TIMEOUT))
+    threads_per_connection = 0 if "--asyncio" in argv else 2
+    ADMISSION = health.Admission(int(get_option("--max-connections",
+                                                health.default_max_connections(threads_per_connection))),
+                                 float(get_option("--accept-rate", 0)))
+    if QUEUE_POLICY not in POLICIES:
+        print(f"Invalid queue policy {QUEUE_POLICY}, expected one of: {', '.join(POLICIES)}")
+        return
+
+    # --log-level debug logs every relayed message; --log-file writes to a rotating file instead of
+    # stdout; --log-sample and --log-rate take category=N,... to keep 1 in N records or N records/s
+    log_level = get_option("--log-level", "info")
+    if log_level not in logs.LEVELS:
+        print(f"Invalid log level {log_level}, expected one of: {', '.join(logs.LEVELS)}")
+        return
+    logs.configure(log_level, get_option("--log-file", None),
+                   sample=logs.parse_limits(get_option("--log-sample", "")),
+                   rate={**LOG_RATES, **logs.parse_limits(get_option("--log-rate", ""))})
+
+    # --metrics-port serves the metrics to Prometheus on 127.0.0.1
+    metrics_port = get_option("--metrics-port", None)
+    if metrics_port:
+        serve(METRICS, int(metrics_port))
+        print(f"Metrics on http://127.0.0.1:{metrics_port}/metrics")
+
+    # --asyncio serves every client from a single event loop instead of a thread per client
+    if "--asyncio" in argv:
+        loop = Thread(target=run_async_server, args=(port,))
+    else:
+        loop = Thread(target=loop_main, args=(port,))
     loop.daemon = True
     loop.start()
 
     while True:
         try:
-            command = input("op> ").strip().lower()
+            command, _, argument = input("op> ").strip().lower().partition(" ")
         except:
             break
+        count = int(argument) if argument.isdigit() else 10
 
         if command == "num_users":
             print(f"Number of users: {len(CLIENTS)}")
+        elif command == "queues":
+            print_queues()
+        elif command == "stats":
+            print_stats()
+        elif command == "top_clients":
+            print_top_clients(count)
+        elif command == "backlog":
+            print("No offline storage, messages to clients that are not connected are dropped")
         else:
             print("Invalid command")
             print("Available commands:")
             print("- num_users: Get the number of connected users")
+            print("- queues: Show outbound queue depth per client")
+            print("- stats: Show message counters, gauges and routing latency")
+            print("- top_clients [N]: Show the N most lagging clients")
 
 
 if __name__ == "__main__":
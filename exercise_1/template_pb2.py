@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0etemplate.proto\x12\x03\x63s2\".\n\x07Message\x12\n\n\x02\x66r\x18\x01 \x01(\x03\x12\n\n\x02to\x18\x02 \x01(\x03\x12\x0b\n\x03msg\x18\x03 \x01(\t\"*\n\rFastHandshake\x12\n\n\x02id\x18\x01 \x01(\x03\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0etemplate.proto\x12\x03\x63s2\"}\n\x07Message\x12\n\n\x02\x66r\x18\x01 \x01(\x03\x12\n\n\x02to\x18\x02 \x01(\x03\x12\x0b\n\x03msg\x18\x03 \x01(\t\x12\x16\n\x0e\x61\x63\x63\x65pt_batches\x18\x04 \x01(\x08\x12\x1a\n\x12\x61\x63\x63\x65pt_compression\x18\x05 \x01(\x08\x12\x19\n\x05trace\x18\x10 \x01(\x0b\x32\n.cs2.Trace\"6\n\x08HopStamp\x12\r\n\x05where\x18\x01 \x01(\t\x12\x0c\n\x04node\x18\x02 \x01(\x03\x12\r\n\x05\x61t_ns\x18\x03 \x01(\x03\"I\n\x05Trace\x12\x10\n\x08trace_id\x18\x01 \x01(\x03\x12\x11\n\torigin_ns\x18\x02 \x01(\x03\x12\x1b\n\x04hops\x18\x03 \x03(\x0b\x32\r.cs2.HopStamp\".\n\x0cMessageBatch\x12\x1e\n\x08messages\x18\x01 \x03(\x0b\x32\x0c.cs2.Message\"w\n\rFastHandshake\x12\n\n\x02id\x18\x01 \x01(\x03\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x10\n\x08\x62\x61tching\x18\x03 \x01(\x08\x12\x13\n\x0b\x63ompression\x18\x04 \x01(\x08\x12\x14\n\x0cheartbeat_ms\x18\x05 \x01(\x05\x12\x0e\n\x06\x63odecs\x18\x06 \x03(\tb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,7 +32,13 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'template_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_MESSAGE']._serialized_start=23
-  _globals['_MESSAGE']._serialized_end=69
-  _globals['_FASTHANDSHAKE']._serialized_start=71
-  _globals['_FASTHANDSHAKE']._serialized_end=113
+  _globals['_MESSAGE']._serialized_end=148
+  _globals['_HOPSTAMP']._serialized_start=150
+  _globals['_HOPSTAMP']._serialized_end=204
+  _globals['_TRACE']._serialized_start=206
+  _globals['_TRACE']._serialized_end=279
+  _globals['_MESSAGEBATCH']._serialized_start=281
+  _globals['_MESSAGEBATCH']._serialized_end=327
+  _globals['_FASTHANDSHAKE']._serialized_start=329
+  _globals['_FASTHANDSHAKE']._serialized_end=448
 # @@protoc_insertion_point(module_scope)
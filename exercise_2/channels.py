@@ -0,0 +1,44 @@
+# Channel membership: which client ids receive the messages sent to a channel.
+# Members stay in a channel while they are offline, their copies go to the
+# offline store like any other message. With --workers or --nodes every
+# channel is kept by one home member, channel_home(name, members), which owns
+# its index and does the fan-out.
+
+__all__ = ["Channels", "channel_home"]
+
+import zlib
+from threading import Lock
+
+
+def channel_home(name, members):
+    # crc32 instead of hash(), which differs between processes
+    return zlib.crc32(name.encode()) % members
+
+
+class Channels:
+
+    def __init__(self):
+        self.channels = {}  # channel name -> set of client ids
+        self.lock = Lock()
+
+    def join(self, channel, id):
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(id)
+
+    def leave(self, channel, id):
+        with self.lock:
+            members = self.channels.get(channel)
+            if members is None:
+                return
+            members.discard(id)
+            if not members:
+                del self.channels[channel]
+
+    def members(self, channel):
+        # snapshot, so the fan-out does not hold the lock while writing
+        with self.lock:
+            return list(self.channels.get(channel, ()))
+
+    def sizes(self):
+        with self.lock:
+            return {channel: len(members) for channel, members in self.channels.items()}
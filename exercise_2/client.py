@@ -1,22 +1,37 @@
 import socket
+import time
 from sys import argv
 import template_pb2
 from threading import Thread
+from framing import FrameReader, send_message
+from health import Heartbeat
+import codec
+import tracing
 
 
-def send_message(conn, m):
-    serialized = m.SerializeToString()
-    conn.sendall(len(serialized).to_bytes(4, byteorder="big"))
-    conn.sendall(serialized)
+def take_option(name, default):
+    # removes `name value` from argv, so the positional arguments keep their places
+    if name not in argv:
+        return default
+    index = argv.index(name)
+    value = argv[index + 1]
+    del argv[index:index + 2]
+    return value
 
-def receive_message(conn, m):
-    msg = m()
-    size = int.from_bytes(conn.recv(4), byteorder="big")
-    data = conn.recv(size)
-    msg.ParseFromString(data)
-    return msg
 
 def main():
+    # --trace-rate R traces about R of the messages sent, receivers print where the time went
+    trace_rate = float(take_option("--trace-rate", 0))
+    # --compress asks the server to compress both directions
+    compress = "--compress" in argv
+    if compress:
+        argv.remove("--compress")
+    # --codec fixed asks the server for the fixed layout, see codec.py
+    codec_name = take_option("--codec", codec.PROTOBUF)
+    if codec_name not in codec.CODECS:
+        print(f"Invalid codec {codec_name}, expected one of: {', '.join(codec.CODECS)}")
+        return
+    requested = "" if codec_name == codec.PROTOBUF else codec_name
     host = None
     port = None
     try:
@@ -42,15 +57,18 @@ def main():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((host, port))
         print("Connected to the server")
+        reader = FrameReader(s)
         
         if new_id:
-            handshake = template_pb2.Handshake(id=new_id,change_id = True)
+            handshake = template_pb2.Handshake(id=new_id,change_id = True, batching = True, compression = compress,
+                                               codec = requested)
             send_message(s, handshake)
         else:
-            handshake = template_pb2.Handshake(change_id = False)
+            handshake = template_pb2.Handshake(change_id = False, batching = True, compression = compress,
+                                               codec = requested)
             send_message(s, handshake)
         
-        handshake = receive_message(s, template_pb2.Handshake)
+        handshake = reader.receive_message(template_pb2.Handshake)
         
         if handshake.change_id:
             print('new id accepted!')
@@ -59,32 +77,47 @@ def main():
             print('id autonoumously created')
         
         id = handshake.id
+        compress = handshake.compression
+        wire = codec.CODECS[handshake.codec or codec.PROTOBUF]
             
         if handshake.error:
             print(f"Handshake failed")
             return
 
-        Thread(target=handle_incoming_messages,args=(s,), daemon=True).start()
+        # a server that asks for heartbeats closes connections that stay silent for longer
+        sender = Heartbeat(s, handshake.heartbeat_ms / 1000)
+
+        # servers that know about batching answer with batching=True and send MessageBatch frames
+        Thread(target=handle_incoming_messages,args=(reader, handshake.batching, wire), daemon=True).start()
         
         while True:
             while True:
                 try:
-                    data = input("Enter a message (format: <receiver_id> <message>): \n")
+                    data = input("Enter a message (format: <receiver_id> <message>, #<channel> <message>, /join <channel> or /leave <channel>): \n")
                     data_chunked = data.split(' ', 1)
                     
                     if len(data_chunked) != 2:
                         raise ValueError("Input must be in format '<receiver_id> <message>'")
                     
-                    receiver_id = int(data_chunked[0])
-                    message = data_chunked[1]
+                    if data_chunked[0] in ("/join", "/leave"):
+                        op = template_pb2.JOIN if data_chunked[0] == "/join" else template_pb2.LEAVE
+                        msg = template_pb2.Message(fr=id, channel=data_chunked[1].lstrip('#'), op=op)
+                        message = None
+                    elif data_chunked[0].startswith('#'):
+                        message = data_chunked[1]
+                        msg = template_pb2.Message(fr=id, channel=data_chunked[0][1:], msg=message)
+                    else:
+                        message = data_chunked[1]
+                        msg = template_pb2.Message(fr=id, to=int(data_chunked[0]), msg=message)
+                    if message is not None and tracing.sampled(trace_rate):
+                        tracing.start(msg)
                     break
                     
                 except ValueError as ve:
                     print(f"Invalid input: {ve}")
                     continue
                 
-            msg = template_pb2.Message(fr=id, to=receiver_id, msg=message)
-            send_message(s, msg)
+            sender.send(wire.encode(msg), compress)
             
             if message == "end":
                 break
@@ -92,11 +125,21 @@ def main():
         print("Closing connection")
 
 
-def handle_incoming_messages(conn):
+def handle_incoming_messages(reader, batching, wire):
     print('waiting for messages...')
     while True:
-        msg = receive_message(conn, template_pb2.Message)
-        print(f"New message arrived: {msg.msg} from client #{msg.fr}")
+        if batching:
+            messages = wire.decode_batch(reader.read_frame())
+        else:
+            messages = [wire.decode(reader.read_frame())]
+        arrived_ns = time.time_ns()
+        for msg in messages:
+            if msg.channel:
+                print(f"New message arrived in #{msg.channel}: {msg.msg} from client #{msg.fr}")
+            else:
+                print(f"New message arrived: {msg.msg} from client #{msg.fr}")
+            if msg.HasField("trace"):
+                print(tracing.report(msg.trace, arrived_ns))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,214 @@
+# Links between the servers that together form one chat network: the worker
+# processes of one server started with --workers N, or the nodes of a
+# federation started with --nodes.
+#
+# Every member listens on its endpoint (a unix socket path or a (host, port)
+# TCP address) for ClusterFrames and keeps one outgoing link to every other
+# endpoint, reconnecting when it drops; frames a broken link did not write go
+# out first on the next one. Members tell each other which client ids they
+# own, so a message for a client connected elsewhere is forwarded there as raw
+# bytes. Offline messages live on the receiver's home member,
+# id % members, and channel messages are sent to the channel's home member,
+# which fans them out.
+
+__all__ = ["Cluster", "endpoint_path", "parse_address"]
+
+import os
+import socket
+import tempfile
+import time
+from threading import Lock, Thread
+
+import template_pb2
+from framing import FrameReader
+from outbound import ClientWriter, BLOCK, OVERFLOW
+import logs
+
+# frames queued per link; senders never wait, past this frames go to the writer's overflow, and a
+# link that falls outbound.MAX_OVERFLOW frames further behind is reset, its frames going out again
+# on the next link
+LINK_QUEUE = 64 * 1024
+RECONNECT_DELAY = 0.5  # seconds between attempts to reach another member
+LOG = logs.get("cluster")
+
+
+def endpoint_path(port, endpoint):
+    return os.path.join(tempfile.gettempdir(), f"chat-server-{port}-{endpoint}.sock")
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+def open_socket(endpoint):
+    if isinstance(endpoint, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+
+def without_membership(payloads):
+    # frames of a broken link worth sending again: the next link starts with a fresh
+    # list of our clients, older joined and left updates would only contradict it
+    frames = []
+    for payload in payloads:
+        frame = template_pb2.ClusterFrame.FromString(payload)
+        del frame.joined[:]
+        del frame.left[:]
+        if frame.messages or frame.replay or frame.channel_messages:
+            frames.append(frame.SerializeToString())
+    return frames
+
+
+class Cluster:
+    # endpoints[me] is this member. The first `members` endpoints own clients,
+    # any endpoint after them (the console process of --workers) only follows
+    # membership.
+
+    def __init__(self, endpoints, me, members, on_frame=None):
+        self.endpoints = endpoints
+        self.member = me
+        self.members = members
+        self.on_frame = on_frame
+        self.owners = {}  # client id -> member it is connected to
+        self.local = set()  # client ids connected to this member
+        self.lock = Lock()  # guards owners
+        self.membership_lock = Lock()  # orders local changes against link (re)connects
+        self.announce_lock = Lock()  # joined and left frames go out in the order of the changes
+        self.links = {}  # endpoint index -> ClientWriter
+
+        endpoint = endpoints[me]
+        if isinstance(endpoint, str) and os.path.exists(endpoint):
+            os.remove(endpoint)
+        self.listener = open_socket(endpoint)
+        if not isinstance(endpoint, str):
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(endpoint)
+        self.listener.listen()
+        Thread(target=self.accept_links, daemon=True).start()
+
+    def connect(self):
+        # one outgoing link to every other endpoint, kept up in the background
+        for index in range(len(self.endpoints)):
+            if index != self.member:
+                Thread(target=self.keep_link, args=(index,), daemon=True).start()
+
+    def keep_link(self, index):
+        unsent = []  # frames the last link to this endpoint never wrote, sent first on the next one
+        while True:
+            conn = open_socket(self.endpoints[index])
+            try:
+                conn.connect(self.endpoints[index])
+            except OSError:
+                conn.close()
+                time.sleep(RECONNECT_DELAY)
+                continue
+
+            link = ClientWriter(conn, LINK_QUEUE, BLOCK)
+            # links between federated servers may cross data centers, worker links stay on this host
+            link.compress = not isinstance(self.endpoints[index], str)
+            with self.membership_lock:
+                # a fresh link starts with everything the other side has to know about us
+                link.send(template_pb2.ClusterFrame(worker=self.member, joined=self.local).SerializeToString())
+                for payload in unsent:
+                    link.send(payload, OVERFLOW)
+                self.links[index] = link
+            link.thread.join()  # returns once the link breaks
+            with self.membership_lock:
+                del self.links[index]
+            conn.close()
+            # forward() reported these frames as sent, they must not go with the link
+            unsent = without_membership(link.take_pending())
+            if unsent:
+                LOG.warning("Link to member %d broke with %d frames unsent, they go out once it is back",
+                            index, len(unsent))
+            time.sleep(RECONNECT_DELAY)
+
+    def accept_links(self):
+        while True:
+            conn, _ = self.listener.accept()
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.read_link, args=(conn,), daemon=True).start()
+
+    def read_link(self, conn):
+        reader = FrameReader(conn)
+        member = None
+        try:
+            while True:
+                frame = reader.receive_message(template_pb2.ClusterFrame)
+                member = frame.worker
+                with self.lock:
+                    for id in frame.joined:
+                        self.owners[id] = member
+                    for id in frame.left:
+                        if self.owners.get(id) == member:
+                            del self.owners[id]
+                if self.on_frame and (frame.messages or frame.replay or frame.channel_messages):
+                    self.on_frame(frame)
+        except Exception as e:
+            LOG.warning("Link from member %s closed: %s", member, e)
+        finally:
+            conn.close()
+            if member is not None:
+                # its clients are unreachable until it reconnects and announces them again
+                with self.lock:
+                    for id in [id for id, owner in self.owners.items() if owner == member]:
+                        del self.owners[id]
+
+    def send(self, index, frame):
+        # False if there is currently no link to that member
+        link = self.links.get(index)
+        if link is None:
+            return False
+        frame.worker = self.member
+        return link.send(frame.SerializeToString(), OVERFLOW)
+
+    def broadcast(self, links, frame):
+        frame.worker = self.member
+        payload = frame.SerializeToString()
+        for link in links:
+            link.send(payload, OVERFLOW)
+
+    def joined(self, id):
+        # a link that connects after the change starts with it in its list of our clients
+        with self.announce_lock:
+            with self.membership_lock:
+                self.local.add(id)
+                links = list(self.links.values())
+            self.broadcast(links, template_pb2.ClusterFrame(joined=[id]))
+
+    def left(self, id):
+        with self.announce_lock:
+            with self.membership_lock:
+                self.local.discard(id)
+                links = list(self.links.values())
+            self.broadcast(links, template_pb2.ClusterFrame(left=[id]))
+
+    def owner(self, id):
+        # member another client id is connected to, None if it is not connected anywhere else
+        return self.owners.get(id)
+
+    def home(self, id):
+        return id % self.members
+
+    def forward(self, member, payload, receivers=()):
+        # receivers: client ids that all get this payload, instead of its Message.to
+        return self.send(member, template_pb2.ClusterFrame(messages=[payload], receivers=receivers))
+
+    def store_remote(self, member, payload, receivers=()):
+        return self.send(member, template_pb2.ClusterFrame(messages=[payload], receivers=receivers, store=True))
+
+    def forward_channel(self, member, payload):
+        return self.send(member, template_pb2.ClusterFrame(channel_messages=[payload]))
+
+    def request_replay(self, member, id):
+        return self.send(member, template_pb2.ClusterFrame(replay=[id]))
+
+    def users_per_member(self):
+        counts = [0] * self.members
+        for member in list(self.owners.values()):
+            counts[member] += 1
+        return counts
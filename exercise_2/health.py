@@ -0,0 +1,136 @@
+# Connection health and admission control for the relays.
+# - Admission(max_connections, rate)  .admit() -> (refused, delay), .release()
+#   at most max_connections at once; with a rate, a burst of up to `rate`
+#   connections passes at once and later ones are spread out to `rate` per
+#   second, refused once they would wait longer than max_delay
+# - expired(clients, now) -> (id, client) of clients silent for longer than
+#   their .timeout, judged by the .last_seen the server's reader keeps
+# - keepalive(sock)  TCP keepalive and user timeout, so the kernel notices a
+#   peer that vanished even for clients that send no heartbeats
+# - Heartbeat(conn, interval)  client side: sends the client's messages and an
+#   empty frame whenever nothing else went out for `interval`
+# Servers advertise HEARTBEAT_INTERVAL in their handshake. A client that sends
+# heartbeats is given up on after HEARTBEAT_MISSES intervals of silence, others
+# only after the idle timeout, if there is one.
+
+__all__ = ["Admission", "Heartbeat", "expired", "keepalive", "default_max_connections",
+           "HEARTBEAT_INTERVAL", "HEARTBEAT_MISSES", "HANDSHAKE_TIMEOUT", "IDLE_TIMEOUT", "REAP_INTERVAL",
+           "HANDSHAKE", "HEARTBEAT", "IDLE", "MAX_CONNECTIONS", "ACCEPT_RATE"]
+
+import resource
+import socket
+import time
+from threading import Lock, Thread
+
+from framing import send_frame
+
+HEARTBEAT_INTERVAL = 2.0  # seconds, advertised to clients, 0 tells them not to send heartbeats
+HEARTBEAT_MISSES = 3  # heartbeats in a row a client may miss before its connection is closed
+HANDSHAKE_TIMEOUT = 5.0  # seconds a new connection has to send its handshake
+IDLE_TIMEOUT = 0  # seconds of silence allowed to clients without heartbeats, 0 for no limit
+REAP_INTERVAL = 0.5  # seconds between scans for silent clients
+FD_RESERVE = 64  # descriptors kept for log files, the store, metrics and cluster links
+
+KEEPALIVE_IDLE = 10  # seconds before the kernel starts probing a silent connection
+KEEPALIVE_INTERVAL = 2  # seconds between probes
+KEEPALIVE_COUNT = 3  # unanswered probes before the connection is reset
+USER_TIMEOUT = (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT) * 1000  # ms data may stay unacked
+
+# what a silent client was expected to send, the reason its connection was closed
+HANDSHAKE = "handshake"
+HEARTBEAT = "heartbeat"
+IDLE = "idle"
+
+# why a new connection was refused
+MAX_CONNECTIONS = "max_connections"
+ACCEPT_RATE = "accept_rate"
+
+
+def default_max_connections(threads_per_connection=0):
+    # as many connections as there are descriptors and, for thread-per-connection servers, threads
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0] - FD_RESERVE
+    threads = resource.getrlimit(resource.RLIMIT_NPROC)[0]
+    if threads_per_connection and threads != resource.RLIM_INFINITY:
+        limit = min(limit, (threads - FD_RESERVE) // threads_per_connection)
+    return max(limit, 1)
+
+
+class Admission:
+
+    def __init__(self, max_connections, rate=0, max_delay=HANDSHAKE_TIMEOUT):
+        self.max_connections = max_connections
+        self.rate = rate
+        self.max_delay = max_delay
+        self.lock = Lock()
+        self.active = 0
+        self.next_start = 0.0  # when the accept rate lets the next connection start, without burst
+
+    def admit(self):
+        # (None, seconds to wait before serving) for an admitted connection, (reason, 0) for a refused one
+        with self.lock:
+            if self.active >= self.max_connections:
+                return MAX_CONNECTIONS, 0
+            delay = 0.0
+            if self.rate:
+                now = time.monotonic()
+                start = max(self.next_start, now)
+                delay = max(0.0, start - 1.0 - now)  # a second worth of connections may arrive at once
+                if delay > self.max_delay:
+                    return ACCEPT_RATE, 0
+                self.next_start = start + 1.0 / self.rate
+            self.active += 1
+            return None, delay
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+
+def expired(clients, now):
+    for id, client in clients.items():
+        if client.timeout and now - client.last_seen > client.timeout:
+            yield id, client
+
+
+def keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        # keepalive only probes idle connections, this covers data written to a peer that is gone
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, USER_TIMEOUT)
+
+
+class Heartbeat:
+    # With interval 0 (a server without heartbeats) it only sends the messages.
+
+    def __init__(self, conn, interval):
+        self.conn = conn
+        self.interval = interval
+        self.lock = Lock()  # a heartbeat must not land in the middle of a message
+        self.last_sent = float("-inf")  # the first heartbeat goes out right away
+        if interval:
+            Thread(target=self.run, daemon=True).start()
+
+    def send(self, payload, compress=False):
+        with self.lock:
+            send_frame(self.conn, payload, compress)
+            self.last_sent = time.monotonic()
+
+    def send_message(self, m, compress=False):
+        self.send(m.SerializeToString(), compress)
+
+    def run(self):
+        while True:
+            with self.lock:
+                idle = time.monotonic() - self.last_sent
+                if idle >= self.interval:
+                    try:
+                        send_frame(self.conn, b"")
+                    except OSError:
+                        return
+                    self.last_sent = time.monotonic()
+                    idle = 0
+            time.sleep(self.interval - idle)
@@ -0,0 +1,328 @@
+# Stores for messages addressed to receivers that are not connected.
+# - MemoryStore()                                   in-process queues, lost on restart
+# - SegmentStore(directory, ram_budget, segment_size) append-only segment log on disk
+#
+# Both store serialized Message payloads and share one interface:
+#   store(receiver_id, payload)
+#   replay(receiver_id) -> iterator of payloads, oldest first. A payload counts
+#                          as delivered once the consumer asks for the next one,
+#                          so breaking out of the loop keeps the current payload.
+#   pending(receiver_id) -> number of stored payloads
+#   backlog() -> {receiver_id: number of stored payloads}
+
+__all__ = ["MemoryStore", "SegmentStore"]
+
+import mmap
+import os
+import struct
+from collections import deque
+from threading import Event, Lock, RLock, Thread
+
+SEGMENT_SIZE = 16 * 1024 * 1024  # bytes per segment file before rotating
+RAM_BUDGET = 64 * 1024 * 1024  # bytes of payload kept in memory, the rest is read back from disk
+COMPACT_RATIO = 0.25  # sealed segments with less live data than this get rewritten
+
+# record: [1B type || 8B sequence || 8B receiver || 4B length || payload]
+HEADER = struct.Struct(">BQqI")
+MESSAGE_RECORD = 0
+ACK_RECORD = 1  # everything for `receiver` up to `sequence` was delivered, no payload
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self.messages = {}
+        self.lock = Lock()
+
+    def store(self, receiver_id, payload):
+        with self.lock:
+            self.messages.setdefault(receiver_id, deque()).append(payload)
+
+    def replay(self, receiver_id):
+        with self.lock:
+            payloads = self.messages.pop(receiver_id, None)
+        if not payloads:
+            return
+        try:
+            while payloads:
+                yield payloads[0]
+                payloads.popleft()
+        finally:
+            if payloads:
+                self._put_back(receiver_id, payloads)
+
+    def _put_back(self, receiver_id, payloads):
+        with self.lock:
+            newer = self.messages.get(receiver_id)
+            if newer:
+                payloads.extend(newer)
+            self.messages[receiver_id] = payloads
+
+    def pending(self, receiver_id):
+        return len(self.messages.get(receiver_id, ()))
+
+    def backlog(self):
+        return {receiver_id: len(payloads) for receiver_id, payloads in list(self.messages.items())}
+
+
+class Entry:
+    # location of one stored payload, payload is set while it is cached in RAM
+    __slots__ = ("sequence", "segment", "offset", "length", "payload")
+
+    def __init__(self, sequence, segment, offset, length, payload=None):
+        self.sequence = sequence
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.payload = payload
+
+
+class SegmentStore:
+    # Every payload is appended to the active segment file before store() returns.
+    # The per-receiver index lives in memory and points into the segments.
+    # Payloads are also cached in RAM until ram_budget is used up; later ones
+    # are only on disk and replay reads them back through mmap.
+    # Segments whose payloads were all delivered are deleted, and sparse ones
+    # are compacted into the active segment after it rotates, by a background
+    # thread that takes the lock for one receiver at a time.
+
+    def __init__(self, directory, ram_budget=RAM_BUDGET, segment_size=SEGMENT_SIZE, fsync=False):
+        self.directory = directory
+        self.ram_budget = ram_budget
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = RLock()  # compact() reads through read() while holding it
+
+        self.index = {}  # receiver -> deque of Entry, oldest first
+        self.acked = {}  # receiver -> last delivered sequence, while records it covers are on disk
+        self.ack_segment = {}  # receiver -> segment holding its latest ack record
+        self.records = {}  # segment -> receivers with message records in it, delivered or not
+        self.live = {}  # segment -> number of undelivered entries
+        self.live_bytes = {}  # segment -> bytes of undelivered payloads
+        self.maps = {}  # segment -> mmap used by replay
+        self.ram_used = 0
+        self.next_sequence = 1
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+        self.active = max(self.live, default=0) + 1
+        self.file = open(self.segment_path(self.active), "ab")
+        self.active_size = 0
+        self.live[self.active] = 0
+        self.live_bytes[self.active] = 0
+        self.records[self.active] = set()
+        self.delete_dead_segments()
+
+        self.compaction_due = Event()
+        Thread(target=self.run_compactions, daemon=True).start()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:08d}.log")
+
+    def segments_on_disk(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".log"):
+                segments.append(int(name[len("segment-"):-len(".log")]))
+        return sorted(segments)
+
+    def recover(self):
+        # rebuild the index from the segments left by a previous run
+        found = {}
+        for segment in self.segments_on_disk():
+            self.live[segment] = 0
+            self.live_bytes[segment] = 0
+            self.records[segment] = set()
+            path = self.segment_path(segment)
+            size = os.path.getsize(path)
+            if size == 0:
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                offset = 0
+                while offset + HEADER.size <= size:
+                    kind, sequence, receiver, length = HEADER.unpack_from(m, offset)
+                    if offset + HEADER.size + length > size:
+                        break
+                    if kind == MESSAGE_RECORD:
+                        found.setdefault(receiver, []).append(Entry(sequence, segment, offset + HEADER.size, length))
+                        self.records[segment].add(receiver)
+                    elif sequence >= self.acked.get(receiver, 0):
+                        self.acked[receiver] = sequence
+                        self.ack_segment[receiver] = segment
+                    self.next_sequence = max(self.next_sequence, sequence + 1)
+                    offset += HEADER.size + length
+            if offset < size:
+                # a record cut short by a crash, drop it
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+
+        for receiver, entries in found.items():
+            acked = self.acked.get(receiver, 0)
+            entries = sorted((e for e in entries if e.sequence > acked), key=lambda e: e.sequence)
+            if entries:
+                self.index[receiver] = deque(entries)
+            for entry in entries:
+                self.live[entry.segment] += 1
+                self.live_bytes[entry.segment] += entry.length
+
+    def append(self, kind, sequence, receiver, payload=b""):
+        # caller holds the lock, returns the offset of the payload in the active segment
+        self.file.write(HEADER.pack(kind, sequence, receiver, len(payload)) + payload)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        offset = self.active_size + HEADER.size
+        self.active_size += HEADER.size + len(payload)
+        return offset
+
+    def store(self, receiver_id, payload):
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            offset = self.append(MESSAGE_RECORD, sequence, receiver_id, payload)
+
+            entry = Entry(sequence, self.active, offset, len(payload))
+            if self.ram_used + len(payload) <= self.ram_budget:
+                entry.payload = payload
+                self.ram_used += len(payload)
+            self.index.setdefault(receiver_id, deque()).append(entry)
+            self.records[self.active].add(receiver_id)
+            self.live[self.active] += 1
+            self.live_bytes[self.active] += len(payload)
+
+            if self.active_size >= self.segment_size:
+                self.rotate()
+
+    def replay(self, receiver_id):
+        with self.lock:
+            entries = self.index.pop(receiver_id, None)
+        if not entries:
+            return
+        delivered = 0
+        try:
+            while entries:
+                entry = entries[0]
+                yield entry.payload if entry.payload is not None else self.read(entry)
+                entries.popleft()
+                delivered = entry.sequence
+                with self.lock:
+                    self.release(entry)
+        finally:
+            with self.lock:
+                if entries:
+                    newer = self.index.get(receiver_id)
+                    if newer:
+                        entries.extend(newer)
+                    self.index[receiver_id] = entries
+                if delivered:
+                    # one ack record for the whole replay instead of one per payload
+                    self.acked[receiver_id] = delivered
+                    self.ack_segment[receiver_id] = self.active
+                    self.append(ACK_RECORD, delivered, receiver_id)
+                self.delete_dead_segments()
+
+    def read(self, entry):
+        with self.lock:
+            m = self.maps.get(entry.segment)
+            if m is None or len(m) < entry.offset + entry.length:
+                # the active segment keeps growing, map it again to see the new records
+                with open(self.segment_path(entry.segment), "rb") as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                old = self.maps.get(entry.segment)
+                self.maps[entry.segment] = m
+                if old is not None:
+                    old.close()
+            return m[entry.offset : entry.offset + entry.length]
+
+    def release(self, entry):
+        # caller holds the lock
+        self.live[entry.segment] -= 1
+        self.live_bytes[entry.segment] -= entry.length
+        if entry.payload is not None:
+            self.ram_used -= entry.length
+            entry.payload = None
+
+    def rotate(self):
+        # caller holds the lock
+        self.file.close()
+        self.active += 1
+        self.file = open(self.segment_path(self.active), "ab")
+        self.active_size = 0
+        self.live[self.active] = 0
+        self.live_bytes[self.active] = 0
+        self.records[self.active] = set()
+        self.delete_dead_segments()
+        self.compaction_due.set()
+
+    def run_compactions(self):
+        while True:
+            self.compaction_due.wait()
+            self.compaction_due.clear()
+            self.compact()
+
+    def compact(self):
+        # move what is left in sparse sealed segments to the active one, so they can be deleted;
+        # store() and replay() get the lock in between receivers
+        with self.lock:
+            sparse = {
+                segment for segment, live in self.live.items()
+                if segment != self.active and live and self.live_bytes[segment] < self.segment_size * COMPACT_RATIO
+            }
+            receivers = list(self.index) if sparse else []
+        for receiver in receivers:
+            with self.lock:
+                if self.file.closed:
+                    return
+                for entry in self.index.get(receiver, ()):
+                    if entry.segment not in sparse:
+                        continue
+                    payload = entry.payload if entry.payload is not None else self.read(entry)
+                    self.live[entry.segment] -= 1
+                    self.live_bytes[entry.segment] -= entry.length
+                    entry.segment = self.active
+                    entry.offset = self.append(MESSAGE_RECORD, entry.sequence, receiver, payload)
+                    self.records[self.active].add(receiver)
+                    self.live[self.active] += 1
+                    self.live_bytes[self.active] += entry.length
+        if receivers:
+            with self.lock:
+                if not self.file.closed:
+                    self.delete_dead_segments()
+
+    def delete_dead_segments(self):
+        # caller holds the lock
+        dead = [segment for segment, live in self.live.items() if live == 0 and segment != self.active]
+        if not dead:
+            return
+        # an ack only matters while records it covers are left on disk: forget the others,
+        # and rewrite the ones that would go with a deleted segment before deleting it
+        kept = set().union(*(receivers for segment, receivers in self.records.items() if segment not in dead))
+        for receiver in list(self.acked):
+            if receiver not in kept:
+                del self.acked[receiver]
+                del self.ack_segment[receiver]
+            elif self.ack_segment[receiver] in dead:
+                self.append(ACK_RECORD, self.acked[receiver], receiver)
+                self.ack_segment[receiver] = self.active
+        for segment in dead:
+            m = self.maps.pop(segment, None)
+            if m is not None:
+                m.close()
+            os.remove(self.segment_path(segment))
+            del self.live[segment]
+            del self.live_bytes[segment]
+            del self.records[segment]
+
+    def pending(self, receiver_id):
+        return len(self.index.get(receiver_id, ()))
+
+    def backlog(self):
+        return {receiver_id: len(entries) for receiver_id, entries in list(self.index.items())}
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            for m in self.maps.values():
+                m.close()
+            self.maps.clear()
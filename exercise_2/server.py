@@ -1,67 +1,180 @@
+import asyncio
+import os
+import signal
 import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from sys import argv
 from threading import Thread
 import template_pb2
-from queue import Queue
+from channels import Channels, channel_home
+from cluster import Cluster, endpoint_path, parse_address
+from framing import FrameReader, decode_frame, encode_frame, frame_size, send_frame
+from metrics import Registry, format_labels, serve
+from outbound import AsyncClientWriter, ClientWriter, MAX_QUEUE, BLOCK, POLICIES, OVERFLOW
+from offline_store import MemoryStore, SegmentStore, RAM_BUDGET
+from registry import ClientRegistry
+import codec
+import tracing
+import health
+import logs
 
-CLIENTS = {}
-MESSAGES = {}
-LAST_ID = 0
+CLIENTS = ClientRegistry()  # workers hand out interleaved ids: worker i uses i, i + N, i + 2N, ...
+MESSAGES = MemoryStore()
+CHANNELS = Channels()
+QUEUE_SIZE = MAX_QUEUE
+QUEUE_POLICY = BLOCK
+COMPRESSION = True  # granted to clients that ask in the Handshake, off with --no-compression
+FIXED_CODEC = True  # codec.FIXED granted to clients that ask in the Handshake, off with --no-fixed-codec
+HEARTBEAT = health.HEARTBEAT_INTERVAL  # asked of clients in the Handshake, seconds
+HANDSHAKE_TIMEOUT = health.HANDSHAKE_TIMEOUT
+IDLE_TIMEOUT = health.IDLE_TIMEOUT  # for clients that send no heartbeats
+ADMISSION = None  # health.Admission, set up in main
+CLUSTER = None  # set in worker processes started with --workers and in federated nodes
+LOOP = None  # event loop of the asyncio mode, for deliveries coming from other threads
+STORE_THREAD = None  # asyncio mode with --store-dir: runs the SegmentStore disk I/O off the event loop
+REPLAY_BATCH = 256  # stored messages read per trip to STORE_THREAD
 
-def send_message(conn, m):
-    serialized = m.SerializeToString()
-    conn.sendall(len(serialized).to_bytes(4, byteorder="big"))
-    conn.sendall(serialized)
+METRICS = Registry()
+CONNECTIONS = METRICS.counter("relay_connections_total", "Client connections accepted")
+ID_CHANGES_REJECTED = METRICS.counter("relay_id_changes_rejected_total", "Requested ids that were already in use")
+RECEIVED = METRICS.counter("relay_messages_received_total", "Messages read from clients")
+QUEUED = METRICS.counter("relay_messages_queued_total", "Messages queued for a connected receiver")
+FORWARDED = METRICS.counter("relay_messages_forwarded_total", "Messages passed to the worker or node of their receiver")
+STORED = METRICS.counter("relay_messages_stored_total", "Messages kept for offline receivers")
+REPLAYED = METRICS.counter("relay_messages_replayed_total", "Stored messages sent to a receiver that connected")
+DROPPED_SLOW = METRICS.counter("relay_messages_dropped_total", "Messages not delivered", {"reason": "slow_receiver"})
+REROUTED = METRICS.counter("relay_messages_rerouted_total",
+                           "Messages queued for a client that went away, stored for its next connection")
+HEARTBEATS = METRICS.counter("relay_heartbeats_total", "Heartbeats read from clients")
+REFUSED = {reason: METRICS.counter("relay_connections_refused_total", "Connections refused by admission control",
+                                   {"reason": reason}) for reason in (health.MAX_CONNECTIONS, health.ACCEPT_RATE)}
+TIMED_OUT = {reason: METRICS.counter("relay_connections_timed_out_total", "Connections closed after the client went silent",
+                                     {"reason": reason}) for reason in (health.HANDSHAKE, health.HEARTBEAT, health.IDLE)}
+ROUTE_SECONDS = METRICS.histogram("relay_route_seconds",
+                                  "Time from reading a message to queueing, forwarding or storing it")
+METRICS.gauge("relay_clients", "Connected clients", lambda: len(CLIENTS))
+METRICS.gauge("relay_connections_open", "Connections admitted and not closed yet", lambda: ADMISSION.active)
+METRICS.gauge("relay_queued_frames", "Frames waiting in the outbound queues",
+              lambda: sum(client.depth() for client in CLIENTS.values()))
+METRICS.gauge("relay_backlog_messages", "Messages stored for offline receivers",
+              lambda: sum(MESSAGES.backlog().values()))
+METRICS.gauge("relay_backlog_receivers", "Offline receivers with stored messages",
+              lambda: sum(1 for pending in MESSAGES.backlog().values() if pending))
+METRICS.gauge("relay_channels", "Channels with at least one member", lambda: len(CHANNELS.sizes()))
+METRICS.gauge("relay_log_records_dropped", "Log records dropped because the log queue was full",
+              lambda: logs.stats()["dropped"])
 
-def receive_message(conn, m):
+CONNECTION_LOG = logs.get("connections")
+MESSAGE_LOG = logs.get("messages")
+DROP_LOG = logs.get("drops")
+CHANNEL_LOG = logs.get("channels")
+STORE_LOG = logs.get("store")
+ADMISSION_LOG = logs.get("admission")
+LOG_RATES = {"drops": 10, "admission": 10}  # records/s, a receiver that went away or a flood would fill the log
+
+def get_option(name, default):
+    if name in argv:
+        return argv[argv.index(name) + 1]
+    return default
+
+async def receive_frame_async(reader: asyncio.StreamReader):
+    size = int.from_bytes(await reader.readexactly(4), byteorder="big")
+    data = await reader.readexactly(frame_size(size))
+    return decode_frame(size, data)
+
+async def receive_message_async(reader: asyncio.StreamReader, m):
     msg = m()
-    size = int.from_bytes(conn.recv(4), byteorder="big")
-    data = conn.recv(size)
-    msg.ParseFromString(data)
+    msg.ParseFromString(await receive_frame_async(reader))
     return msg
 
-def change_client_id(id, conn):
-    if CLIENTS.get(id):
+def change_client_id(id, client):
+    # claims id for client, unless it is connected here or on another member
+    if CLUSTER and CLUSTER.owner(id) is not None:
         return False
-    else:
-        CLIENTS[id] = conn
-        return True
+    return CLIENTS.reserve(id, client)
+
+def held_elsewhere(id):
+    # the counter of this member hands out id, but a client elsewhere claimed it as desired id
+    return CLUSTER is not None and CLUSTER.owner(id) is not None
 
 def handle_client(conn: socket.socket, addr):
-    global LAST_ID
-    id = LAST_ID
-    LAST_ID += 1
-    CLIENTS[id] = conn
+    client = ClientWriter(conn, QUEUE_SIZE, QUEUE_POLICY)
+    id = CLIENTS.register(client)
+    CONNECTIONS.inc()
+    reader = FrameReader(conn)
+    client.timeout, client.waiting_for = HANDSHAKE_TIMEOUT, health.HANDSHAKE
+    replies = []  # handshake frames, the only frames queued for the client that are not messages
 
     try:
-        handshake_message = receive_message(conn, template_pb2.Handshake)
+        handshake_message = reader.receive_message(template_pb2.Handshake)
         
         if handshake_message.change_id:
             new_id = handshake_message.id
-            if change_client_id(new_id, conn):
+            if change_client_id(new_id, client):
+                CLIENTS.remove(id, client)
+                id = new_id
                 handshake = template_pb2.Handshake(id=new_id, error=False, change_id=True)
-                print(f"Client requested ID {new_id}. ID change successful from {addr}")
+                CONNECTION_LOG.info("Client requested ID %d. ID change successful from %s", new_id, addr)
             else:
+                ID_CHANGES_REJECTED.inc()
                 handshake = template_pb2.Handshake(id=id, error=False, change_id=False)
-                print(f"Client requested ID {new_id}. ID change failed, already in use assigning default")
+                CONNECTION_LOG.info("Client requested ID %d. ID change failed, already in use assigning default", new_id)
                 
         else:
             handshake = template_pb2.Handshake(id=id, error=False, change_id=False)
-            print(f"Client connected with default ID {id} from {addr}.")
+            CONNECTION_LOG.info("Client connected with default ID %d from %s.", id, addr)
 
-        send_message(conn, handshake)
+        handshake.batching = handshake_message.batching
+        handshake.compression = handshake_message.compression and COMPRESSION
+        handshake.heartbeat_ms = int(HEARTBEAT * 1000)
+        handshake.codec = negotiate_codec(handshake_message.codec)
+        replies.append(handshake.SerializeToString())
+        if handshake.batching:
+            client.switch_to_batches(replies[-1])  # backlog replay and bursts go out as MessageBatch frames
+        else:
+            client.send(replies[-1])
+        client.compress = handshake.compression
+        client.codec = handshake.codec or codec.PROTOBUF
+        client.timeout, client.waiting_for = IDLE_TIMEOUT, health.IDLE
+        if CLUSTER:
+            CLUSTER.joined(id)
 
-        deliver_stored_messages(id, conn)  # deliver stored messages if any
+        deliver_stored_messages(id, client)  # deliver stored messages if any
 
     except Exception as e:
-        print(f"Error handling client #{id}: {e}")
-        handshake_failed = template_pb2.Handshake(id=-1, error=True)
-        send_message(conn, handshake_failed)
+        log_client_error(id, client, e)
+        replies.append(template_pb2.Handshake(id=-1, error=True).SerializeToString())
+        client.send(replies[-1])
 
     try:
         while True:
-            msg = receive_message(conn, template_pb2.Message)
-            print(f"Message from {msg.fr} to {msg.to}: {msg.msg}")
+            frame = reader.read_frame()
+            start = client.last_seen = time.perf_counter()
+            if not frame:
+                note_heartbeat(client)
+                continue
+            RECEIVED.inc()
+            client.received += 1
+            if FIXED_CODEC and codec.is_fixed(frame):
+                to, payload = read_fixed(frame)
+                if payload is None:
+                    break
+                receiver = route_payload(to, payload)
+                if receiver:
+                    if receiver.send(payload):
+                        QUEUED.inc()
+                    else:
+                        undelivered(to, receiver, payload)
+                ROUTE_SECONDS.observe(time.perf_counter() - start)
+                continue
+
+            msg = template_pb2.Message.FromString(frame)
+            if msg.HasField("trace"):
+                tracing.stamp(msg, "relay", node_id())
+            if MESSAGE_LOG.enabled(logs.DEBUG):
+                MESSAGE_LOG.debug("Message from %d to %d: %s", msg.fr, msg.to, msg.msg)
 
             if msg.msg.lower() == "end":
                 break
@@ -69,74 +182,765 @@ def handle_client(conn: socket.socket, addr):
             if msg.msg == '':
                 msg.msg = 'empty string'
 
-            receiver_conn = CLIENTS.get(msg.to)
-            if receiver_conn:
-                send_message(receiver_conn, msg)
-            else:
-                store_message(msg.to, msg)
+            if msg.channel:
+                receivers, payload = route_channel_message(msg)
+                for member_id, receiver in receivers:
+                    if receiver.send(payload):
+                        QUEUED.inc()
+                    else:
+                        undelivered(member_id, receiver, payload)
+                ROUTE_SECONDS.observe(time.perf_counter() - start)
+                continue
+
+            receiver = route_message(msg)
+            if receiver:
+                if receiver.send_message(msg):
+                    QUEUED.inc()
+                else:
+                    undelivered(msg.to, receiver, msg.SerializeToString())
+            ROUTE_SECONDS.observe(time.perf_counter() - start)
 
     except Exception as e:
-        print(f"Error handling client #{id}: {e}")
+        log_client_error(id, client, e)
     finally:
-        print(f"Closing connection to client #{id}")
-        CLIENTS.pop(id, None)
+        CONNECTION_LOG.info("Closing connection to client #%d", id)
+        CLIENTS.remove(id, client)
+        if CLUSTER:
+            CLUSTER.left(id)
+        client.close()
+        store_undelivered(id, client, replies)
         conn.close()
 
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # same protocol as handle_client, but one coroutine per client instead of one thread
+    client = AsyncClientWriter(writer, QUEUE_SIZE, QUEUE_POLICY)
+    id = CLIENTS.register(client)
+    CONNECTIONS.inc()
+    addr = writer.get_extra_info("peername")
+    client.timeout, client.waiting_for = HANDSHAKE_TIMEOUT, health.HANDSHAKE
+    replies = []
+
+    try:
+        handshake_message = await receive_message_async(reader, template_pb2.Handshake)
+
+        if handshake_message.change_id:
+            new_id = handshake_message.id
+            if change_client_id(new_id, client):
+                CLIENTS.remove(id, client)
+                id = new_id
+                handshake = template_pb2.Handshake(id=new_id, error=False, change_id=True)
+                CONNECTION_LOG.info("Client requested ID %d. ID change successful from %s", new_id, addr)
+            else:
+                ID_CHANGES_REJECTED.inc()
+                handshake = template_pb2.Handshake(id=id, error=False, change_id=False)
+                CONNECTION_LOG.info("Client requested ID %d. ID change failed, already in use assigning default", new_id)
+
+        else:
+            handshake = template_pb2.Handshake(id=id, error=False, change_id=False)
+            CONNECTION_LOG.info("Client connected with default ID %d from %s.", id, addr)
+
+        handshake.batching = handshake_message.batching
+        handshake.compression = handshake_message.compression and COMPRESSION
+        handshake.heartbeat_ms = int(HEARTBEAT * 1000)
+        handshake.codec = negotiate_codec(handshake_message.codec)
+        replies.append(handshake.SerializeToString())
+        if handshake.batching:
+            await client.switch_to_batches(replies[-1])
+        else:
+            await client.send(replies[-1])
+        client.compress = handshake.compression
+        client.codec = handshake.codec or codec.PROTOBUF
+        client.timeout, client.waiting_for = IDLE_TIMEOUT, health.IDLE
+        if CLUSTER:
+            CLUSTER.joined(id)
+
+        await deliver_stored_messages_async(id, client)  # deliver stored messages if any
+
+    except Exception as e:
+        log_client_error(id, client, e)
+        replies.append(template_pb2.Handshake(id=-1, error=True).SerializeToString())
+        await client.send(replies[-1])
+
+    try:
+        while True:
+            frame = await receive_frame_async(reader)
+            start = client.last_seen = time.perf_counter()
+            if not frame:
+                note_heartbeat(client)
+                continue
+            RECEIVED.inc()
+            client.received += 1
+            if FIXED_CODEC and codec.is_fixed(frame):
+                to, payload = read_fixed(frame)
+                if payload is None:
+                    break
+                receiver = route_payload(to, payload)
+                if receiver:
+                    if await receiver.send(payload):
+                        QUEUED.inc()
+                    else:
+                        undelivered(to, receiver, payload)
+                ROUTE_SECONDS.observe(time.perf_counter() - start)
+                continue
+
+            msg = template_pb2.Message.FromString(frame)
+            if msg.HasField("trace"):
+                tracing.stamp(msg, "relay", node_id())
+            if MESSAGE_LOG.enabled(logs.DEBUG):
+                MESSAGE_LOG.debug("Message from %d to %d: %s", msg.fr, msg.to, msg.msg)
+
+            if msg.msg.lower() == "end":
+                break
+
+            if msg.msg == '':
+                msg.msg = 'empty string'
+
+            if msg.channel:
+                receivers, payload = route_channel_message(msg)
+                for member_id, receiver in receivers:
+                    if await receiver.send(payload):
+                        QUEUED.inc()
+                    else:
+                        undelivered(member_id, receiver, payload)
+                ROUTE_SECONDS.observe(time.perf_counter() - start)
+                continue
+
+            receiver = route_message(msg)
+            if receiver:
+                if await receiver.send_message(msg):
+                    QUEUED.inc()
+                else:
+                    undelivered(msg.to, receiver, msg.SerializeToString())
+            ROUTE_SECONDS.observe(time.perf_counter() - start)
+
+    except Exception as e:
+        log_client_error(id, client, e)
+    finally:
+        CONNECTION_LOG.info("Closing connection to client #%d", id)
+        CLIENTS.remove(id, client)
+        if CLUSTER:
+            CLUSTER.left(id)
+        client.close()
+        store_undelivered(id, client, replies)
+        writer.close()
+
+def log_client_error(id, client, e):
+    # connections the server closed itself, silent clients and those too far behind, are no error
+    if client.closed:
+        CONNECTION_LOG.info("Connection to client #%d closed: %s", id, e)
+    else:
+        CONNECTION_LOG.error("Error handling client #%d: %s", id, e)
+
+def note_heartbeat(client):
+    # the first heartbeat shows the client sends them, from then on it may only miss a few
+    HEARTBEATS.inc()
+    if client.waiting_for != health.HEARTBEAT:
+        client.timeout = HEARTBEAT * health.HEARTBEAT_MISSES
+        client.waiting_for = health.HEARTBEAT
+
+def undelivered(receiver_id, receiver, payload):
+    # a receiver on its way out refused the message, it waits in storage for the next connection;
+    # one that is only not keeping up loses it
+    if receiver.closed:
+        reroute(receiver_id, payload)
+    else:
+        DROPPED_SLOW.inc()
+        DROP_LOG.warning("Client #%d is not keeping up. Dropping message.", receiver_id)
+
+def store_undelivered(client_id, client, replies):
+    # what was still queued for a client that went away, dead connections included
+    for payload in client.take_pending():
+        if not any(payload is reply for reply in replies):
+            reroute(client_id, payload)
+
+def reroute(receiver_id, payload):
+    REROUTED.inc()
+    store_payload(receiver_id, tracing.stamp_payload(payload, "stored", node_id(), template_pb2.Message))
+
+def negotiate_codec(requested):
+    # the codec named in the Handshake reply, "" for protobuf
+    if requested == codec.FIXED and FIXED_CODEC:
+        return requested
+    return ""
+
+def read_fixed(frame):
+    # (to, payload) of a fixed layout message, (to, None) for "end"; the payload is passed on as it came in
+    to, fr, _ = codec.check(frame)
+    if MESSAGE_LOG.enabled(logs.DEBUG):
+        MESSAGE_LOG.debug("Message from %d to %d: %s", fr, to, codec.text(frame))
+    if codec.is_end(frame):
+        return to, None
+    if len(frame) == codec.HEADER_SIZE:
+        return to, bytes(frame) + b"empty string"
+    return to, bytes(frame)
+
+def node_id():
+    # the worker or federation member stamping a trace, 0 for a single server
+    return CLUSTER.member if CLUSTER else 0
+
+def route_message(msg):
+    # local client the message should be written to, None once it was forwarded or stored
+    receiver = CLIENTS.get(msg.to)
+    if receiver:
+        return receiver
+
+    owner = CLUSTER.owner(msg.to) if CLUSTER else None
+    if owner is not None:
+        if msg.HasField("trace"):
+            tracing.stamp(msg, "forwarded", node_id())
+        if CLUSTER.forward(owner, msg.SerializeToString()):
+            FORWARDED.inc()
+            return None
+    store_message(msg.to, msg)
+    return None
+
+def route_payload(receiver_id, payload):
+    # route_message for a payload that was not decoded, fixed layout payloads carry no trace
+    receiver = CLIENTS.get(receiver_id)
+    if receiver:
+        return receiver
+
+    owner = CLUSTER.owner(receiver_id) if CLUSTER else None
+    if owner is not None and CLUSTER.forward(owner, payload):
+        FORWARDED.inc()
+        return None
+    store_payload(receiver_id, payload)
+    return None
+
+def route_channel_message(msg):
+    # the message is serialized once and the same bytes go to every member,
+    # returns the (id, client) pairs of local members that still have to be written to
+    payload = msg.SerializeToString()
+    if CLUSTER:
+        home = channel_home(msg.channel, CLUSTER.members)
+        if home != CLUSTER.member:
+            if not CLUSTER.forward_channel(home, payload):
+                DROP_LOG.warning("Channel #%s is unavailable, member %d cannot be reached. Dropping message.",
+                                 msg.channel, home)
+            return [], payload
+    return apply_channel_message(msg, payload), payload
+
+def apply_channel_message(msg, payload):
+    # runs on the channel's home member
+    if msg.op == template_pb2.JOIN:
+        CHANNELS.join(msg.channel, msg.fr)
+        CHANNEL_LOG.info("Client #%d joined channel #%s", msg.fr, msg.channel)
+        return []
+    if msg.op == template_pb2.LEAVE:
+        CHANNELS.leave(msg.channel, msg.fr)
+        CHANNEL_LOG.info("Client #%d left channel #%s", msg.fr, msg.channel)
+        return []
+
+    local = []
+    remote = {}  # member -> ids of channel members connected there
+    offline = []
+    for member_id in CHANNELS.members(msg.channel):
+        if member_id == msg.fr:
+            continue
+        client = CLIENTS.get(member_id)
+        if client:
+            local.append((member_id, client))
+            continue
+        owner = CLUSTER.owner(member_id) if CLUSTER else None
+        if owner is None:
+            offline.append(member_id)
+        else:
+            remote.setdefault(owner, []).append(member_id)
+
+    for owner, member_ids in remote.items():
+        # one frame per member for all of its clients in the channel
+        if CLUSTER.forward(owner, payload, member_ids):
+            FORWARDED.inc()
+        else:
+            offline.extend(member_ids)
+    store_payloads(offline, payload)
+    return local
+
 def store_message(receiver_id, msg):
-    if receiver_id in MESSAGES:
-        MESSAGES[receiver_id].put(msg)
+    if msg.HasField("trace"):
+        tracing.stamp(msg, "stored", node_id())
+    store_payload(receiver_id, msg.SerializeToString())
+
+def store_payload(receiver_id, payload):
+    # with --workers or --nodes, offline messages are kept by the receiver's home member,
+    # they stay here only while that member cannot be reached
+    if CLUSTER and CLUSTER.home(receiver_id) != CLUSTER.member:
+        if CLUSTER.store_remote(CLUSTER.home(receiver_id), payload):
+            FORWARDED.inc()
+            return
+    store_offline(receiver_id, payload)
+
+def store_payloads(receiver_ids, payload):
+    # the same payload for several offline receivers, one store frame per home member
+    homes = {}
+    for receiver_id in receiver_ids:
+        home = CLUSTER.home(receiver_id) if CLUSTER else None
+        homes.setdefault(home, []).append(receiver_id)
+    for home, ids in homes.items():
+        if home is not None and home != CLUSTER.member and CLUSTER.store_remote(home, payload, ids):
+            FORWARDED.inc()
+            continue
+        for receiver_id in ids:
+            store_offline(receiver_id, payload)
+
+def store_offline(receiver_id, payload):
+    # a single store thread keeps the stores in order, and ahead of any replay asked for after them
+    if STORE_THREAD:
+        STORE_THREAD.submit(MESSAGES.store, receiver_id, payload).add_done_callback(store_failed)
     else:
-        MESSAGES[receiver_id] = Queue()
-        MESSAGES[receiver_id].put(msg)
-
-def deliver_stored_messages(client_id, client_conn):
-    if client_id in MESSAGES:
-        while not MESSAGES[client_id].empty():
-            stored_message = MESSAGES[client_id].get()
-            send_message(client_conn, stored_message)
+        MESSAGES.store(receiver_id, payload)
+    STORED.inc()
+
+def store_failed(future):
+    if future.exception():
+        STORE_LOG.warning("Could not store a message: %s", future.exception())
+
+async def in_store_thread(function, *args):
+    if not STORE_THREAD:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(STORE_THREAD, function, *args)
+
+def deliver_stored_messages(client_id, client):
+    # streamed from the store, whatever the client does not accept stays stored
+    if CLUSTER and CLUSTER.home(client_id) != CLUSTER.member:
+        CLUSTER.request_replay(CLUSTER.home(client_id), client_id)
+    if MESSAGES.pending(client_id):
+        for stored_message in MESSAGES.replay(client_id):
+            stored_message = tracing.stamp_payload(stored_message, "replayed", node_id(), template_pb2.Message)
+            if not client.send(stored_message, BLOCK):
+                break
+            REPLAYED.inc()
+    else:
+        STORE_LOG.debug("No stored messages for client #%d", client_id)
+
+async def deliver_stored_messages_async(client_id, client):
+    if CLUSTER and CLUSTER.home(client_id) != CLUSTER.member:
+        CLUSTER.request_replay(CLUSTER.home(client_id), client_id)
+    if not await in_store_thread(MESSAGES.pending, client_id):
+        STORE_LOG.debug("No stored messages for client #%d", client_id)
+        return
+    replay = MESSAGES.replay(client_id)
+    try:
+        while True:
+            # the replay holds on to the last payload of a full batch, all others count as delivered
+            batch = await in_store_thread(list, islice(replay, REPLAY_BATCH))
+            if not batch:
+                return
+            for sent, stored_message in enumerate(batch):
+                stored_message = tracing.stamp_payload(stored_message, "replayed", node_id(), template_pb2.Message)
+                if not await client.send(stored_message, BLOCK):
+                    # stored again for the next connection, like whatever was queued for the client
+                    for payload in batch[sent : REPLAY_BATCH - 1]:
+                        reroute(client_id, payload)
+                    return
+                REPLAYED.inc()
+    finally:
+        await in_store_thread(replay.close)
+
+def on_cluster_frame(frame):
+    # runs on a worker link thread
+    for payload in frame.messages:
+        receiver_ids = frame.receivers or [codec.receiver(payload)]
+        for receiver_id in receiver_ids:
+            if frame.store:
+                store_offline(receiver_id, payload)
+            else:
+                deliver_forwarded(receiver_id, payload)
+
+    for payload in frame.channel_messages:
+        msg = template_pb2.Message.FromString(payload)
+        for member_id, client in apply_channel_message(msg, payload):
+            send_forwarded(member_id, client, payload)
+
+    if frame.replay:
+        # a backlog can be long, the link reader goes on with the next frame meanwhile
+        Thread(target=replay_to_member, args=(frame.worker, list(frame.replay)), daemon=True).start()
+
+def replay_to_member(member, client_ids):
+    for client_id in client_ids:
+        # stored channel copies are not addressed to client_id, so name the receiver
+        for stored_message in MESSAGES.replay(client_id):
+            stored_message = tracing.stamp_payload(stored_message, "replayed", node_id(), template_pb2.Message)
+            if not CLUSTER.forward(member, stored_message, [client_id]):
+                break
+            REPLAYED.inc()
+
+def deliver_forwarded(receiver_id, payload):
+    client = CLIENTS.get(receiver_id)
+    if client is None:
+        # left before the message arrived
+        store_payload(receiver_id, payload)
+    else:
+        send_forwarded(receiver_id, client, payload)
+
+def send_forwarded(receiver_id, client, payload):
+    # runs on a link thread, which must not wait for one slow receiver: every other
+    # message on the link queues behind it. Where the policy would block, a full queue
+    # keeps the message in the writer's overflow, in order; the other policies apply as they are
+    policy = OVERFLOW if QUEUE_POLICY == BLOCK else QUEUE_POLICY
+    if LOOP:
+        def queued(done):
+            # on the loop, once the writer took the message or refused it
+            if not done.cancelled() and done.exception() is None:
+                forwarded(receiver_id, client, payload, done.result())
+        asyncio.run_coroutine_threadsafe(client.send(payload, policy), LOOP).add_done_callback(queued)
     else:
-        print(f"No stored messages for client #{client_id}")
+        forwarded(receiver_id, client, payload, client.send(payload, policy))
+
+def forwarded(receiver_id, client, payload, queued):
+    if queued:
+        QUEUED.inc()
+    else:
+        undelivered(receiver_id, client, payload)
+
+def refusal(reason):
+    # the Handshake a refused connection gets before it is closed
+    REFUSED[reason].inc()
+    ADMISSION_LOG.warning("Refusing a connection: %s", reason)
+    return template_pb2.Handshake(id=-1, error=True).SerializeToString()
+
+def serve_client(conn: socket.socket, addr):
+    try:
+        health.keepalive(conn)
+        # replies and relayed messages are small frames, Nagle would hold them back for an ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handle_client(conn, addr)
+    finally:
+        ADMISSION.release()
+
+async def serve_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    refused, delay = ADMISSION.admit()
+    if refused:
+        writer.writelines(encode_frame(refusal(refused)))
+        writer.close()
+        return
+    try:
+        sock = writer.get_extra_info("socket")
+        health.keepalive(sock)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # as in serve_client
+        if delay:
+            await asyncio.sleep(delay)
+        await handle_client_async(reader, writer)
+    finally:
+        ADMISSION.release()
+
+def reap_silent_clients():
+    # closes the connections of clients that went silent, their readers then run the usual cleanup,
+    # which stores what was still queued for them
+    for id, client in health.expired(CLIENTS, time.perf_counter()):
+        TIMED_OUT[client.waiting_for].inc()
+        CONNECTION_LOG.info("Client #%d sent no %s for %.1fs. Closing connection.", id, client.waiting_for,
+                            client.timeout)
+        client.timeout = None
+        client.abort()
+
+def reap_forever():
+    while True:
+        time.sleep(health.REAP_INTERVAL)
+        reap_silent_clients()
+
+async def reap_forever_async():
+    while True:
+        await asyncio.sleep(health.REAP_INTERVAL)
+        reap_silent_clients()
 
 def loop_main(port):
+    Thread(target=reap_forever, daemon=True).start()
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            if CLUSTER:
+                # every worker binds the same port, the kernel spreads connections over them
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.bind(("0.0.0.0", port))
             print(f"Server started on port {port}")
             print("Waiting for a client...")
-            s.listen()
+            s.listen(socket.SOMAXCONN)
             while True:
                 try:
                     conn, addr = s.accept()
-                    Thread(target=handle_client, args=(conn, addr)).start()
                 except KeyboardInterrupt:
                     break
+                except OSError as e:
+                    # out of descriptors: the pending connection stays in the backlog until one is free
+                    ADMISSION_LOG.error("Accepting a connection failed: %s", e)
+                    time.sleep(health.REAP_INTERVAL)
+                    continue
+                refused, delay = ADMISSION.admit()
+                if refused:
+                    try:
+                        send_frame(conn, refusal(refused))
+                    except OSError:
+                        pass
+                    conn.close()
+                    continue
+                if delay:
+                    time.sleep(delay)  # later connections wait in the listen backlog meanwhile
+                try:
+                    Thread(target=serve_client, args=(conn, addr)).start()
+                except RuntimeError as e:
+                    # out of threads, --max-connections is set too high for this machine
+                    ADMISSION.release()
+                    ADMISSION_LOG.error("Serving a connection failed: %s", e)
+                    conn.close()
+    except Exception as e:
+        print(f"Server error: {e}")
+
+async def loop_main_async(port):
+    global LOOP
+    global STORE_THREAD
+    LOOP = asyncio.get_running_loop()
+    if isinstance(MESSAGES, SegmentStore):
+        STORE_THREAD = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store")
+    server = await asyncio.start_server(serve_client_async, "0.0.0.0", port, backlog=socket.SOMAXCONN,
+                                        reuse_port=CLUSTER is not None)
+    reaper = asyncio.create_task(reap_forever_async())
+    print(f"Server started on port {port} (asyncio mode)")
+    print("Waiting for a client...")
+    async with server:
+        await server.serve_forever()
+    reaper.cancel()
+
+def run_async_server(port):
+    try:
+        asyncio.run(loop_main_async(port))
     except Exception as e:
         print(f"Server error: {e}")
 
+def print_queues():
+    # lagging clients first
+    queues = sorted(((id, client.stats()) for id, client in CLIENTS.items()),
+                    key=lambda item: item[1]["depth"], reverse=True)
+    print(f"Outbound queues (max {QUEUE_SIZE} frames, policy {QUEUE_POLICY}):")
+    for id, stats in queues:
+        print(f"  client #{id}: depth={stats['depth']} max_depth={stats['max_depth']} "
+              f"sent={stats['sent']} dropped={stats['dropped']} batches={stats['batches']}")
+
+def print_stats():
+    print("Metrics:")
+    for metric in METRICS.metrics:
+        if metric.kind != "histogram":
+            print(f"  {metric.name}{format_labels(metric.labels)}: {metric.value}")
+        elif metric.count:
+            print(f"  {metric.name}: count={metric.count} mean={metric.sum / metric.count * 1000:.3f}ms "
+                  f"p50<={metric.quantile(0.5) * 1000:g}ms p99<={metric.quantile(0.99) * 1000:g}ms "
+                  f"p999<={metric.quantile(0.999) * 1000:g}ms")
+        else:
+            print(f"  {metric.name}: no observations")
+
+def print_top_clients(count):
+    # the clients lagging the most, then the busiest senders
+    clients = sorted(((id, client.stats()) for id, client in CLIENTS.items()),
+                     key=lambda item: (item[1]["depth"], item[1]["received"]), reverse=True)
+    print(f"Top {min(count, len(clients))} of {len(clients)} clients:")
+    for id, stats in clients[:count]:
+        print(f"  client #{id}: lag={stats['depth']} frames max_lag={stats['max_depth']} "
+              f"received={stats['received']} sent={stats['sent']} dropped={stats['dropped']}")
+
+def print_backlog(count):
+    backlog = {id: pending for id, pending in MESSAGES.backlog().items() if pending}
+    print(f"Stored messages: {sum(backlog.values())} for {len(backlog)} offline clients")
+    for id, pending in sorted(backlog.items(), key=lambda item: item[1], reverse=True)[:count]:
+        print(f"  client #{id}: {pending}")
+
+def start_metrics(offset=0):
+    # --metrics-port serves the metrics to Prometheus, worker i of --workers uses the port + i
+    metrics_port = get_option("--metrics-port", None)
+    if metrics_port:
+        serve(METRICS, int(metrics_port) + offset)
+        print(f"Metrics on http://127.0.0.1:{int(metrics_port) + offset}/metrics")
+
+def start_logs(name=None):
+    # --log-level debug logs every relayed message; --log-file writes to a rotating file instead of
+    # stdout, worker i of --workers to a file of its own; --log-sample and --log-rate take
+    # category=N,... to keep 1 in N records or N records/s
+    path = get_option("--log-file", None)
+    if path and name:
+        path = f"{path}.{name}"
+    logs.configure(get_option("--log-level", "info"), path,
+                   sample=logs.parse_limits(get_option("--log-sample", "")),
+                   rate={**LOG_RATES, **logs.parse_limits(get_option("--log-rate", ""))})
+
+def open_store(name=None):
+    # --store-dir keeps undelivered messages in a segment log on disk instead of in memory
+    store_dir = get_option("--store-dir", None)
+    if not store_dir:
+        return MemoryStore()
+    if name:
+        store_dir = os.path.join(store_dir, name)
+    ram_budget = int(get_option("--ram-budget", RAM_BUDGET))
+    store = SegmentStore(store_dir, ram_budget=ram_budget)
+    print(f"Offline messages stored in {store_dir} ({sum(store.backlog().values())} pending)")
+    return store
+
+def run_worker(port, worker, workers):
+    # body of a forked worker process, never returns
+    global CLUSTER
+    global MESSAGES
+    global CLIENTS
+
+    CLIENTS = ClientRegistry(first_id=worker, step=workers, taken=held_elsewhere)
+    start_logs(f"worker-{worker}")
+    MESSAGES = open_store(f"worker-{worker}")
+    CLUSTER = Cluster(worker_endpoints(port, workers), worker, workers, on_cluster_frame)
+    CLUSTER.connect()
+    start_metrics(worker)
+    Thread(target=watch_parent, args=(os.getppid(),), daemon=True).start()
+
+    if "--asyncio" in argv:
+        run_async_server(port)
+    else:
+        loop_main(port)
+    os._exit(0)
+
+def watch_parent(parent):
+    # workers go away with the console process
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+def worker_endpoints(port, workers):
+    # one unix socket per worker, the last one belongs to the console process
+    return [endpoint_path(port, endpoint) for endpoint in range(workers + 1)]
+
+def start_workers(port, workers):
+    global CLUSTER
+
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(port, worker, workers)
+        pids.append(pid)
+    # the console process only follows which worker owns which client
+    CLUSTER = Cluster(worker_endpoints(port, workers), workers, workers)
+    return pids
+
+def join_federation(nodes, node):
+    # this server is member `node` of the comma separated host:port federation addresses
+    global CLUSTER
+    global CLIENTS
+
+    endpoints = [parse_address(address) for address in nodes.split(",")]
+    CLIENTS = ClientRegistry(first_id=node, step=len(endpoints), taken=held_elsewhere)
+    CLUSTER = Cluster(endpoints, node, len(endpoints), on_cluster_frame)
+    CLUSTER.connect()
+    print(f"Node {node} of {len(endpoints)}, federation links on {endpoints[node][0]}:{endpoints[node][1]}")
+
 def main():
     global CLIENTS
+    global MESSAGES
+    global QUEUE_SIZE
+    global QUEUE_POLICY
+    global COMPRESSION
+    global FIXED_CODEC
+    global HEARTBEAT
+    global HANDSHAKE_TIMEOUT
+    global IDLE_TIMEOUT
+    global ADMISSION
 
     try:
         port = int(argv[1])
     except:
         port = 8080
 
-    loop = Thread(target=loop_main, args=(port,))
-    loop.daemon = True
-    loop.start()
+    QUEUE_SIZE = int(get_option("--queue-size", MAX_QUEUE))
+    QUEUE_POLICY = get_option("--queue-policy", BLOCK)
+    COMPRESSION = "--no-compression" not in argv
+    # --no-fixed-codec answers Handshakes asking for codec.FIXED with protobuf
+    FIXED_CODEC = "--no-fixed-codec" not in argv
+    # --heartbeat S asks clients for a heartbeat every S seconds (0 for none), those that miss
+    # HEARTBEAT_MISSES in a row are disconnected; --idle-timeout S does the same for clients without
+    # heartbeats after S silent seconds and --handshake-timeout S for connections that send no
+    # Handshake; --max-connections N and --accept-rate N/s limit new connections, per worker
+    HEARTBEAT = float(get_option("--heartbeat", health.HEARTBEAT_INTERVAL))
+    HANDSHAKE_TIMEOUT = float(get_option("--handshake-timeout", health.HANDSHAKE_TIMEOUT))
+    IDLE_TIMEOUT = float(get_option("--idle-timeout", health.IDLE_TIMEOUT))
+    threads_per_connection = 0 if "--asyncio" in argv else 2
+    ADMISSION = health.Admission(int(get_option("--max-connections",
+                                                health.default_max_connections(threads_per_connection))),
+                                 float(get_option("--accept-rate", 0)), HANDSHAKE_TIMEOUT)
+    if QUEUE_POLICY not in POLICIES:
+        print(f"Invalid queue policy {QUEUE_POLICY}, expected one of: {', '.join(POLICIES)}")
+        return
+    log_level = get_option("--log-level", "info")
+    if log_level not in logs.LEVELS:
+        print(f"Invalid log level {log_level}, expected one of: {', '.join(logs.LEVELS)}")
+        return
+    start_logs()
+
+    # --workers N forks N processes sharing the port, this one only runs the console
+    workers = int(get_option("--workers", 1))
+    # --nodes h:p,h:p,... --node i links this server with other servers into one network
+    nodes = get_option("--nodes", None)
+    if nodes and workers > 1:
+        print("--nodes and --workers cannot be combined")
+        return
+
+    pids = []
+    if workers > 1:
+        pids = start_workers(port, workers)
+    else:
+        if nodes:
+            join_federation(nodes, int(get_option("--node", 0)))
+        MESSAGES = open_store()
+        start_metrics()
+        # --asyncio serves every client from a single event loop instead of a thread per client
+        if "--asyncio" in argv:
+            loop = Thread(target=run_async_server, args=(port,))
+        else:
+            loop = Thread(target=loop_main, args=(port,))
+        loop.daemon = True
+        loop.start()
 
     while True:
         try:
-            command = input("op> ").strip().lower()
+            command, _, argument = input("op> ").strip().lower().partition(" ")
         except:
             break
+        count = int(argument) if argument.isdigit() else 10
 
         if command == "num_users":
-            print(f"Number of users: {len(CLIENTS)}")
+            if CLUSTER and workers > 1:
+                counts = CLUSTER.users_per_member()
+                print(f"Number of users: {sum(counts)}")
+                for worker, count in enumerate(counts):
+                    print(f"  worker {worker}: {count}")
+            else:
+                print(f"Number of users: {len(CLIENTS)}")
+        elif command == "channels":
+            if CLUSTER and workers > 1:
+                print("Channels are kept by each worker, not available with --workers")
+            else:
+                sizes = CHANNELS.sizes()
+                print(f"Number of channels: {len(sizes)}")
+                for channel, size in sorted(sizes.items()):
+                    print(f"  #{channel}: {size} members")
+        elif command == "queues":
+            if CLUSTER and workers > 1:
+                print("Queue stats are kept by each worker, not available with --workers")
+            else:
+                print_queues()
+        elif command in ("stats", "top_clients", "backlog"):
+            if CLUSTER and workers > 1:
+                print("Metrics are kept by each worker, see --metrics-port")
+            elif command == "stats":
+                print_stats()
+            elif command == "top_clients":
+                print_top_clients(count)
+            else:
+                print_backlog(count)
         else:
             print("Invalid command")
             print("Available commands:")
             print("- num_users: Get the number of connected users")
+            print("- channels: List the channels and their number of members")
+            print("- queues: Show outbound queue depth per client")
+            print("- stats: Show message counters, gauges and routing latency")
+            print("- top_clients [N]: Show the N most lagging clients")
+            print("- backlog [N]: Show stored messages and the N clients with the most")
+
+    for pid in pids:
+        os.kill(pid, signal.SIGTERM)
 
 if __name__ == "__main__":
     main()
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0etemplate.proto\x12\x03\x63s2\".\n\x07Message\x12\n\n\x02\x66r\x18\x01 \x01(\x03\x12\n\n\x02to\x18\x02 \x01(\x03\x12\x0b\n\x03msg\x18\x03 \x01(\t\"=\n\rFastHandshake\x12\n\n\x02id\x18\x01 \x01(\x03\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x11\n\tchange_id\x18\x03 \x01(\x08\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0etemplate.proto\x12\x03\x63s2\"v\n\x07Message\x12\n\n\x02\x66r\x18\x01 \x01(\x03\x12\n\n\x02to\x18\x02 \x01(\x03\x12\x0b\n\x03msg\x18\x03 \x01(\t\x12\x0f\n\x07\x63hannel\x18\x04 \x01(\t\x12\x1a\n\x02op\x18\x05 \x01(\x0e\x32\x0e.cs2.ChannelOp\x12\x19\n\x05trace\x18\x10 \x01(\x0b\x32\n.cs2.Trace\"6\n\x08HopStamp\x12\r\n\x05where\x18\x01 \x01(\t\x12\x0c\n\x04node\x18\x02 \x01(\x03\x12\r\n\x05\x61t_ns\x18\x03 \x01(\x03\"I\n\x05Trace\x12\x10\n\x08trace_id\x18\x01 \x01(\x03\x12\x11\n\torigin_ns\x18\x02 \x01(\x03\x12\x1b\n\x04hops\x18\x03 \x03(\x0b\x32\r.cs2.HopStamp\".\n\x0cMessageBatch\x12\x1e\n\x08messages\x18\x01 \x03(\x0b\x32\x0c.cs2.Message\"\x95\x01\n\tHandshake\x12\n\n\x02id\x18\x01 \x01(\x03\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x11\n\tchange_id\x18\x03 \x01(\x08\x12\x0e\n\x06new_id\x18\x04 \x01(\x08\x12\x10\n\x08\x62\x61tching\x18\x05 \x01(\x08\x12\x13\n\x0b\x63ompression\x18\x06 \x01(\x08\x12\x14\n\x0cheartbeat_ms\x18\x07 \x01(\x05\x12\r\n\x05\x63odec\x18\x08 \x01(\t\"\x9a\x01\n\x0c\x43lusterFrame\x12\x0e\n\x06worker\x18\x01 \x01(\x05\x12\x0e\n\x06joined\x18\x02 \x03(\x03\x12\x0c\n\x04left\x18\x03 \x03(\x03\x12\x10\n\x08messages\x18\x04 \x03(\x0c\x12\r\n\x05store\x18\x05 \x01(\x08\x12\x0e\n\x06replay\x18\x06 \x03(\x03\x12\x11\n\treceivers\x18\x07 \x03(\x03\x12\x18\n\x10\x63hannel_messages\x18\x08 \x03(\x0c**\n\tChannelOp\x12\x08\n\x04SEND\x10\x00\x12\x08\n\x04JOIN\x10\x01\x12\t\n\x05LEAVE\x10\x02\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,7 +32,17 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'template_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_MESSAGE']._serialized_start=23
-  _globals['_MESSAGE']._serialized_end=69
-  _globals['_FASTHANDSHAKE']._serialized_start=71
-  _globals['_FASTHANDSHAKE']._serialized_end=132
+  _globals['_MESSAGE']._serialized_end=141
+  _globals['_HOPSTAMP']._serialized_start=143
+  _globals['_HOPSTAMP']._serialized_end=197
+  _globals['_TRACE']._serialized_start=199
+  _globals['_TRACE']._serialized_end=272
+  _globals['_MESSAGEBATCH']._serialized_start=274
+  _globals['_MESSAGEBATCH']._serialized_end=320
+  _globals['_HANDSHAKE']._serialized_start=323
+  _globals['_HANDSHAKE']._serialized_end=472
+  _globals['_CLUSTERFRAME']._serialized_start=475
+  _globals['_CLUSTERFRAME']._serialized_end=629
+  _globals['_CHANNELOP']._serialized_start=631
+  _globals['_CHANNELOP']._serialized_end=673
 # @@protoc_insertion_point(module_scope)
@@ -1,97 +1,578 @@
+import random
 import threading
 import socket
+import time
+from collections import OrderedDict
 import snowflake
+import tracing
+import logs
 import message_pb2 as message_pb2
+from compression import COMPRESS_MIN, deflate, inflate
+from fragments import MIN_FRAGMENT, Reassembly, split
+from membership import MembershipTable
+from reliability import ReceiveWindow, SendWindow
+from routing import RoutingTable
+from seen_cache import SeenCache
 
 id_list = []
 lock = threading.Lock()
 CONNECT_MESSAGE = 'CONNECT'
 ACK_MESSAGE = 'ACK'
+HEARTBEAT_MESSAGE = 'HEARTBEAT'
+DIGEST_MESSAGE = 'DIGEST'
+WANT_MESSAGE = 'WANT'
+FLOOD = 'flood'
+GOSSIP = 'gossip'
+HEARTBEAT_INTERVAL = 1.0  # seconds between heartbeats to every neighbor
+PROBE_EVERY = 5  # heartbeat intervals between heartbeats to evicted neighbors, to notice them coming back
+MAX_HOPS = 16  # forwards before a message is dropped, in case the seen cache missed it
+ACK_DELAY = 0.02  # seconds an ACK waits so it can cover more messages
+ACK_EVERY = 16  # arrivals that make the ACK go out right away
+TIMER_TICK = 0.01  # seconds between checks for due ACKs and retransmissions
+WINDOW_SWEEP = 5.0  # seconds between looks for idle windows to drop
+MESSAGE_ID_TAG = b"\x30"  # Message.message_id: field 6, varint
+DEFAULT_MTU = 1500  # when the path MTU cannot be queried
+MAX_DATAGRAM = 65507  # largest UDP payload over IPv4
+IP_UDP_HEADERS = 28
+FRAGMENT_OVERHEAD = 96  # bytes of Message fields around the slice in a fragment
+RECEIVE_BUFFER = 4 * 1024 * 1024  # kernel socket buffer asked for, absorbs bursts of fragments
+GOSSIP_FANOUT = 3  # neighbors a gossiped message is passed on to
+GOSSIP_ROUNDS = 8  # forwards a gossiped message gets before it dies out
+ANTI_ENTROPY_INTERVAL = 0.5  # seconds between digests sent to a random neighbor
+DIGEST_SIZE = 128  # most recent message ids listed in a digest
+RECENT_MESSAGES = 1024  # gossiped messages kept for neighbors that missed them
+IP_MTU = getattr(socket, "IP_MTU", 14)  # Linux value, missing from the socket module
+COMPRESSED_TAG = b"\x00"  # first byte of a deflated datagram, field number 0 never starts a Message
+MESSAGE_LOG = logs.get("messages")
+PEER_LOG = logs.get("peers")
+TRACE_LOG = logs.get("traces")
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def path_mtu(addr):
+    # MTU of the route to addr, datagrams up to this size are not fragmented by IP
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(addr)
+            return s.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_MTU
+
 
 class Peer:
     
-    def __init__(self, ip, port, desired_id=None):
+    def __init__(self, ip, port, desired_id=None, max_hops=MAX_HOPS, routing=True, reliable=True, mtu=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, dissemination=FLOOD, fanout=GOSSIP_FANOUT,
+                 gossip_rounds=GOSSIP_ROUNDS, push_pull=False, anti_entropy_interval=ANTI_ENTROPY_INTERVAL,
+                 trace_rate=0.0, compression=False):
+        if dissemination not in (FLOOD, GOSSIP):
+            raise ValueError(f"unknown dissemination mode {dissemination!r}")
         self.ip = ip
         self.port = port
         self.peer_id = self.generate_id(desired_id)
-        self.peers = []  
+        self.ids = snowflake.generator(self.peer_id)  # message and fragment ids
+        self.wait_for_ids = True  # sleep when a tick's ids are used up, see snowflake.py
+        self.incarnation = time.time_ns()  # of the newest SendWindow, sequences start at 1 again in each
+        self.peers = MembershipTable(heartbeat_interval)  # neighbors, iterates over the live ones
+        self.heartbeat_interval = heartbeat_interval
+        self.next_heartbeat = 0
+        self.next_probe = 0
+        self.max_hops = max_hops
+        self.seen = SeenCache()  # (sender id, message id) of messages already delivered or forwarded here
+        self.routing = routing  # unicast along learned routes instead of flooding when possible
+        self.routes = RoutingTable()
+        self.reliable = reliable  # retransmit messages until the destination ACKs them
+        self.send_windows = {}  # destination id -> SendWindow
+        self.receive_windows = {}  # sender id -> ReceiveWindow
+        self.sending = set()  # destination ids whose windows have messages unacked or waiting
+        self.acks_due = set()  # sender ids whose windows have a delayed ACK pending
+        self.windows_lock = threading.Lock()
+        self.next_sweep = 0
+        self.mtu = mtu  # overrides the path MTU measured towards each neighbor
+        self.path_mtus = {}  # neighbor address -> MTU of the route to it
+        self.reassembly = Reassembly()
+        self.dissemination = dissemination  # how messages without a route spread: FLOOD or GOSSIP
+        self.fanout = fanout
+        self.gossip_rounds = gossip_rounds
+        self.push_pull = push_pull  # exchange digests with neighbors to fill in what gossip missed
+        self.anti_entropy_interval = anti_entropy_interval
+        self.next_digest = 0
+        self.recent = OrderedDict()  # (sender id, message id) -> encoding, None for messages only delivered here
+        self.recent_lock = threading.Lock()
+        self.trace_rate = trace_rate  # share of the messages sent with a trace, stamped by every forwarder
+        self.compression = compression  # deflate datagrams to neighbors that announced they read them
+        self.compressing = set()  # addresses of those neighbors
+        self.last_deflated = (None, None)  # (datagram, encoding): a flood deflates once for all neighbors
+
+        self.packets_sent = 0
+        self.messages_received = 0
+        self.acks_received = 0
+        self.acks_sent = 0
+        self.duplicates_delivered = 0  # retransmitted copies of messages that had already arrived
+        self.routed = 0  # messages sent to a single neighbor along a learned route
+        self.flooded = 0  # messages sent to every neighbor
+        self.gossiped = 0  # messages sent to fanout random neighbors
+        self.repaired = 0  # messages sent to a neighbor whose digest lacked them
+        self.duplicates_dropped = 0
+        self.hop_limit_dropped = 0
+        self.compressed = 0  # datagrams sent deflated
+        self.bytes_saved = 0
+        self.corrupt = 0  # compressed datagrams that did not inflate
+        self.stale = 0  # reliable messages and ACKs from or for an earlier window of their sender
+        self.windows_dropped = 0  # idle send and receive windows
+        self.dropped_retransmissions = 0  # counted by send windows that were dropped since
+        self.dropped_given_up = 0
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((self.ip, self.port))
+        self._start_engine()
 
+    def _start_engine(self):
+        # threaded engine: a blocking socket, a listener thread and a timer thread
+        self.socket = self.open_socket()
         self._start_server_thread()
+        self._start_timer_thread()
         print(f"Peer {self.peer_id} started at {self.ip}:{self.port}")
 
+    def open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        sock.bind((self.ip, self.port))
+        return sock
+
     def generate_id(self, desired_id):
         if desired_id is not None:
             if desired_id in id_list:
                 print('id already in use')
-                return snowflake.derive_id()
+                return snowflake.derive_id(self.port)
             else:
                 with lock:
                     id_list.append(desired_id)
                 return desired_id
         else:
-            return snowflake.derive_id()
+            return snowflake.derive_id(self.port)
 
     def _start_server_thread(self):
         self.server_thread = threading.Thread(target=self.listen_for_messages)
         self.server_thread.daemon = True
         self.server_thread.start()
 
+    def _start_timer_thread(self):
+        self.timer_thread = threading.Thread(target=self.run_timers)
+        self.timer_thread.daemon = True
+        self.timer_thread.start()
+
+    def run_timers(self):
+        while True:
+            time.sleep(TIMER_TICK)
+            self.tick()
+
+    def tick(self):
+        # due ACKs, retransmissions of what was not ACKed in time, heartbeats and digests
+        now = time.monotonic()
+        with self.windows_lock:
+            acks_due = [(sender_id, self.receive_windows.get(sender_id)) for sender_id in self.acks_due]
+            sending = [(destination_id, self.send_windows[destination_id]) for destination_id in self.sending]
+        for sender_id, window in acks_due:
+            if window is not None and window.ack_due is not None and window.ack_due <= now:
+                self.send_ack(sender_id, window)
+        for _, window in sending:
+            for message in window.expired():
+                self.transmit(message)
+        with self.windows_lock:
+            # a window that got new traffic meanwhile was put back in by the thread that added it
+            for sender_id, window in acks_due:
+                if window is None or window.ack_due is None:
+                    self.acks_due.discard(sender_id)
+            for destination_id, window in sending:
+                if not window.pending() and self.send_windows.get(destination_id) is window:
+                    self.sending.discard(destination_id)
+            if now >= self.next_sweep:
+                self.next_sweep = now + WINDOW_SWEEP
+                self.drop_idle_windows(now)
+        if now >= self.next_heartbeat:
+            self.next_heartbeat = now + self.heartbeat_interval
+            self.send_heartbeats(now)
+        if self.push_pull and now >= self.next_digest:
+            self.next_digest = now + self.anti_entropy_interval
+            self.send_digest()
+
+    def send_heartbeats(self, now):
+        heartbeat = self.create_connect_message(HEARTBEAT_MESSAGE, self.port).SerializeToString()
+        for peer_addr in self.peers:
+            self.send_data(heartbeat, peer_addr)
+        if now >= self.next_probe:
+            self.next_probe = now + PROBE_EVERY * self.heartbeat_interval
+            for peer_addr in self.peers.evicted():
+                self.send_data(heartbeat, peer_addr)
+
+        evicted = self.peers.evict_suspects()
+        for peer_addr in evicted:
+            # no more sends or routes through it until it is heard from again
+            self.routes.forget(peer_addr)
+            self.path_mtus.pop(peer_addr, None)
+            PEER_LOG.info("Peer at %s stopped responding, evicted", peer_addr)
+        if evicted:
+            # messages still waiting for a dead neighbor's ACK are given up with its window
+            dead = {member["peer_id"] for member in self.peers.snapshot() if member["addr"] in evicted}
+            with self.windows_lock:
+                for destination_id in dead & self.send_windows.keys():
+                    self.drop_send_window(destination_id)
+
     def listen_for_messages(self):
         while True:
-            data, addr = self.socket.recvfrom(1024)
-            self.process_incoming_message(data, addr)
+            data, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            try:
+                self.process_incoming_message(data, addr)
+            except Exception as e:
+                # one bad datagram must not take the listener thread down with it
+                PEER_LOG.error("Error processing message from %s: %s", addr, e)
 
     def process_incoming_message(self, data, addr):
+        if data[:1] == COMPRESSED_TAG:
+            try:
+                data = inflate(data[1:])
+            except ValueError:
+                self.corrupt += 1
+                return
         message = message_pb2.Message()
         message.ParseFromString(data)
 
         if message.text_message == CONNECT_MESSAGE:
             sender_ip = addr[0]
             sender_port = message.sender_port
-            self.peers.append((sender_ip, sender_port))
+            self.add_peer((sender_ip, sender_port), message.sender_id)
+            self.note_compression((sender_ip, sender_port), message.compression)
+            return
+
+        if message.text_message == HEARTBEAT_MESSAGE:
+            sender_addr = (addr[0], message.sender_port)
+            if not self.peers.heard(sender_addr, message.sender_id):
+                # an evicted neighbor that is back, or one that knows us and we do not know yet
+                self.add_peer(sender_addr, message.sender_id)
+            self.note_compression(sender_addr, message.compression)
+            return
+
+        if message.text_message == DIGEST_MESSAGE:
+            self.answer_digest(list(zip(message.digest_senders, message.digest)), addr)
+            return
+
+        if message.text_message == WANT_MESSAGE:
+            self.send_recent(list(zip(message.digest_senders, message.digest)), addr)
+            return
+
+        # every copy of a flooded message carries the same id, only the first one is handled
+        if message.message_id and not self.seen.add((message.sender_id, message.message_id)):
+            self.duplicates_dropped += 1
             return
+
+        # the first copy from a peer came the fastest way, which is also the way back to it
+        if self.routing and message.sender_id != self.peer_id:
+            self.routes.learn(message.sender_id, addr, message.hops)
         
         if message.text_message == ACK_MESSAGE and message.destination_id == self.peer_id:
-            print(f"\nACK received from {addr}")
+            self.acks_received += 1
+            self.on_ack(message, addr)
+            window = self.send_windows.get(message.sender_id)
+            if window is not None and message.incarnation and message.incarnation != window.incarnation:
+                self.stale += 1
+            elif window is not None:
+                for ready in window.acknowledge(message.cumulative_ack, message.selective_acks):
+                    self.transmit(ready)
             return
 
         if message.destination_id == self.peer_id:
-            print(f"\nMessage received: {message.text_message}")
-            ack_message = self.create_ack_message(message.sender_id)
-            self.send_serialized_message(ack_message, addr)
+            reliable = bool(message.sequence)
+            if reliable:
+                # sent reliably: ACKed together with the messages around it, delivered once
+                window = self.receive_window(message.sender_id, message.incarnation)
+                if window is None:
+                    self.stale += 1
+                    return
+                delivered = window.receive(message.sequence, ACK_DELAY)
+                if window.unacked >= ACK_EVERY:
+                    self.send_ack(message.sender_id, window)
+                else:
+                    with self.windows_lock:
+                        self.acks_due.add(message.sender_id)
+                if not delivered:
+                    self.duplicates_delivered += 1
+                    return
+            if self.push_pull and message.message_id:
+                # nothing to pass on, but neighbors need not send it here again
+                self.remember((message.sender_id, message.message_id), None)
+            if message.fragment_count:
+                data = self.reassembly.add(message)
+                if data is None:
+                    return
+                message = message_pb2.Message.FromString(data)
+            self.messages_received += 1
+            self.on_message(message)
+            if message.HasField("trace"):
+                self.on_trace(message, time.time_ns())
+            if not reliable:
+                ack_message = self.create_ack_message(message.sender_id)
+                self.send_serialized_message(ack_message, addr)
         else:
             self.forward_message(message, addr)
 
+    def on_message(self, message):
+        MESSAGE_LOG.info("Message received: %s", message.text_message)
+
+    def on_trace(self, message, arrived_ns):
+        TRACE_LOG.info("%s", tracing.report(message.trace, arrived_ns))
+
+    def on_ack(self, message, addr):
+        MESSAGE_LOG.debug("ACK received from %s", addr)
+
     def forward_message(self, message, sender_addr):
-        for peer_addr in self.peers:
-            if peer_addr != sender_addr:  # do not forward back to the sender
-                self.send_serialized_message(message, peer_addr)
+        max_hops = self.max_hops if self.dissemination == FLOOD else min(self.max_hops, self.gossip_rounds)
+        if message.hops >= max_hops:
+            self.hop_limit_dropped += 1
+            return
+        message.hops += 1
+        if message.HasField("trace"):
+            tracing.stamp(message, "forwarded", self.peer_id)
+        self.send_to_destination(message.SerializeToString(), message.destination_id, sender_addr,
+                                 (message.sender_id, message.message_id))
+
+    def send_to_destination(self, data, destination_id, sender_addr=None, key=None):
+        # key: (sender id, message id) under which push-pull remembers the message
+        next_hop = self.next_hop(destination_id)
+        if next_hop is not None and next_hop != sender_addr:
+            self.routed += 1
+            self.send_data(data, next_hop)
+            return
+        # no route yet, or it points back where the message came from: flood or gossip
+        if self.push_pull and key and key[1]:
+            self.remember(key, data)
+        neighbors = [peer_addr for peer_addr in self.peers if peer_addr != sender_addr]  # not back to the sender
+        if self.dissemination == GOSSIP and len(neighbors) > self.fanout:
+            self.gossiped += 1
+            neighbors = random.sample(neighbors, self.fanout)
+        else:
+            self.flooded += 1
+        for peer_addr in neighbors:
+            self.send_data(data, peer_addr)
+
+    def remember(self, key, data):
+        with self.recent_lock:
+            self.recent[key] = data
+            if len(self.recent) > RECENT_MESSAGES:
+                self.recent.popitem(last=False)
+
+    def recent_keys(self):
+        with self.recent_lock:
+            keys = list(self.recent)
+        return keys[-DIGEST_SIZE:]
+
+    def send_digest(self):
+        # push-pull anti-entropy: a random neighbor sends back what we lack and asks for what it lacks
+        neighbors = list(self.peers)
+        if not neighbors:
+            return
+        digest = self.create_connect_message(DIGEST_MESSAGE, self.port)
+        self.add_keys(digest, self.recent_keys())
+        self.send_serialized_message(digest, random.choice(neighbors))
+
+    def answer_digest(self, digest, addr):
+        # digest: (sender id, message id) of the messages the neighbor has
+        theirs = set(digest)
+        ours = self.recent_keys()
+        self.send_recent([key for key in ours if key not in theirs], addr)
+        with self.recent_lock:
+            wanted = [key for key in digest if key not in self.recent]
+        if wanted:
+            want = self.create_connect_message(WANT_MESSAGE, self.port)
+            self.add_keys(want, wanted)
+            self.send_serialized_message(want, addr)
+
+    def add_keys(self, message, keys):
+        for sender_id, message_id in keys:
+            message.digest_senders.append(sender_id)
+            message.digest.append(message_id)
+
+    def send_recent(self, keys, addr):
+        for key in keys:
+            with self.recent_lock:
+                data = self.recent.get(key)
+            if data is not None:
+                self.repaired += 1
+                self.send_data(data, addr)
+
+    def next_hop(self, destination_id):
+        if not self.routing:
+            return None
+        return self.routes.next_hop(destination_id)
 
     def send_serialized_message(self, message, peer_addr):
+        self.send_data(message.SerializeToString(), peer_addr)
+
+    def note_compression(self, peer_addr, compression):
+        if compression:
+            self.compressing.add(peer_addr)
+        else:
+            self.compressing.discard(peer_addr)
+
+    def encode_datagram(self, data, peer_addr):
+        # deflated for neighbors that read compressed datagrams, when it saves anything
+        if not self.compression or len(data) < COMPRESS_MIN or peer_addr not in self.compressing:
+            return data
+        plain, encoded = self.last_deflated
+        if plain is not data:
+            deflated = deflate(data)
+            encoded = COMPRESSED_TAG + deflated if deflated is not None else data
+            self.last_deflated = (data, encoded)
+        if encoded is not data:
+            self.compressed += 1
+            self.bytes_saved += len(data) - len(encoded)
+        return encoded
+
+    def send_data(self, data, peer_addr):
+        data = self.encode_datagram(data, peer_addr)
         try:
-            self.socket.sendto(message.SerializeToString(), peer_addr)
+            self.socket.sendto(data, peer_addr)
+            self.packets_sent += 1
         except Exception as e:
-            print(f"Error sending message to {peer_addr}: {e}")
+            PEER_LOG.warning("Error sending message to %s: %s", peer_addr, e)
+
+    def add_peer(self, peer_addr, peer_id=0):
+        # True if peer_addr was not a live neighbor yet
+        if not self.peers.add(peer_addr, peer_id):
+            return False
+        self.measure_path(peer_addr)
+        return True
+
+    def membership(self):
+        # live and evicted neighbors with their failure detector state
+        return self.peers.snapshot()
 
     def connect_to_peer(self, peer_ip, peer_port):
-        if (peer_ip, peer_port) not in self.peers:
-            self.peers.append((peer_ip, peer_port))
+        if self.add_peer((peer_ip, peer_port)):
             connect_message = self.create_connect_message(CONNECT_MESSAGE, self.port)
             self.send_serialized_message(connect_message, (peer_ip, peer_port))
 
     def broadcast_message(self, message_text, destination_id):
         message = self.create_message(message_text, destination_id)
-        for peer_addr in self.peers:
-            self.send_serialized_message(message, peer_addr)
+        parts = self.fragment(message)
+        if not self.reliable:
+            for part in parts:
+                self.transmit(part)
+            return
+        # returns right away, the window sends each part as soon as it has room
+        ready = []
+        with self.windows_lock:
+            # submitted under the lock, so the window cannot be dropped as idle meanwhile
+            window = self.send_window(destination_id)
+            for part in parts:
+                ready.extend(window.submit(part))
+            self.sending.add(destination_id)
+        for part in ready:
+            self.transmit(part)
+
+    def measure_path(self, addr):
+        if self.mtu is None:
+            self.path_mtus[addr] = path_mtu(addr)
+
+    def fragment_size(self):
+        # fragments may take any neighbor, so they have to fit through the smallest MTU
+        mtu = self.mtu or min(list(self.path_mtus.values()), default=DEFAULT_MTU)
+        # receivers count on MIN_FRAGMENT bytes per fragment at least, below that IP splits the datagrams
+        return max(min(mtu - IP_UDP_HEADERS, MAX_DATAGRAM) - FRAGMENT_OVERHEAD, MIN_FRAGMENT)
+
+    def fragment(self, message):
+        # the message itself when it fits in one datagram, its fragments otherwise
+        data = message.SerializeToString()
+        size = self.fragment_size()
+        if len(data) <= size:
+            return [message]
+        fragment_id = self.ids.derive_id(self.wait_for_ids)
+        chunks = split(data, size)
+        parts = []
+        for index, chunk in enumerate(chunks):
+            part = message_pb2.Message()
+            part.sender_id = self.peer_id
+            part.destination_id = message.destination_id
+            part.fragment_id = fragment_id
+            part.fragment_index = index
+            part.fragment_count = len(chunks)
+            part.fragment = bytes(chunk)
+            parts.append(part)
+        return parts
+
+    def transmit(self, message):
+        # every transmission gets its own id, or peers would drop a retransmission as a duplicate.
+        # The id is appended to the encoding instead of set on the message, which the
+        # listener and the timer thread may both be sending
+        message_id = self.new_message_id()
+        data = message.SerializeToString() + MESSAGE_ID_TAG + varint(message_id)
+        self.send_to_destination(data, message.destination_id, key=(self.peer_id, message_id))
+
+    def send_window(self, destination_id):
+        # caller holds windows_lock
+        window = self.send_windows.get(destination_id)
+        if window is None:
+            # a destination whose window was dropped gets a newer incarnation, its receive window starts over
+            self.incarnation = max(self.incarnation + 1, time.time_ns())
+            window = self.send_windows[destination_id] = SendWindow(self.incarnation)
+        return window
+
+    def drop_send_window(self, destination_id):
+        # caller holds windows_lock
+        window = self.send_windows.pop(destination_id)
+        self.sending.discard(destination_id)
+        self.dropped_retransmissions += window.retransmissions
+        self.dropped_given_up += window.given_up + window.pending()
+        self.windows_dropped += 1
+
+    def drop_idle_windows(self, now):
+        # caller holds windows_lock; destinations that stopped ACKing end up here once their
+        # messages are given up, senders that went away once their last ACK went out
+        for destination_id, window in list(self.send_windows.items()):
+            if destination_id not in self.sending and window.idle(now):
+                self.drop_send_window(destination_id)
+        for sender_id, window in list(self.receive_windows.items()):
+            if sender_id not in self.acks_due and window.idle(now):
+                del self.receive_windows[sender_id]
+                self.windows_dropped += 1
+
+    def receive_window(self, sender_id, incarnation):
+        # None for a message from an earlier run of the sender, which is neither delivered nor ACKed
+        with self.windows_lock:
+            window = self.receive_windows.get(sender_id)
+            if window is None or incarnation > window.incarnation:
+                # the sender restarted and counts from 1 again
+                window = self.receive_windows[sender_id] = ReceiveWindow(incarnation)
+            elif incarnation < window.incarnation:
+                return None
+            # so drop_idle_windows leaves it alone until the message is in
+            window.last_arrival = time.monotonic()
+            return window
+
+    def send_ack(self, sender_id, window):
+        # one ACK for everything that arrived from sender_id so far
+        cumulative, selective = window.take_ack()
+        ack_message = self.create_ack_message(sender_id)
+        ack_message.cumulative_ack = cumulative
+        ack_message.incarnation = window.incarnation
+        ack_message.selective_acks.extend(selective)
+        self.send_to_destination(ack_message.SerializeToString(), sender_id,
+                                 key=(self.peer_id, ack_message.message_id))
+        self.acks_sent += 1
 
     def create_message(self, text, destination_id):
         message = message_pb2.Message()
         message.text_message = text
         message.sender_id = self.peer_id
         message.destination_id = destination_id
+        if tracing.sampled(self.trace_rate):
+            tracing.start(message)
         return message
     
     def create_ack_message(self, destination_id):
@@ -99,6 +580,7 @@ class Peer:
         ack_message.text_message = ACK_MESSAGE
         ack_message.sender_id = self.peer_id
         ack_message.destination_id = destination_id
+        ack_message.message_id = self.new_message_id()
         return ack_message
     
     def create_connect_message(self, text, sender_port):
@@ -106,5 +588,42 @@ class Peer:
         message.text_message = text
         message.sender_id = self.peer_id
         message.sender_port = sender_port
+        message.compression = self.compression
         return message
-    
+
+    def new_message_id(self):
+        # copies that come back to us through a cycle are dropped like any other duplicate
+        message_id = self.ids.derive_id(self.wait_for_ids)
+        self.seen.add((self.peer_id, message_id))
+        return message_id
+
+    def stats(self):
+        return {
+            "peers": len(self.peers),
+            "evicted": self.peers.evictions,
+            "rejoined": self.peers.rejoins,
+            "seen": len(self.seen),
+            "routes": len(self.routes),
+            "packets_sent": self.packets_sent,
+            "messages_received": self.messages_received,
+            "acks_received": self.acks_received,
+            "acks_sent": self.acks_sent,
+            "duplicates_delivered": self.duplicates_delivered,
+            "retransmissions": self.dropped_retransmissions + sum(
+                window.retransmissions for window in list(self.send_windows.values())),
+            "given_up": self.dropped_given_up + sum(window.given_up for window in list(self.send_windows.values())),
+            "unacked": sum(window.pending() for window in list(self.send_windows.values())),
+            "reassembly": self.reassembly.stats(),
+            "routed": self.routed,
+            "flooded": self.flooded,
+            "gossiped": self.gossiped,
+            "repaired": self.repaired,
+            "duplicates_dropped": self.duplicates_dropped,
+            "hop_limit_dropped": self.hop_limit_dropped,
+            "compressed": self.compressed,
+            "bytes_saved": self.bytes_saved,
+            "corrupt": self.corrupt,
+            "stale": self.stale,
+            "windows": len(self.send_windows) + len(self.receive_windows),
+            "windows_dropped": self.windows_dropped,
+        }
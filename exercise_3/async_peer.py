@@ -0,0 +1,194 @@
+# asyncio engine for Peer: the same protocol, run on an event loop instead of
+# a listener thread and a timer thread, with an API for embedding and load tests.
+#
+#   peer = AsyncPeer(ip, port)
+#   await peer.start()
+#   peer.connect_to_peer(ip, port)
+#   await peer.send(text, destination_id)
+#   async for message in peer: ...
+#
+# The transport hands over one datagram per readiness event, so the protocol
+# drains whatever else the kernel has queued right away and only queues raw
+# datagrams; a processing task parses and handles them in batches, so a slow
+# pass never keeps the socket from being drained. Every outgoing datagram,
+# forwards included, is queued and flushed by a writer task that stops while
+# the transport's buffer is full. Message ids never sleep on the loop: when a
+# tick's ids are used up they run ahead of the clock, and send() awaits the lead.
+
+__all__ = ["AsyncPeer"]
+
+import asyncio
+from collections import deque
+
+import logs
+from Peer import Peer, MAX_DATAGRAM, TIMER_TICK
+
+INBOUND_QUEUE = 64 * 1024  # datagrams waiting to be processed, later ones are dropped
+OUTBOUND_QUEUE = 64 * 1024  # datagrams waiting to be sent, later ones are dropped
+DELIVERED_QUEUE = 64 * 1024  # delivered messages nobody took yet, later ones are dropped
+BATCH = 256  # datagrams processed or sent before the loop gets to run other callbacks
+LOG = logs.get("peers")
+
+
+class PeerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def datagram_received(self, data, addr):
+        self.peer.received(data, addr)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable from a neighbor that went away
+        self.peer.send_errors += 1
+
+    def pause_writing(self):
+        self.peer.writable.clear()
+
+    def resume_writing(self):
+        self.peer.writable.set()
+
+
+class AsyncPeer(Peer):
+
+    def __init__(self, ip, port, desired_id=None, **options):
+        super().__init__(ip, port, desired_id, **options)
+        self.inbound = deque()  # (data, addr) received but not processed yet
+        self.outbound = deque()  # (data, addr) waiting for the writer task
+        self.messages = asyncio.Queue(DELIVERED_QUEUE)  # delivered messages, for the async iterator
+        self.transport = None
+        self.tasks = []
+        self.wait_for_ids = False
+
+        self.inbound_dropped = 0
+        self.outbound_dropped = 0
+        self.delivered_dropped = 0
+        self.send_errors = 0
+
+    def _start_engine(self):
+        # nothing runs before start() is awaited on the loop
+        self.socket = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.inbound_ready = asyncio.Event()
+        self.outbound_ready = asyncio.Event()
+        self.outbound_space = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+        self.socket = self.open_socket()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: PeerProtocol(self), sock=self.socket)
+        self.tasks = [
+            loop.create_task(self.process_batches()),
+            loop.create_task(self.flush_outbound()),
+            loop.create_task(self.run_timers()),
+        ]
+        print(f"Peer {self.peer_id} started at {self.ip}:{self.port} (asyncio mode)")
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.transport:
+            self.transport.close()
+
+    async def send(self, message_text, destination_id):
+        # like broadcast_message, but waits while the outbound queue is more than half full,
+        # and while the ids handed out so far are ahead of the clock
+        while len(self.outbound) >= OUTBOUND_QUEUE // 2:
+            self.outbound_space.clear()
+            await self.outbound_space.wait()
+        lead = self.ids.lead()
+        if lead:
+            await asyncio.sleep(lead)
+        self.broadcast_message(message_text, destination_id)
+
+    async def receive(self):
+        return await self.messages.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.messages.get()
+
+    def received(self, data, addr):
+        self.queue_inbound(data, addr)
+        while len(self.inbound) < INBOUND_QUEUE:
+            try:
+                data, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.send_errors += 1  # an ICMP error reported on the socket
+                break
+            self.queue_inbound(data, addr)
+        self.inbound_ready.set()
+
+    def queue_inbound(self, data, addr):
+        if len(self.inbound) >= INBOUND_QUEUE:
+            self.inbound_dropped += 1
+            return
+        self.inbound.append((data, addr))
+
+    async def process_batches(self):
+        while True:
+            await self.inbound_ready.wait()
+            self.inbound_ready.clear()
+            while self.inbound:
+                for _ in range(min(BATCH, len(self.inbound))):
+                    data, addr = self.inbound.popleft()
+                    try:
+                        self.process_incoming_message(data, addr)
+                    except Exception as e:
+                        LOG.error("Error processing message from %s: %s", addr, e)
+                await asyncio.sleep(0)
+
+    def send_data(self, data, peer_addr):
+        if len(self.outbound) >= OUTBOUND_QUEUE:
+            self.outbound_dropped += 1
+            return
+        self.outbound.append((self.encode_datagram(data, peer_addr), peer_addr))
+        self.outbound_ready.set()
+
+    async def flush_outbound(self):
+        while True:
+            await self.outbound_ready.wait()
+            self.outbound_ready.clear()
+            while self.outbound:
+                await self.writable.wait()
+                for _ in range(min(BATCH, len(self.outbound))):
+                    data, addr = self.outbound.popleft()
+                    self.transport.sendto(data, addr)
+                    self.packets_sent += 1
+                if len(self.outbound) < OUTBOUND_QUEUE // 2:
+                    self.outbound_space.set()
+                await asyncio.sleep(0)
+
+    async def run_timers(self):
+        while True:
+            await asyncio.sleep(TIMER_TICK)
+            self.tick()
+
+    def on_message(self, message):
+        # a peer nobody iterates over still routes and ACKs, it just stops keeping what it delivered
+        if self.messages.full():
+            self.delivered_dropped += 1
+            return
+        self.messages.put_nowait(message)
+
+    def on_ack(self, message, addr):
+        pass
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "inbound": len(self.inbound),
+            "outbound": len(self.outbound),
+            "inbound_dropped": self.inbound_dropped,
+            "outbound_dropped": self.outbound_dropped,
+            "delivered": self.messages.qsize(),
+            "delivered_dropped": self.delivered_dropped,
+            "send_errors": self.send_errors,
+        })
+        return stats
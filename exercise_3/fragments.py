@@ -0,0 +1,128 @@
+# Messages too large for one datagram travel as fragments: Messages that carry
+# a slice of the serialized original in `fragment` and are routed, forwarded
+# and acknowledged like any other message.
+# - split(data, size) -> list of slices of at most size bytes
+# - Reassembly(timeout, max_bytes, max_message, min_fragment).add(fragment) -> the
+#   original serialized message once its last fragment arrived, None before that
+#
+# Incomplete messages are dropped after timeout seconds, and the oldest ones
+# are dropped first when the buffer would grow past max_bytes. Fragment counts
+# come from the network: every fragment but the last has min_fragment bytes at
+# least, and a message of max_message bytes cut into slices of that size has no
+# more fragments than ceil(max_message / slice), so other counts are rejected.
+# The slot list of an incomplete message counts towards max_bytes like its
+# fragments, and is charged before it is allocated.
+
+__all__ = ["split", "Reassembly"]
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+TIMEOUT = 30  # seconds an incomplete message waits for its missing fragments
+MAX_BYTES = 64 * 1024 * 1024  # fragment bytes buffered over all incomplete messages
+MAX_MESSAGE = 32 * 1024 * 1024  # bytes of the largest message accepted
+MIN_FRAGMENT = 256  # bytes in every fragment but the last, whatever the MTU
+SLOT_BYTES = 8  # per expected fragment, the list slot of an incomplete message
+
+
+def split(data, size):
+    view = memoryview(data)
+    return [view[i : i + size] for i in range(0, len(data), size)]
+
+
+class Partial:
+    __slots__ = ("parts", "received", "size", "expiry")
+
+    def __init__(self, count, expiry):
+        self.parts = [None] * count
+        self.received = 0
+        self.size = 0
+        self.expiry = expiry
+
+
+class Reassembly:
+
+    def __init__(self, timeout=TIMEOUT, max_bytes=MAX_BYTES, max_message=MAX_MESSAGE, min_fragment=MIN_FRAGMENT):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_message = max_message
+        self.min_fragment = min_fragment
+        self.max_count = -(-max_message // min_fragment)
+        self.partials = OrderedDict()  # (sender id, fragment id) -> Partial, oldest first
+        self.buffered = 0
+        self.lock = Lock()
+
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0  # incomplete messages dropped to stay under max_bytes
+        self.rejected = 0  # fragments of messages larger than max_message, or inconsistent ones
+
+    def add(self, fragment):
+        key = (fragment.sender_id, fragment.fragment_id)
+        count = fragment.fragment_count
+        index = fragment.fragment_index
+        now = time.monotonic()
+        size = len(fragment.fragment)
+        with self.lock:
+            self._expire(now)
+            # every fragment but the last one is full sized
+            if index >= count or count > self.max_count or not size:
+                self.rejected += 1
+                return None
+            if index < count - 1 and (size < self.min_fragment or count > -(-self.max_message // size)):
+                self.rejected += 1
+                return None
+            partial = self.partials.get(key)
+            if partial is not None and len(partial.parts) != count:
+                self.rejected += 1
+                return None
+            if partial is not None and partial.parts[index] is not None:
+                return None
+            charge = size if partial is not None else size + count * SLOT_BYTES
+            while self.buffered + charge > self.max_bytes:
+                if not self.partials:
+                    self.rejected += 1
+                    return None
+                oldest = next(iter(self.partials))
+                self._drop(oldest)
+                self.evicted += 1
+                if oldest == key:
+                    return None
+            if partial is None:
+                partial = self.partials[key] = Partial(count, now + self.timeout)
+                partial.size = count * SLOT_BYTES
+                self.buffered += partial.size
+            partial.parts[index] = fragment.fragment
+            partial.received += 1
+            partial.size += size
+            self.buffered += size
+            if partial.received < count:
+                return None
+            self._drop(key)
+            self.completed += 1
+        return b"".join(partial.parts)
+
+    def _drop(self, key):
+        # caller holds the lock
+        partial = self.partials.pop(key)
+        self.buffered -= partial.size
+
+    def _expire(self, now):
+        # caller holds the lock
+        while self.partials:
+            key, partial = next(iter(self.partials.items()))
+            if partial.expiry > now:
+                return
+            self._drop(key)
+            self.expired += 1
+
+    def stats(self):
+        return {
+            "incomplete": len(self.partials),
+            "buffered": self.buffered,
+            "completed": self.completed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,248 @@
+# Structured logging that stays off the per-message path: a call checks the
+# level of its category and appends a record to a queue, a background thread
+# formats the records and writes them in batches to stdout or a rotating file.
+# - configure(level, path, max_bytes, backups, sample, rate)
+#       sample {category: N}   keeps 1 in N debug and info records of the category
+#       rate {category: R}     keeps at most R records/s of the category, any level
+# - get(category) -> Category  .debug/.info/.warning/.error(fmt, *args)
+#       fmt % args is done by the writer, so arguments must not change afterwards
+# - parse_limits("messages=100,drops=10") -> {"messages": 100.0, "drops": 10.0}
+# - flush(), stats()
+#
+# With the level above DEBUG a debug() call returns after one comparison. The
+# queue is bounded, records that do not fit are dropped and counted rather
+# than making a handler wait for the disk. Suppressed records are reported by
+# the writer as one line per category and batch.
+
+__all__ = ["DEBUG", "INFO", "WARNING", "ERROR", "LEVELS",
+           "configure", "get", "parse_limits", "flush", "stats"]
+
+import atexit
+import os
+import sys
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+NAMES = {value: name.upper() for name, value in LEVELS.items()}
+MAX_QUEUE = 65536  # records waiting for the writer
+FLUSH_INTERVAL = 0.05  # seconds between batches, warnings and errors wake the writer at once
+MAX_BYTES = 10 * 1024 * 1024  # size of the log file before it is rotated
+BACKUPS = 3  # rotated files kept as path.1 ... path.N
+
+
+def format_line(created, level, name, text):
+    stamp = time.strftime("%H:%M:%S", time.localtime(created))
+    return f"{stamp}.{int(created % 1 * 1000):03d} {NAMES[level]} {name}: {text}\n"
+
+
+class Category:
+
+    def __init__(self, name, pipeline):
+        self.name = name
+        self.pipeline = pipeline
+        self.level = pipeline.level
+        self.sample_every = 1
+        self.seen = 0
+        self.rate = None  # records/s, None for no limit
+        self.tokens = 0.0
+        self.refilled = 0.0
+        self.suppressed = 0
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def debug(self, fmt, *args):
+        if self.level <= DEBUG:
+            self.log(DEBUG, fmt, args)
+
+    def info(self, fmt, *args):
+        if self.level <= INFO:
+            self.log(INFO, fmt, args)
+
+    def warning(self, fmt, *args):
+        if self.level <= WARNING:
+            self.log(WARNING, fmt, args)
+
+    def error(self, fmt, *args):
+        self.log(ERROR, fmt, args)
+
+    def log(self, level, fmt, args):
+        if level < WARNING and self.sample_every > 1:
+            self.seen += 1
+            if self.seen % self.sample_every:
+                return
+        if self.rate is not None and not self.take_token():
+            self.suppressed += 1
+            return
+        self.pipeline.put((time.time(), level, self, fmt, args))
+
+    def take_token(self):
+        # token bucket holding up to one second of records
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Pipeline:
+
+    def __init__(self):
+        self.level = WARNING  # until configure(), so modules used as libraries stay quiet
+        self.sample = {}
+        self.rate = {}
+        self.categories = {}
+        self.records = deque()
+        self.wake = Event()
+        self.lock = Lock()  # one batch written at a time, by the writer or by flush()
+        self.thread = None
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.max_bytes = MAX_BYTES
+        self.backups = BACKUPS
+        self.reported = {}  # suppressed records of each category already reported
+        self.written = 0
+        self.dropped = 0
+
+    def put(self, record):
+        if len(self.records) >= MAX_QUEUE:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if self.thread is None:
+            self.start()
+        if record[1] >= WARNING:
+            self.wake.set()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines = []
+            while self.records:
+                created, level, category, fmt, args = self.records.popleft()
+                try:
+                    text = fmt % args if args else fmt
+                except (TypeError, ValueError) as e:
+                    text = f"{fmt!r} {args!r} ({e})"
+                lines.append(format_line(created, level, category.name, text))
+            for category in list(self.categories.values()):
+                suppressed = category.suppressed - self.reported.get(category.name, 0)
+                if suppressed:
+                    self.reported[category.name] = category.suppressed
+                    lines.append(format_line(time.time(), WARNING, "logs",
+                                             f"{suppressed} {category.name} records suppressed by the rate limit"))
+            if lines:
+                self.write("".join(lines))
+                self.written += len(lines)
+
+    def write(self, text):
+        if self.path is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+        data = text.encode()
+        if self.file is None:
+            self.open()
+        elif self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+    def rotate(self):
+        # path -> path.1 -> path.2 ..., the oldest one is overwritten
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+
+PIPELINE = Pipeline()
+atexit.register(PIPELINE.flush)
+
+
+def _after_fork():
+    # a forked child has neither the writer thread nor whoever held the lock
+    PIPELINE.lock = Lock()
+    PIPELINE.thread = None
+    PIPELINE.file = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def configure(level="info", path=None, max_bytes=MAX_BYTES, backups=BACKUPS, sample=None, rate=None):
+    # level is a name of LEVELS or one of the constants; categories created later follow it too
+    PIPELINE.flush()
+    with PIPELINE.lock:
+        if PIPELINE.file is not None:
+            PIPELINE.file.close()
+            PIPELINE.file = None
+        PIPELINE.level = LEVELS[level.lower()] if isinstance(level, str) else level
+        PIPELINE.path = path
+        PIPELINE.max_bytes = max_bytes
+        PIPELINE.backups = backups
+        PIPELINE.sample = dict(sample or {})
+        PIPELINE.rate = dict(rate or {})
+        for category in PIPELINE.categories.values():
+            _apply(category)
+
+
+def _apply(category):
+    category.level = PIPELINE.level
+    category.sample_every = max(1, int(PIPELINE.sample.get(category.name, 1)))
+    category.rate = PIPELINE.rate.get(category.name)
+    category.tokens = category.rate or 0.0
+    category.refilled = time.monotonic()
+
+
+def get(name):
+    category = PIPELINE.categories.get(name)
+    if category is None:
+        category = PIPELINE.categories.setdefault(name, Category(name, PIPELINE))
+        _apply(category)
+    return category
+
+
+def parse_limits(text):
+    limits = {}
+    for item in filter(None, text.split(",")):
+        name, _, value = item.partition("=")
+        limits[name.strip()] = float(value)
+    return limits
+
+
+def flush():
+    PIPELINE.flush()
+
+
+def stats():
+    return {"queued": len(PIPELINE.records), "written": PIPELINE.written, "dropped": PIPELINE.dropped,
+            "suppressed": {name: category.suppressed for name, category in PIPELINE.categories.items()
+                           if category.suppressed}}
@@ -1,5 +1,10 @@
+import asyncio
 import sys
+import logs
 from Peer import Peer
+from async_peer import AsyncPeer
+
+MESSAGE_LOG = logs.get("messages")
 
 def main():
     if len(sys.argv) < 3:
@@ -14,14 +19,74 @@ def main():
         desired_id_index = sys.argv.index('--desired-id')
         desired_id = int(sys.argv[desired_id_index + 1])
 
-    peer = Peer(my_ip, my_port, desired_id)
+    # --no-routing floods every message instead of following learned routes
+    options = {'routing': '--no-routing' not in sys.argv}
+
+    # --gossip K passes messages without a route to K random neighbors instead of all of them,
+    # --push-pull has neighbors exchange digests to fill in what gossip missed
+    if '--gossip' in sys.argv:
+        options['dissemination'] = 'gossip'
+        options['fanout'] = int(sys.argv[sys.argv.index('--gossip') + 1])
+    options['push_pull'] = '--push-pull' in sys.argv
+
+    # --compress deflates datagrams to neighbors that run with --compress too
+    options['compression'] = '--compress' in sys.argv
+
+    # --trace-rate R traces about R of the messages sent, receivers print where the time went
+    if '--trace-rate' in sys.argv:
+        options['trace_rate'] = float(sys.argv[sys.argv.index('--trace-rate') + 1])
+
+    # --log-level debug also logs ACKs, --log-file writes to a rotating file instead of stdout
+    log_level = 'info'
+    if '--log-level' in sys.argv:
+        log_level = sys.argv[sys.argv.index('--log-level') + 1]
+    if log_level not in logs.LEVELS:
+        print(f"Invalid log level {log_level}, expected one of: {', '.join(logs.LEVELS)}")
+        sys.exit(1)
+    log_file = None
+    if '--log-file' in sys.argv:
+        log_file = sys.argv[sys.argv.index('--log-file') + 1]
+    logs.configure(log_level, log_file)
+
+    # --asyncio runs the peer on an event loop instead of a listener thread
+    if '--asyncio' in sys.argv:
+        asyncio.run(run_async(my_ip, my_port, desired_id, options))
+        return
+
+    peer = Peer(my_ip, my_port, desired_id, **options)
+    connect_peers(peer, desired_id)
+
+    while True:
+        msg_text = input("Enter message text to broadcast: ")
+        destination_id = int(input("Enter destination ID: "))
+        peer.broadcast_message(msg_text, destination_id)
+
+async def run_async(my_ip, my_port, desired_id, options):
+    peer = AsyncPeer(my_ip, my_port, desired_id, **options)
+    await peer.start()
+    connect_peers(peer, desired_id)
+    printer = asyncio.create_task(print_messages(peer))  # referenced so it is not garbage collected
+
+    loop = asyncio.get_running_loop()
+    while True:
+        msg_text = await loop.run_in_executor(None, input, "Enter message text to broadcast: ")
+        destination_id = int(await loop.run_in_executor(None, input, "Enter destination ID: "))
+        await peer.send(msg_text, destination_id)
+
+async def print_messages(peer):
+    async for message in peer:
+        MESSAGE_LOG.info("Message received: %s", message.text_message)
 
+def connect_peers(peer, desired_id):
     # Connect to other peers 
-    for arg in sys.argv[2:]:
-        if arg == '--desired-id':
+    for index, arg in enumerate(sys.argv[2:], 2):
+        if arg in ('--desired-id', '--no-routing', '--asyncio', '--gossip', '--push-pull', '--trace-rate',
+                   '--log-level', '--log-file', '--compress'):
             continue 
         if arg == str(desired_id):
             continue  
+        if sys.argv[index - 1] in ('--gossip', '--trace-rate', '--log-level', '--log-file'):
+            continue
 
         peer_ip_port = arg.split(":")
         if len(peer_ip_port) == 2:
@@ -31,10 +96,5 @@ def main():
         else:
             print(f"Invalid peer address format: {arg}. Expected format is ip:port.")
 
-    while True:
-        msg_text = input("Enter message text to broadcast: ")
-        destination_id = int(input("Enter destination ID: "))
-        peer.broadcast_message(msg_text, destination_id)
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
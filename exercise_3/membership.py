@@ -0,0 +1,131 @@
+# Neighbors of a Peer and whether they are still alive.
+# - MembershipTable(expected_gap, threshold)  neighbors indexed by address;
+#                                            iterating it yields the live ones
+#
+# Neighbors send each other heartbeats every expected_gap seconds. A phi
+# accrual failure detector turns the time since the last heartbeat into a
+# suspicion level phi = -log10(P(a gap this long)), using the mean and spread
+# of the gaps seen so far. Neighbors above the threshold are evicted; they are
+# still probed for a while, and an arrival from one of them brings it back.
+
+__all__ = ["MembershipTable"]
+
+import math
+import time
+from collections import deque
+from threading import Lock
+
+PHI_THRESHOLD = 8.0  # suspicion level at which a neighbor is evicted
+HISTORY = 100  # arrival gaps kept per neighbor
+MIN_STD = 0.05  # seconds, keeps phi finite for very regular arrivals
+FORGET_AFTER = 300  # seconds an evicted neighbor keeps being probed
+
+
+class Member:
+    __slots__ = ("addr", "peer_id", "joined", "last_heard", "gaps", "evicted_at")
+
+    def __init__(self, addr, peer_id, now, expected_gap):
+        self.addr = addr
+        self.peer_id = peer_id
+        self.joined = now
+        self.last_heard = now
+        # seeded with the expected gap, so a neighbor that never answers is still detected
+        self.gaps = deque([expected_gap], maxlen=HISTORY)
+        self.evicted_at = None
+
+    def phi(self, now):
+        mean = sum(self.gaps) / len(self.gaps)
+        variance = sum((gap - mean) ** 2 for gap in self.gaps) / len(self.gaps)
+        std = max(math.sqrt(variance), MIN_STD, mean / 4)
+        # probability of a gap longer than the current one under a normal distribution
+        p = 0.5 * math.erfc((now - self.last_heard - mean) / (std * math.sqrt(2)))
+        return -math.log10(max(p, 1e-300))
+
+
+class MembershipTable:
+
+    def __init__(self, expected_gap, threshold=PHI_THRESHOLD):
+        self.expected_gap = expected_gap  # seconds between heartbeats
+        self.threshold = threshold
+        self.members = {}  # addr -> Member, live and evicted
+        self.live = ()  # addresses of the live members, rebuilt on every change
+        self.lock = Lock()
+
+        self.evictions = 0
+        self.rejoins = 0
+
+    def add(self, addr, peer_id=0):
+        # True if addr was not a live member before
+        now = time.monotonic()
+        with self.lock:
+            member = self.members.get(addr)
+            if member is not None and member.evicted_at is None:
+                if peer_id:
+                    member.peer_id = peer_id
+                return False
+            if member is not None:
+                self.rejoins += 1
+            # a neighbor coming back may have restarted, its old gaps say nothing about it
+            self.members[addr] = Member(addr, peer_id, now, self.expected_gap)
+            self._rebuild()
+            return True
+
+    def heard(self, addr, peer_id=0):
+        # records a heartbeat, returns False if addr is not a live member
+        now = time.monotonic()
+        with self.lock:
+            member = self.members.get(addr)
+            if member is None or member.evicted_at is not None:
+                return False
+            member.gaps.append(now - member.last_heard)
+            member.last_heard = now
+            if peer_id:
+                member.peer_id = peer_id
+            return True
+
+    def evict_suspects(self):
+        # evicts the live members whose phi is above the threshold, returns their addresses
+        now = time.monotonic()
+        with self.lock:
+            evicted = [addr for addr, member in self.members.items()
+                       if member.evicted_at is None and member.phi(now) > self.threshold]
+            for addr in evicted:
+                self.members[addr].evicted_at = now
+                self.evictions += 1
+            for addr in [addr for addr, member in self.members.items()
+                         if member.evicted_at is not None and now - member.evicted_at > FORGET_AFTER]:
+                del self.members[addr]
+            if evicted:
+                self._rebuild()
+            return evicted
+
+    def evicted(self):
+        with self.lock:
+            return [addr for addr, member in self.members.items() if member.evicted_at is not None]
+
+    def _rebuild(self):
+        # caller holds the lock
+        self.live = tuple(addr for addr, member in self.members.items() if member.evicted_at is None)
+
+    def snapshot(self):
+        # one dict per neighbor, for watching the overlay
+        now = time.monotonic()
+        with self.lock:
+            return [{
+                "addr": addr,
+                "peer_id": member.peer_id,
+                "status": "alive" if member.evicted_at is None else "evicted",
+                "phi": member.phi(now) if member.evicted_at is None else None,
+                "last_heard": now - member.last_heard,
+                "uptime": now - member.joined,
+            } for addr, member in self.members.items()]
+
+    def __iter__(self):
+        return iter(self.live)
+
+    def __contains__(self, addr):
+        member = self.members.get(addr)
+        return member is not None and member.evicted_at is None
+
+    def __len__(self):
+        return len(self.live)
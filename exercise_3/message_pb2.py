@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\"\x82\x01\n\x07Message\x12\x16\n\x0ctext_message\x18\x01 \x01(\tH\x00\x12\x18\n\x0e\x61\x63knowledgment\x18\x02 \x01(\tH\x00\x12\x11\n\tsender_id\x18\x03 \x01(\x03\x12\x16\n\x0e\x64\x65stination_id\x18\x04 \x01(\x03\x12\x13\n\x0bsender_port\x18\x05 \x01(\x03\x42\x05\n\x03msgb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rmessage.proto\"\xa6\x03\n\x07Message\x12\x16\n\x0ctext_message\x18\x01 \x01(\tH\x00\x12\x18\n\x0e\x61\x63knowledgment\x18\x02 \x01(\tH\x00\x12\x11\n\tsender_id\x18\x03 \x01(\x03\x12\x16\n\x0e\x64\x65stination_id\x18\x04 \x01(\x03\x12\x13\n\x0bsender_port\x18\x05 \x01(\x03\x12\x12\n\nmessage_id\x18\x06 \x01(\x03\x12\x0c\n\x04hops\x18\x07 \x01(\x05\x12\x10\n\x08sequence\x18\x08 \x01(\x03\x12\x16\n\x0e\x63umulative_ack\x18\t \x01(\x03\x12\x16\n\x0eselective_acks\x18\n \x03(\x03\x12\x13\n\x0b\x66ragment_id\x18\x0b \x01(\x03\x12\x16\n\x0e\x66ragment_index\x18\x0c \x01(\x05\x12\x16\n\x0e\x66ragment_count\x18\r \x01(\x05\x12\x10\n\x08\x66ragment\x18\x0e \x01(\x0c\x12\x0e\n\x06\x64igest\x18\x0f \x03(\x03\x12\x15\n\x05trace\x18\x10 \x01(\x0b\x32\x06.Trace\x12\x13\n\x0b\x63ompression\x18\x11 \x01(\x08\x12\x13\n\x0bincarnation\x18\x12 \x01(\x03\x12\x16\n\x0e\x64igest_senders\x18\x13 \x03(\x03\x42\x05\n\x03msg\"6\n\x08HopStamp\x12\r\n\x05where\x18\x01 \x01(\t\x12\x0c\n\x04node\x18\x02 \x01(\x03\x12\r\n\x05\x61t_ns\x18\x03 \x01(\x03\"E\n\x05Trace\x12\x10\n\x08trace_id\x18\x01 \x01(\x03\x12\x11\n\torigin_ns\x18\x02 \x01(\x03\x12\x17\n\x04hops\x18\x03 \x03(\x0b\x32\t.HopStampb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,5 +32,9 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'message_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_MESSAGE']._serialized_start=18
-  _globals['_MESSAGE']._serialized_end=148
+  _globals['_MESSAGE']._serialized_end=440
+  _globals['_HOPSTAMP']._serialized_start=442
+  _globals['_HOPSTAMP']._serialized_end=496
+  _globals['_TRACE']._serialized_start=498
+  _globals['_TRACE']._serialized_end=567
 # @@protoc_insertion_point(module_scope)
@@ -0,0 +1,180 @@
+# Reliable delivery between two Peers over lossy UDP.
+# - SendWindow(incarnation, max_window)  per destination: sequence numbers, messages
+#                           in flight, retransmission deadlines and the adaptive RTO
+# - ReceiveWindow(incarnation)  per sender: which sequence numbers arrived, and
+#                           the cumulative + selective ACK that reports them
+#
+# A message keeps its sequence number across retransmissions, so the receiver
+# delivers it once however many copies arrive. One ACK covers every sequence
+# number up to `cumulative` plus the ones listed in `selective`. A sender that
+# restarts counts from 1 again, and so does a window that was dropped after
+# IDLE_TIMEOUT without traffic and created again, so messages carry the
+# incarnation of their SendWindow, the time it was created: a newer one gets a
+# fresh ReceiveWindow, and ACKs echo it so a sender ignores those meant for an
+# earlier window. Receivers drop quiet windows after RECEIVE_IDLE_TIMEOUT.
+
+__all__ = ["SendWindow", "ReceiveWindow"]
+
+import time
+from collections import deque
+from threading import Lock
+
+MAX_WINDOW = 64  # sequences in flight per destination, counted from the oldest unacked one
+INITIAL_RTO = 0.5  # seconds, until the first round trip was measured
+MIN_RTO = 0.02
+MAX_RTO = 5.0
+MAX_RETRANSMISSIONS = 10  # attempts before a message is given up
+MAX_SELECTIVE = MAX_WINDOW  # sequence numbers listed in one ACK beyond the cumulative one
+IDLE_TIMEOUT = 120  # seconds an empty SendWindow is kept after its last message or ACK
+RECEIVE_IDLE_TIMEOUT = 2 * IDLE_TIMEOUT  # longer, so the sender's window goes first
+
+
+class InFlight:
+    __slots__ = ("message", "sent", "deadline", "retransmissions")
+
+    def __init__(self, message, sent, deadline):
+        self.message = message
+        self.sent = sent
+        self.deadline = deadline
+        self.retransmissions = 0
+
+
+class SendWindow:
+
+    def __init__(self, incarnation=0, max_window=MAX_WINDOW):
+        self.incarnation = incarnation  # carried by its messages, ACKs echo it
+        self.max_window = min(max_window, MAX_WINDOW)  # receivers rely on MAX_WINDOW
+        self.last_active = time.monotonic()
+        self.next_sequence = 1
+        self.in_flight = {}  # sequence -> InFlight
+        self.waiting = deque()  # messages that do not fit in the window yet
+        self.lock = Lock()
+
+        # round trip estimate as in RFC 6298
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+        self.retransmissions = 0
+        self.given_up = 0
+
+    def submit(self, message):
+        # numbers the message, returns the messages that can go out now
+        with self.lock:
+            message.sequence = self.next_sequence
+            message.incarnation = self.incarnation
+            self.next_sequence += 1
+            self.waiting.append(message)
+            self.last_active = time.monotonic()
+            return self._fill(self.last_active)
+
+    def _fill(self, now):
+        # caller holds the lock
+        ready = []
+        while self.waiting:
+            # like TCP the window starts at the oldest unacked sequence, so one
+            # lost message holds back new ones instead of letting them run ahead
+            oldest = min(self.in_flight, default=self.waiting[0].sequence)
+            if self.waiting[0].sequence >= oldest + self.max_window:
+                break
+            message = self.waiting.popleft()
+            self.in_flight[message.sequence] = InFlight(message, now, now + self.rto)
+            ready.append(message)
+        return ready
+
+    def acknowledge(self, cumulative, selective):
+        # drops what the receiver confirmed, returns the messages that fit in the window now
+        now = time.monotonic()
+        with self.lock:
+            self.last_active = now
+            acked = [sequence for sequence in self.in_flight if sequence <= cumulative]
+            acked.extend(sequence for sequence in selective if sequence in self.in_flight)
+            for sequence in acked:
+                entry = self.in_flight.pop(sequence, None)
+                if entry is not None and entry.retransmissions == 0:
+                    # Karn: the round trip of a retransmitted message is ambiguous
+                    self._sample(now - entry.sent)
+            return self._fill(now)
+
+    def _sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def expired(self):
+        # messages whose ACK is overdue, to be sent again
+        now = time.monotonic()
+        resend = []
+        with self.lock:
+            overdue = sorted((sequence, entry) for sequence, entry in self.in_flight.items() if entry.deadline <= now)
+            if not overdue:
+                return resend
+            if min(self.in_flight) == overdue[0][0]:
+                # back off when the oldest message times out, like TCP's single
+                # retransmission timer, not once for every message behind it
+                self.rto = min(MAX_RTO, self.rto * 2)
+            for sequence, entry in overdue:
+                if entry.retransmissions >= MAX_RETRANSMISSIONS:
+                    del self.in_flight[sequence]
+                    self.given_up += 1
+                    continue
+                entry.retransmissions += 1
+                self.retransmissions += 1
+                entry.sent = now
+                entry.deadline = now + self.rto
+                resend.append(entry.message)
+            # given up messages made room in the window
+            resend.extend(self._fill(now))
+        return resend
+
+    def pending(self):
+        return len(self.in_flight) + len(self.waiting)
+
+    def idle(self, now):
+        # nothing left to send or retransmit and no traffic for IDLE_TIMEOUT
+        return not self.pending() and now - self.last_active > IDLE_TIMEOUT
+
+
+class ReceiveWindow:
+
+    def __init__(self, incarnation=0):
+        self.incarnation = incarnation  # of the sender, ACKs carry it back
+        self.cumulative = 0  # every sequence up to this one arrived
+        self.above = set()  # sequences above cumulative that arrived
+        self.unacked = 0  # arrivals since the last ACK was sent
+        self.ack_due = None  # monotonic time the next ACK has to go out by
+        self.last_arrival = time.monotonic()
+        self.lock = Lock()
+
+    def receive(self, sequence, ack_delay):
+        # True the first time a sequence arrives, duplicates are ACKed again but not delivered
+        with self.lock:
+            self.unacked += 1
+            self.last_arrival = time.monotonic()
+            if self.ack_due is None:
+                self.ack_due = self.last_arrival + ack_delay
+            if sequence <= self.cumulative or sequence in self.above:
+                return False
+            if sequence > self.cumulative + MAX_WINDOW:
+                # senders only get this far once they gave up on the missing ones below
+                self.cumulative = sequence - MAX_WINDOW
+                self.above = {s for s in self.above if s > self.cumulative}
+            self.above.add(sequence)
+            while self.cumulative + 1 in self.above:
+                self.cumulative += 1
+                self.above.remove(self.cumulative)
+            return True
+
+    def take_ack(self):
+        # (cumulative, selective) for the next ACK, resets the delayed ACK timer
+        with self.lock:
+            self.unacked = 0
+            self.ack_due = None
+            return self.cumulative, sorted(self.above)[:MAX_SELECTIVE]
+
+    def idle(self, now):
+        return self.ack_due is None and now - self.last_arrival > RECEIVE_IDLE_TIMEOUT
@@ -0,0 +1,58 @@
+# Reverse-path routes learned by Peer: the neighbor a message from peer X
+# arrived through first is also the way back to X.
+# - RoutingTable(ttl).learn(peer_id, neighbor_addr, hops)
+# - RoutingTable.next_hop(peer_id) -> neighbor address, None if unknown or expired
+
+__all__ = ["RoutingTable"]
+
+import time
+from threading import Lock
+
+ROUTE_TTL = 30  # seconds a route is used after it was last confirmed
+
+
+class Route:
+    __slots__ = ("neighbor", "hops", "expiry")
+
+    def __init__(self, neighbor, hops, expiry):
+        self.neighbor = neighbor
+        self.hops = hops
+        self.expiry = expiry
+
+
+class RoutingTable:
+
+    def __init__(self, ttl=ROUTE_TTL):
+        self.ttl = ttl
+        self.routes = {}  # peer id -> Route
+        self.lock = Lock()
+
+    def learn(self, peer_id, neighbor, hops):
+        with self.lock:
+            self.routes[peer_id] = Route(neighbor, hops, time.monotonic() + self.ttl)
+
+    def next_hop(self, peer_id):
+        with self.lock:
+            route = self.routes.get(peer_id)
+            if route is None:
+                return None
+            if route.expiry <= time.monotonic():
+                del self.routes[peer_id]
+                return None
+            return route.neighbor
+
+    def forget(self, neighbor):
+        # drops every route through a neighbor that went away
+        with self.lock:
+            for peer_id in [peer_id for peer_id, route in self.routes.items() if route.neighbor == neighbor]:
+                del self.routes[peer_id]
+
+    def table(self):
+        # {peer id: (neighbor, hops, seconds left)} of the routes still valid
+        now = time.monotonic()
+        with self.lock:
+            return {peer_id: (route.neighbor, route.hops, route.expiry - now)
+                    for peer_id, route in self.routes.items() if route.expiry > now}
+
+    def __len__(self):
+        return len(self.routes)
@@ -0,0 +1,48 @@
+# Bounded set of recently seen message keys, used by Peer to forward every
+# flooded message at most once.
+# - SeenCache(capacity, ttl).add(key) -> True the first time a key is seen
+#
+# Peer uses (sender id, message id) as the key: snowflake ids only carry a hash
+# of their assigner, so two peers can mint the same id.
+# Keys are kept in least recently seen order. A key is forgotten once it has not
+# been seen for ttl seconds, or when capacity newer keys push it out.
+
+__all__ = ["SeenCache"]
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+CAPACITY = 64 * 1024  # keys remembered at most
+TTL = 60  # seconds a key is remembered after it was last seen
+
+
+class SeenCache:
+
+    def __init__(self, capacity=CAPACITY, ttl=TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.expiry = OrderedDict()  # key -> time it is forgotten, oldest first
+        self.lock = Lock()
+
+    def add(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            seen = key in self.expiry
+            self.expiry[key] = now + self.ttl
+            if seen:
+                self.expiry.move_to_end(key)
+            elif len(self.expiry) > self.capacity:
+                self.expiry.popitem(last=False)
+            return not seen
+
+    def _expire(self, now):
+        while self.expiry:
+            key, expiry = next(iter(self.expiry.items()))
+            if expiry > now:
+                return
+            del self.expiry[key]
+
+    def __len__(self):
+        return len(self.expiry)
@@ -1,15 +1,32 @@
 # Simplified snowflake variant: [1b(0) || 38b(timestamp_{10ms}) || 16b(assigner_hash) || 9b(sequence)]
+# - IdGenerator(assigner)           ids for one assigner, safe to share between threads
+#   .derive_id(wait), .derive_ids(n, wait), .lead() -> seconds the last id is ahead of the clock
+# - generator(assigner) -> IdGenerator  the process-wide generator for an assigner
 # - derive_id(assigner: id) -> id
+# - derive_ids(assigner: id, n) -> [id]
+#
+# A tick has room for 512 ids; when they are used up the generator waits for
+# the next tick instead of wrapping around. With wait=False, for callers on an
+# event loop, it runs ahead into the next tick instead and leaves the waiting
+# to them: lead() says how long. Timestamps never go backwards: if the clock is
+# set back, ids keep coming from the last tick handed out, and when the clock
+# is set back by more than MAX_WAIT the generator moves on one tick at a time
+# instead of waiting for it to catch up.
 
-__all__ = ["derive_id"]
+__all__ = ["IdGenerator", "generator", "derive_id", "derive_ids"]
 
 import time
 import datetime
 from hashlib import sha256
+from threading import Lock
 
 
-LAST_TIMESTAMP = 0
-LAST_SEQUENCE = 0
+SEQUENCE_BITS = 9
+ASSIGNER_BITS = 16
+TIMESTAMP_SHIFT = ASSIGNER_BITS + SEQUENCE_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TICK_NS = 10_000_000  # 10ms
+MAX_WAIT = 100  # ticks the generator waits for a clock that was set back
 ORIGIN = int(
     datetime.datetime(2024, 1, 1, 0, 0, 0).timestamp() * 100
 )  # 2024-01-01 00:00:00, 10ms precision
@@ -25,15 +42,107 @@ def folded_hash(data: int):
     return int.from_bytes(folded, byteorder="big")
 
 
+class IdGenerator:
+
+    def __init__(self, assigner: int):
+        self.assigner = assigner
+        self.assigner_bits = folded_hash(assigner) << SEQUENCE_BITS  # hashed once, not per id
+        self.timestamp = 0  # tick of the last id handed out
+        self.sequence = MAX_SEQUENCE
+        self.last_clock = 0
+        self.lock = Lock()
+
+        self.waits = 0  # ticks whose 512 ids were used up
+        self.regressions = 0  # times the clock was seen going backwards
+
+    def clock(self):
+        return time.time_ns() // TICK_NS - ORIGIN
+
+    def derive_id(self, wait=True):
+        with self.lock:
+            self._observe_clock()
+            if self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self._next_tick(wait)
+            return (self.timestamp << TIMESTAMP_SHIFT) | self.assigner_bits | self.sequence
+
+    def derive_ids(self, n: int, wait=True):
+        # n ids reserved in one go, in increasing order
+        ids = []
+        with self.lock:
+            self._observe_clock()
+            while len(ids) < n:
+                if self.sequence == MAX_SEQUENCE:
+                    self._next_tick(wait)
+                    first = 0
+                else:
+                    first = self.sequence + 1
+                last = min(MAX_SEQUENCE, first + n - len(ids) - 1)
+                base = (self.timestamp << TIMESTAMP_SHIFT) | self.assigner_bits
+                ids.extend(range(base | first, (base | last) + 1))
+                self.sequence = last
+        return ids
+
+    def _observe_clock(self):
+        # caller holds the lock; starts a new tick when the clock has moved past the last one
+        now = self.clock()
+        if now < self.last_clock:
+            self.regressions += 1
+        self.last_clock = now
+        if now > self.timestamp:
+            self.timestamp = now
+            self.sequence = -1
+
+    def lead(self):
+        # seconds until the clock reaches the tick of the last id handed out, 0 once it has
+        with self.lock:
+            ahead = (self.timestamp + ORIGIN) * TICK_NS - time.time_ns()
+        return min(max(0, ahead), MAX_WAIT * TICK_NS) / 1e9
+
+    def _next_tick(self, wait):
+        # caller holds the lock and has used up every sequence of self.timestamp
+        self.waits += 1
+        now = self.clock()
+        if not wait or self.timestamp - now >= MAX_WAIT:
+            # the caller cannot block, or the clock was set back further than is worth waiting for:
+            # run ahead of it
+            self.timestamp += 1
+        else:
+            while now <= self.timestamp:
+                time.sleep(max(0, (self.timestamp + 1 + ORIGIN) * TICK_NS - time.time_ns()) / 1e9)
+                now = self.clock()
+            self.timestamp = now
+            self.last_clock = now
+        self.sequence = 0
+
+    def stats(self):
+        return {"waits": self.waits, "regressions": self.regressions}
+
+
+GENERATORS = {}  # assigner -> IdGenerator
+GENERATORS_BY_HASH = {}  # assigner hash -> IdGenerator
+GENERATORS_LOCK = Lock()
+
+
+def generator(assigner: int):
+    # assigners whose hashes collide share a generator, so their ids cannot collide either
+    ids = GENERATORS.get(assigner)
+    if ids is None:
+        with GENERATORS_LOCK:
+            ids = GENERATORS.get(assigner)
+            if ids is None:
+                hashed = folded_hash(assigner)
+                ids = GENERATORS_BY_HASH.get(hashed)
+                if ids is None:
+                    ids = GENERATORS_BY_HASH[hashed] = IdGenerator(assigner)
+                GENERATORS[assigner] = ids
+    return ids
+
+
 def derive_id(assigner: int):
-    global LAST_TIMESTAMP
-    global LAST_SEQUENCE
+    return generator(assigner).derive_id()
 
-    timestamp = int(time.time() * 100) - ORIGIN
-    if timestamp == LAST_TIMESTAMP:
-        LAST_SEQUENCE = (LAST_SEQUENCE + 1) % 512
-    else:
-        LAST_SEQUENCE = 0
-        LAST_TIMESTAMP = timestamp
 
-    return (timestamp << 25) | (folded_hash(assigner) << 9) | LAST_SEQUENCE
+def derive_ids(assigner: int, n: int):
+    return generator(assigner).derive_ids(n)